@@ -1,4 +1,5 @@
 from src.dicom_download import *
+from src.dicom_download_local import dicom_download_local_start
 from src.query import *
 from src.anonymize_dicoms import *
 from src.encrypt_keys import *
@@ -24,7 +25,15 @@ def parse_arguments():
     # Download arguments
     parser.add_argument('--deploy', action='store_true', help='Deploy FastAPI to Cloud Run')
     parser.add_argument('--rerun', action='store_true', help='Send message to pre-deployed FastAPI on Cloud Run')
+    parser.add_argument('--republish-all', action='store_true', help='With --rerun, publish every study instead of only those without a completion marker')
     parser.add_argument('--cleanup', action='store_true', help='Clean up resources')
+    parser.add_argument('--download-local', nargs='?', const='', metavar='DIR', help='Download on this machine without Cloud Run, into DIR if given, otherwise into the configured bucket')
+    parser.add_argument('--workers', type=int, default=8, help='Studies downloaded at once with --download-local')
+    parser.add_argument('--qps', type=float, default=0, help='DICOMweb requests per second with --download-local (0 = no limit)')
+    parser.add_argument('--calibrate', type=int, default=0, metavar='N', help='With --deploy, download N studies locally first to measure time and memory for capacity planning')
+    parser.add_argument('--track', action='store_true', help='Wait for published studies to finish, from completion markers in the bucket (on its own, tracks an earlier run)')
+    parser.add_argument('--auto-cleanup', action='store_true', help='With --track, clean up resources once every study has finished')
+    parser.add_argument('--csv', type=str, help='CSV of ENDPOINT_ADDRESS values to publish instead of output/endpoint_data.csv (e.g. output/failed_publish.csv)')
     
     # Anonymize arguments
     parser.add_argument('--anon', type=str, help='Directory name for anonymized DICOM output')
@@ -37,6 +46,7 @@ def main():
     
     dicom_query_file = f'{env}/output/endpoint_data.csv'
     key_output = f'{env}/encryption_key.pkl'
+    id_store_path = f'{env}/output/id_mapping.sqlite'
     output_path = os.path.join(env, "raw_data")
     
     # Handle query command
@@ -63,15 +73,22 @@ def main():
         # Filter data
         create_final_dataset(rad_df, path_df, output_path)
     
-    elif args.deploy or args.cleanup or args.rerun:
-        dicom_download_remote_start(dicom_query_file, args.deploy, args.cleanup)
+    elif args.download_local is not None:
+        dicom_download_local_start(args.csv or dicom_query_file, args.download_local or None, args.workers, args.qps,
+                                   key_file=key_output)
+        
+    elif args.deploy or args.cleanup or args.rerun or args.track:
+        dicom_download_remote_start(args.csv or dicom_query_file, args.deploy, args.cleanup, key_file=key_output,
+                                    publish=args.deploy or args.rerun, track=args.track,
+                                    auto_cleanup=args.auto_cleanup, republish_all=args.republish_all,
+                                    calibrate=args.calibrate)
         
     elif args.anon:
         
         anon_file_gcp = f'{CONFIG["storage"]["anonymized_path"]}/{args.anon}/anon_data.csv'
         anon_file_local = f'{env}/output/anon_data.csv'
         
-        key = encrypt_ids(dicom_query_file, anon_file_gcp, anon_file_local, key_output)
+        key = encrypt_ids(dicom_query_file, anon_file_gcp, anon_file_local, key_output, id_store_path)
         
         BUCKET_PATH = f'{CONFIG["storage"]["download_path"]}/{args.anon}'
         BUCKET_OUTPUT_PATH = f'{CONFIG["storage"]["anonymized_path"]}/{args.anon}'
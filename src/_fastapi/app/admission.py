@@ -0,0 +1,91 @@
+import os
+import threading
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def current_rss():
+    """Resident set size of this process in bytes, or 0 if unavailable."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def container_memory_limit():
+    """Memory limit of the container in bytes (cgroup v2 or v1), or None if unlimited."""
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.isdigit() and int(value) < 1 << 60:
+            return int(value)
+    return None
+
+
+class AdmissionController:
+    """
+    Decides whether this instance can take on another study.
+
+    Tracks in-flight studies and the DICOM bytes held in memory for them, and
+    checks process RSS against a fraction of the container memory limit. When
+    any budget is exceeded new studies are refused, so the caller can answer
+    with a retryable status and let Pub/Sub redeliver later.
+    """
+
+    def __init__(self, max_studies, max_inflight_bytes, memory_limit, memory_high_watermark=0.8):
+        self.max_studies = max_studies
+        self.max_inflight_bytes = max_inflight_bytes
+        self.memory_budget = int(memory_limit * memory_high_watermark) if memory_limit else None
+        self.inflight_studies = 0
+        self.inflight_bytes = 0
+        self.rejections = {"studies": 0, "bytes": 0, "memory": 0}
+        self._lock = threading.Lock()
+
+    def try_admit(self):
+        """
+        Reserve a study slot if every budget allows it.
+
+        Returns:
+            str or None: None if admitted, otherwise the name of the exceeded budget
+        """
+        rss = current_rss() if self.memory_budget else 0
+        with self._lock:
+            if self.inflight_studies >= self.max_studies:
+                reason = "studies"
+            elif self.inflight_bytes >= self.max_inflight_bytes:
+                reason = "bytes"
+            elif self.memory_budget and rss >= self.memory_budget:
+                reason = "memory"
+            else:
+                self.inflight_studies += 1
+                return None
+            self.rejections[reason] += 1
+            return reason
+
+    def release(self):
+        with self._lock:
+            self.inflight_studies -= 1
+
+    def add_bytes(self, count):
+        with self._lock:
+            self.inflight_bytes += count
+
+    def remove_bytes(self, count):
+        with self._lock:
+            self.inflight_bytes -= count
+
+    def stats(self):
+        with self._lock:
+            return {
+                "inflight_studies": self.inflight_studies,
+                "inflight_bytes": self.inflight_bytes,
+                "max_studies": self.max_studies,
+                "max_inflight_bytes": self.max_inflight_bytes,
+                "memory_budget": self.memory_budget,
+                "rss": current_rss(),
+                "rejections": dict(self.rejections),
+            }
@@ -0,0 +1,38 @@
+import io
+import pydicom as dicom
+
+# Bytes scanned first when looking for UIDs. The UIDs sit near the start of
+# the dataset, long before the pixel data of even the largest cine loops.
+HEADER_PROBE_SIZE = 64 * 1024
+
+UID_TAGS = ['SeriesInstanceUID', 'SOPInstanceUID']
+
+
+def _read_uids(data):
+    ds = dicom.dcmread(io.BytesIO(data), force=True, stop_before_pixels=True, specific_tags=UID_TAGS)
+    return ds.get('SeriesInstanceUID'), ds.get('SOPInstanceUID')
+
+
+def read_instance_uids(part_content):
+    """
+    Read SeriesInstanceUID and SOPInstanceUID from DICOM bytes without parsing pixel data.
+
+    Only the leading HEADER_PROBE_SIZE bytes are parsed first. If either UID is
+    not found there, the header of the full part is parsed, still stopping
+    before the pixel data.
+
+    Args:
+        part_content (bytes): Complete DICOM instance
+
+    Returns:
+        tuple: (series_uid, instance_uid), either may be None if missing
+    """
+    if len(part_content) > HEADER_PROBE_SIZE:
+        try:
+            series_uid, instance_uid = _read_uids(part_content[:HEADER_PROBE_SIZE])
+            if series_uid is not None and instance_uid is not None:
+                return series_uid, instance_uid
+        except Exception:
+            pass  # probe ended inside an element, fall back to the full header
+
+    return _read_uids(part_content)
@@ -0,0 +1,238 @@
+import os
+import time
+import random
+import threading
+import email.utils
+
+import requests
+
+# Statuses worth retrying: quota exhaustion and transient server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Healthcare API request budget shared by every instance of the service, and the
+# number of instances sharing it. Each worker process gets a static share of the
+# budget. With DICOMWEB_ADAPTIVE it raises its rate while requests succeed, up to
+# DICOMWEB_ADAPTIVE_MAX_SHARE times that share, and backs off on 429s. That relies
+# on the shared quota answering 429, so it is off by default.
+DICOMWEB_QPS = float(os.environ.get("DICOMWEB_QPS", "0"))
+DICOMWEB_INSTANCES = int(os.environ.get("DICOMWEB_INSTANCES", "1"))
+DICOMWEB_BURST = float(os.environ.get("DICOMWEB_BURST", "0"))
+DICOMWEB_ADAPTIVE = os.environ.get("DICOMWEB_ADAPTIVE", "false").lower() in ("1", "true", "yes")
+DICOMWEB_ADAPTIVE_MAX_SHARE = float(os.environ.get("DICOMWEB_ADAPTIVE_MAX_SHARE", "2"))
+# Gunicorn worker processes per instance, each with its own rate limiter
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "1"))
+
+DICOMWEB_MAX_RETRIES = int(os.environ.get("DICOMWEB_MAX_RETRIES", "5"))
+DICOMWEB_BACKOFF_BASE = float(os.environ.get("DICOMWEB_BACKOFF_BASE", "1"))
+DICOMWEB_BACKOFF_MAX = float(os.environ.get("DICOMWEB_BACKOFF_MAX", "60"))
+# (connect, read) timeouts; the read timeout applies between chunks, not to the whole study
+DICOMWEB_TIMEOUT = (10, float(os.environ.get("DICOMWEB_READ_TIMEOUT", "300")))
+
+
+class TokenBucket:
+    """
+    Blocking token-bucket rate limiter.
+
+    Tokens refill at `rate` per second up to `burst`. A rate of 0 disables
+    throttling.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one token, sleeping until one is available.
+
+        Returns:
+            float: Seconds spent waiting
+        """
+        if self.rate <= 0:
+            return 0.0
+
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def succeeded(self):
+        """Note a request the server accepted; a fixed rate ignores it."""
+
+    def throttled(self):
+        """Note a request the server rejected for quota; a fixed rate ignores it."""
+
+
+class AdaptiveTokenBucket(TokenBucket):
+    """
+    Token bucket whose rate adapts to the server's quota errors.
+
+    Starting from the static share `rate`, the rate grows by `max_rate * step`
+    per accepted request up to `max_rate`, and is halved on a 429, at most once
+    per `decrease_interval` seconds since a burst of 429s is one quota event.
+    It never drops below the static share, which stays within the budget on its own.
+    """
+
+    def __init__(self, rate, max_rate, burst=None, step=0.001, decrease_interval=1.0):
+        super().__init__(rate, burst)
+        self.min_rate = rate
+        self.max_rate = max(max_rate, rate)
+        self.increase = self.max_rate * step
+        self.decrease_interval = decrease_interval
+        self.decreased = 0.0
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def throttled(self):
+        with self._lock:
+            now = time.monotonic()
+            if now - self.decreased >= self.decrease_interval:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.decreased = now
+
+
+def retry_after_seconds(response):
+    """Parse a Retry-After header (seconds or HTTP date), or None if absent."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class DicomWebClient:
+    """
+    DICOMweb GET client with a shared keep-alive session, rate limiting and retries.
+
+    Requests on 429 and 5xx responses, or on connection errors, are retried
+    with exponential backoff and full jitter, honouring Retry-After when the
+    server sends one. Only the initial response is retried; a stream that
+    breaks mid-transfer is left to the caller.
+    """
+
+    def __init__(self, session_provider, token_provider, rate_limiter=None,
+                 max_retries=DICOMWEB_MAX_RETRIES, backoff_base=DICOMWEB_BACKOFF_BASE,
+                 backoff_max=DICOMWEB_BACKOFF_MAX, timeout=DICOMWEB_TIMEOUT):
+        self.session_provider = session_provider
+        self.token_provider = token_provider
+        self.rate_limiter = rate_limiter or TokenBucket(0)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.status_counts = {}
+        self.counters = {"requests": 0, "retries": 0, "connection_errors": 0,
+                         "throttle_wait_seconds": 0.0, "backoff_wait_seconds": 0.0}
+        self._lock = threading.Lock()
+
+    def _record(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def _backoff(self, attempt, response=None):
+        delay = retry_after_seconds(response) if response is not None else None
+        if delay is None:
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        delay = min(delay, self.backoff_max)
+        self._record("retries")
+        self._record("backoff_wait_seconds", delay)
+        time.sleep(delay)
+
+    def get(self, url, accept, stream=True):
+        """
+        GET a DICOMweb resource, retrying transient failures.
+
+        Args:
+            url (str): DICOMweb URL
+            accept (str): Accept header value
+            stream (bool): Stream the response body
+
+        Returns:
+            requests.Response: The last response received; the caller checks the
+            status and closes it
+
+        Raises:
+            requests.RequestException: If every attempt failed to connect
+        """
+        for attempt in range(self.max_retries + 1):
+            self._record("throttle_wait_seconds", self.rate_limiter.acquire())
+            self._record("requests")
+
+            headers = {"Accept": accept, "Authorization": f"Bearer {self.token_provider()}"}
+            try:
+                response = self.session_provider().get(url, headers=headers, stream=stream, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                self._record("connection_errors")
+                if attempt == self.max_retries:
+                    raise
+                self._backoff(attempt)
+                continue
+
+            with self._lock:
+                self.status_counts[response.status_code] = self.status_counts.get(response.status_code, 0) + 1
+            if response.status_code == 429:
+                self.rate_limiter.throttled()
+            elif response.status_code < 400:
+                self.rate_limiter.succeeded()
+
+            if response.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+                return response
+
+            response.close()
+            self._backoff(attempt, response)
+
+    def stats(self):
+        """Request, retry and throttling counters plus responses per status code."""
+        with self._lock:
+            stats = dict(self.counters)
+            stats["status_counts"] = {str(status): count for status, count in sorted(self.status_counts.items())}
+        stats["rate_limit"] = self.rate_limiter.rate
+        return stats
+
+
+def per_instance_rate(total_qps=DICOMWEB_QPS, instances=DICOMWEB_INSTANCES, processes=WEB_CONCURRENCY):
+    """
+    This worker process's static share of the service-wide DICOMweb request budget.
+
+    The budget is split evenly between every process of every instance that
+    may run. The split is fixed at startup, so with fewer instances running
+    it under-uses the budget; dicomweb_rate_limiter adapts from there.
+    """
+    if total_qps <= 0:
+        return 0.0
+    return total_qps / (max(1, instances) * max(1, processes))
+
+
+def dicomweb_rate_limiter(total_qps=DICOMWEB_QPS, adaptive=DICOMWEB_ADAPTIVE, burst=DICOMWEB_BURST,
+                          max_share=DICOMWEB_ADAPTIVE_MAX_SHARE):
+    """
+    Rate limiter for this worker process's DICOMweb requests.
+
+    Starts at the static per-process share; if adaptive, it may rise to
+    `max_share` times the share (never past the whole budget) while requests
+    succeed, and backs off toward the share on 429s. The cap keeps every
+    process together within `max_share` times the budget even when none sees a 429.
+    """
+    rate = per_instance_rate(total_qps)
+    if adaptive and rate > 0:
+        return AdaptiveTokenBucket(rate, min(total_qps, rate * max_share), burst)
+    return TokenBucket(rate, burst)
@@ -0,0 +1,143 @@
+import os
+import re
+import time
+import datetime
+import threading
+from typing import Dict
+
+import requests
+from requests.adapters import HTTPAdapter
+from google.cloud import storage
+import google.auth
+import google.auth.transport
+import google.auth.transport.requests
+import google.oauth2.id_token
+
+# Refresh access tokens this many seconds before they expire
+TOKEN_REFRESH_MARGIN = int(os.environ.get("TOKEN_REFRESH_MARGIN", "300"))
+# Used when Google's cert response has no Cache-Control max-age
+CERT_CACHE_TTL = int(os.environ.get("CERT_CACHE_TTL", "3600"))
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "64"))
+
+MAX_AGE_PATTERN = re.compile(r'max-age=(\d+)')
+
+_lock = threading.Lock()
+_token_lock = threading.Lock()
+_storage_client = None
+_http_session = None
+_credentials = None
+_cert_request = None
+
+CACHE_STATS = {
+    "storage_client_created": 0,
+    "storage_client_reused": 0,
+    "http_session_created": 0,
+    "http_session_reused": 0,
+    "token_cache_hits": 0,
+    "token_refreshes": 0,
+    "cert_cache_hits": 0,
+    "cert_fetches": 0,
+}
+
+
+def _count(name):
+    with _lock:
+        CACHE_STATS[name] += 1
+
+
+def cache_stats():
+    """Return a copy of the cache hit/refresh counters."""
+    with _lock:
+        return dict(CACHE_STATS)
+
+
+def get_storage_client():
+    """Return the process-wide GCS client, creating it on first use."""
+    global _storage_client
+    with _lock:
+        if _storage_client is None:
+            _storage_client = storage.Client()
+            CACHE_STATS["storage_client_created"] += 1
+        else:
+            CACHE_STATS["storage_client_reused"] += 1
+        return _storage_client
+
+
+def get_http_session():
+    """Return the process-wide keep-alive HTTP session."""
+    global _http_session
+    with _lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+            CACHE_STATS["http_session_created"] += 1
+        else:
+            CACHE_STATS["http_session_reused"] += 1
+        return _http_session
+
+
+def get_oauth2_token():
+    """Retrieves an OAuth2 token for accessing the Google Cloud Healthcare API.
+
+    The token is cached and only refreshed when it is close to expiring.
+    """
+    global _credentials
+    with _token_lock:
+        if _credentials is None:
+            _credentials, project = google.auth.default()
+
+        # google-auth stores expiry as a naive UTC datetime
+        expiry = _credentials.expiry
+        if expiry is not None and expiry.tzinfo is None:
+            expiry = expiry.replace(tzinfo=datetime.timezone.utc)
+        expires_soon = expiry is None or (expiry.timestamp() - time.time()) < TOKEN_REFRESH_MARGIN
+        if _credentials.token and _credentials.valid and not expires_soon:
+            _count("token_cache_hits")
+            return _credentials.token
+
+        _credentials.refresh(google.auth.transport.requests.Request(session=get_http_session()))
+        _count("token_refreshes")
+        return _credentials.token
+
+
+class CachingRequest(google.auth.transport.Request):
+    """Auth transport that caches successful GET responses (Google's JWT certs) with a TTL."""
+
+    def __init__(self, request):
+        self._request = request
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+
+    def __call__(self, url, method="GET", body=None, headers=None, timeout=None, **kwargs):
+        if method != "GET":
+            return self._request(url, method=method, body=body, headers=headers, timeout=timeout, **kwargs)
+
+        with self._cache_lock:
+            entry = self._cache.get(url)
+            if entry and entry[0] > time.monotonic():
+                _count("cert_cache_hits")
+                return entry[1]
+
+        response = self._request(url, method=method, body=body, headers=headers, timeout=timeout, **kwargs)
+        _count("cert_fetches")
+
+        if response.status == 200:
+            match = MAX_AGE_PATTERN.search(response.headers.get("cache-control", ""))
+            ttl = int(match.group(1)) if match else CERT_CACHE_TTL
+            with self._cache_lock:
+                self._cache[url] = (time.monotonic() + ttl, response)
+        return response
+
+
+def verify_jwt(token: str) -> Dict:
+    """Verifies a JWT token and returns the claims, using cached signing certs."""
+    global _cert_request
+    if _cert_request is None:
+        session = get_http_session()
+        with _lock:
+            if _cert_request is None:
+                _cert_request = CachingRequest(google.auth.transport.requests.Request(session=session))
+    return google.oauth2.id_token.verify_oauth2_token(token, _cert_request)
@@ -0,0 +1,77 @@
+import os
+import tempfile
+import threading
+
+from google.api_core.exceptions import PreconditionFailed
+
+# Bucket names with this prefix are local directories
+LOCAL_BUCKET_PREFIX = "file://"
+
+# Serializes conditional writes, which compare a file's generation and then replace it
+_conditional_write_lock = threading.Lock()
+
+
+def file_generation(path):
+    """Generation of a local object, its modification time in ns, or 0 if it does not exist."""
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+class LocalBlob:
+    """Object in a LocalBucket, with the subset of the GCS blob API the downloader uses."""
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.root, name)
+        # Set by LocalBucket.get_blob, as GCS does
+        self.generation = None
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        """Write the object; with if_generation_match, only if it is still at that generation (0: absent)."""
+        if isinstance(data, str):
+            data = data.encode()
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file first so a crash never leaves a truncated object
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".upload-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            if if_generation_match is None:
+                os.replace(temp_path, self.path)
+                return
+            with _conditional_write_lock:
+                if file_generation(self.path) != if_generation_match:
+                    raise PreconditionFailed(f"{self.name} is not at generation {if_generation_match}")
+                os.replace(temp_path, self.path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+    def download_as_bytes(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+
+class LocalBucket:
+    """Directory used in place of a GCS bucket, with object names as relative paths."""
+
+    def __init__(self, root):
+        self.root = root
+        self.name = LOCAL_BUCKET_PREFIX + root
+
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+    def get_blob(self, name):
+        """The object if it exists, else None, as for a GCS bucket."""
+        blob = LocalBlob(self, name)
+        blob.generation = file_generation(blob.path)
+        return blob if blob.generation else None
@@ -1,36 +1,32 @@
-import logging
-import io
-import tempfile
 import os
-import sys
 import base64
-import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union
-from typing import Dict
 from fastapi import FastAPI
-from starlette.status import HTTP_204_NO_CONTENT
+from starlette.status import HTTP_204_NO_CONTENT, HTTP_429_TOO_MANY_REQUESTS, HTTP_503_SERVICE_UNAVAILABLE
 from fastapi.responses import JSONResponse
 from starlette.requests import Request
 from starlette.responses import Response
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.middleware.base import RequestResponseEndpoint
+from starlette.concurrency import run_in_threadpool
 
-# Dicom imports
-import requests
-import pydicom as dicom
-from requests.structures import CaseInsensitiveDict
-from requests_toolbelt import MultipartDecoder
-from google.cloud import storage
-import google.auth.transport.requests
-import google.oauth2.id_token
-
-# Configure standard Python logging (Cloud Run captures stdout/stderr automatically)
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler()]
+from app.gcp_clients import verify_jwt, cache_stats
+from app.metrics import start_summary_logger
+from app.retrieval import (
+    logger, retrieve_and_store_dicom, record_study_failure,
+    ADMISSION, DICOMWEB, METRICS, MAX_CONCURRENT_STUDIES, MAX_STUDY_ATTEMPTS, INLINE_DEID,
 )
-logger = logging.getLogger("dicom-processor")
+
+# All blocking network and parsing work for a study runs on this pool, keeping the event loop free
+STUDY_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_STUDIES, thread_name_prefix="study")
+
+
+def timed_verify_jwt(token):
+    with METRICS.timed("auth"):
+        return verify_jwt(token)
+
 
 app = FastAPI()
 
@@ -48,112 +44,61 @@ class SimpleLoggingMiddleware(BaseHTTPMiddleware):
 
 app.add_middleware(SimpleLoggingMiddleware)
 
+
+def collect_metrics(reset_window=False):
+    """Service metrics together with admission, DICOMweb and cache counters."""
+    metrics = {
+        **METRICS.snapshot(reset_window),
+        "admission": ADMISSION.stats(),
+        "dicomweb": DICOMWEB.stats(),
+        "caches": cache_stats(),
+    }
+    if INLINE_DEID:
+        from app.retrieval import get_id_cache_stats
+        metrics["id_cache"] = get_id_cache_stats()
+    return metrics
+
+
+@app.on_event("startup")
+async def start_metrics_summary():
+    # Started per worker, after gunicorn forks the preloaded app
+    start_summary_logger(collect_metrics)
+
+
 @app.get("/")
 async def read_root():
-    logger.info("INFO MSG")
-    logger.debug("DEBUG MSG")
-    logger.warning("WARNING MSG")
-    logger.error("ERROR MSG")
     return {"Hello": "World"}
 
 
+@app.get("/metrics")
+async def read_metrics():
+    """Study counts, throughput, per-phase latency, in-flight work and peak RSS."""
+    return collect_metrics()
+
+
 @app.get("/items/{item_id}")
 async def read_item(item_id: int, q: Union[str, None] = None):
     return {"item_id": item_id, "q": q}
 
 
-# Helper function to verify JWT
-def verify_jwt(token: str) -> Dict:
-    """Verifies a JWT token and returns the claims."""
-    auth_req = google.auth.transport.requests.Request()
-    return google.oauth2.id_token.verify_oauth2_token(token, auth_req)
-
-
-def get_oauth2_token():
-    """Retrieves an OAuth2 token for accessing the Google Cloud Healthcare API."""
-    creds, project = google.auth.default()
-    auth_req = google.auth.transport.requests.Request()
-    creds.refresh(auth_req)
-    return creds.token
-
-async def retrieve_and_store_dicom(url, bucket_name, bucket_path):
-    """Retrieves and stores all DICOM instances from a DICOMweb study."""
-    # Extract study ID from the URL
-    study_id_from_url = url.split('/')[-1]
-    
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    
-    headers = CaseInsensitiveDict()
-    headers['Accept'] = 'multipart/related; type="application/dicom"; transfer-syntax=*'
-    headers["Authorization"] = f"Bearer {get_oauth2_token()}"
-    
-    try:
-        response = requests.get(url, headers=headers)
-        
-        if response.status_code != 200:
-            logger.error(f"Failed to retrieve DICOM: Status {response.status_code}")
-            return False
-            
-        content_type = response.headers.get('Content-Type', '')
-        if 'multipart/related' not in content_type:
-            logger.error(f"Unsupported content type: {content_type}")
-            return False
-        
-        # Parse the multipart response
-        decoder = MultipartDecoder(response.content, content_type)
-        
-        # Process each part (each part is a separate DICOM instance)
-        instance_count = 0
-        success_count = 0
-        
-        for part in decoder.parts:
-            part_content_type = part.headers.get(b'Content-Type', b'').decode('utf-8')
-            
-            if 'application/dicom' not in part_content_type:
-                logger.warning(f"Skipping non-DICOM part with content type: {part_content_type}")
-                continue
-            
-            # Process this DICOM instance
-            try:
-                # Read the DICOM data
-                with io.BytesIO(part.content) as dicom_data:
-                    dcm = dicom.dcmread(dicom_data, force=True)
-                    
-                    # Extract metadata for logging (not using study_uid for path anymore)
-                    series_uid = str(dcm.get('SeriesInstanceUID', 'unknown_series'))
-                    
-                    # Get instance UID
-                    if 'SOPInstanceUID' in dcm:
-                        instance_uid = str(dcm['SOPInstanceUID'].value)
-                    else:
-                        # Generate a fallback UID
-                        import hashlib
-                        instance_hash = hashlib.md5(part.content[:4096]).hexdigest()
-                        instance_uid = f"unknown_uid_{instance_hash}"
-                        logger.warning(f"No SOPInstanceUID found in DICOM, using generated ID: {instance_uid}")
-                    
-                    # Use study ID from URL instead of study_uid from DICOM
-                    file_path = f"{bucket_path}/{study_id_from_url}/{series_uid}/{instance_uid}.dcm"
-                    
-                    # Upload to GCS
-                    blob = bucket.blob(file_path)
-                    blob.upload_from_string(part.content, content_type='application/dicom')
-                    
-                    success_count += 1
-            
-            except Exception as e:
-                logger.exception(f"Error processing DICOM instance: {e}")
-            
-            instance_count += 1
-        
-        return success_count > 0
-        
-    except Exception as e:
-        logger.exception(f"Error retrieving or processing DICOM study: {e}")
-        return False
-    
-    
+@app.get("/admission_stats")
+async def read_admission_stats():
+    """Current in-flight studies and bytes, memory budget and rejection counts."""
+    return ADMISSION.stats()
+
+
+@app.get("/dicomweb_stats")
+async def read_dicomweb_stats():
+    """DICOMweb requests per status code, retries and time spent throttled."""
+    return DICOMWEB.stats()
+
+
+@app.get("/cache_stats")
+async def read_cache_stats():
+    """Reuse counters for the cached storage client, HTTP session, token and JWT certs."""
+    return cache_stats()
+
+
 # Modify the Pub/Sub handler
 @app.post("/push_handlers/receive_messages")
 async def pubsub_push_handlers_receive(request: Request):
@@ -165,7 +110,7 @@ async def pubsub_push_handlers_receive(request: Request):
 
     try:
         token = bearer_token.split(" ")[1]
-        claim = verify_jwt(token)
+        claim = await run_in_threadpool(timed_verify_jwt, token)
         #logger.info(f"Processing request with JWT claim ID: {claim.get('sub', 'unknown')}")
 
         envelope = await request.json()
@@ -188,17 +133,41 @@ async def pubsub_push_handlers_receive(request: Request):
             bucket_name = os.environ.get("BUCKET_NAME", "")
             bucket_path = os.environ.get("BUCKET_PATH", "Downloads")               
             
-            # Retrieve and store the DICOM image
-            success = await retrieve_and_store_dicom(dicom_url, bucket_name, bucket_path)
+            # Refuse the study while over budget, Pub/Sub will redeliver it with backoff
+            rejected = ADMISSION.try_admit()
+            if rejected:
+                logger.info(f"Deferring {dicom_url}: over {rejected} budget")
+                return JSONResponse(
+                    status_code=HTTP_429_TOO_MANY_REQUESTS,
+                    content={"message": f"Instance over {rejected} budget, retry later"},
+                    headers={"Retry-After": "30"},
+                )
+            
+            # Retrieve and store the DICOM image without blocking the event loop
+            try:
+                loop = asyncio.get_running_loop()
+                success = await loop.run_in_executor(
+                    STUDY_EXECUTOR, retrieve_and_store_dicom, dicom_url, bucket_name, bucket_path
+                )
+            finally:
+                ADMISSION.release()
             
             if not success:
-                logger.warning(f"Failed to process DICOM from {dicom_url}")
+                attempts = await run_in_threadpool(record_study_failure, bucket_name, bucket_path, dicom_url)
+                if attempts >= MAX_STUDY_ATTEMPTS:
+                    logger.error(f"Giving up on {dicom_url} after {attempts} failed attempts")
+                    return Response(status_code=HTTP_204_NO_CONTENT)
+                
+                # A non-2xx response makes Pub/Sub redeliver the study instead of dropping it
+                logger.warning(f"Failed to process DICOM from {dicom_url} (attempt {attempts})")
+                return JSONResponse(
+                    status_code=HTTP_503_SERVICE_UNAVAILABLE, content={"message": "Failed to process study, retry later"}
+                )
             
         else:
+            # Redelivering a malformed message can't help, so acknowledge it
             logger.warning("Invalid Pub/Sub message format")
 
-        # Return a 204 to indicate a success, even if processing failed
-        # This is standard practice for Pub/Sub to prevent retries
         return Response(status_code=HTTP_204_NO_CONTENT)
     except (ValueError, IndexError) as e:
         logger.error(f"Invalid Authorization header format: {e}")
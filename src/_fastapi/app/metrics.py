@@ -0,0 +1,169 @@
+import os
+import sys
+import json
+import time
+import logging
+import resource
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# Seconds between structured metric summaries in the log (0 disables them)
+METRICS_LOG_INTERVAL = int(os.environ.get("METRICS_LOG_INTERVAL", "60"))
+# Recent samples kept per phase for percentiles
+LATENCY_SAMPLES = 1000
+
+# fetch: DICOMweb request until the response headers, or a whole single-instance response
+# transfer: reading a multipart study body, per part; split: separating each part from the body
+# header: reading a part's DICOM header to name its object
+PHASES = ("auth", "fetch", "transfer", "split", "header", "deid", "upload")
+
+# Summaries are written as one JSON object per line so Cloud Logging parses them as structured entries
+metrics_logger = logging.getLogger("dicom-metrics")
+metrics_logger.propagate = False
+if not metrics_logger.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    metrics_logger.addHandler(_handler)
+    metrics_logger.setLevel(logging.INFO)
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes."""
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class PhaseTimer:
+    """Count, total, max and recent samples of one phase's latency."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=LATENCY_SAMPLES)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+
+    def summary(self):
+        samples = sorted(self.samples)
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count * 1000, 2) if self.count else 0.0,
+            "p50_ms": round(percentile(samples, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(samples, 0.95) * 1000, 2),
+            "max_ms": round(self.max * 1000, 2),
+        }
+
+
+class ServiceMetrics:
+    """
+    Process-wide counters for the download service.
+
+    Tracks studies started, completed, skipped and failed, instances and
+    bytes stored, and per-phase latency. Rates are reported both over the
+    process lifetime and since the previous summary.
+    """
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.counters = {
+            "studies_started": 0,
+            "studies_completed": 0,
+            "studies_skipped": 0,
+            "studies_failed": 0,
+            "instances_stored": 0,
+            "bytes_stored": 0,
+            "instances_deidentified": 0,
+            "deid_failures": 0,
+        }
+        self.phases = {phase: PhaseTimer() for phase in PHASES}
+        self._window = (self.started_at, 0, 0)
+        self._lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def record_stored(self, instances, stored_bytes):
+        with self._lock:
+            self.counters["instances_stored"] += instances
+            self.counters["bytes_stored"] += stored_bytes
+
+    def record_phase(self, phase, seconds):
+        with self._lock:
+            self.phases[phase].add(seconds)
+
+    @contextmanager
+    def timed(self, phase):
+        """Time the enclosed block as one sample of `phase`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_phase(phase, time.perf_counter() - start)
+
+    def snapshot(self, reset_window=False):
+        """
+        Current counters, rates and phase latencies.
+
+        Args:
+            reset_window (bool): Start a new window for the "recent" rates
+
+        Returns:
+            dict: JSON-serializable metrics
+        """
+        now = time.monotonic()
+        with self._lock:
+            counters = dict(self.counters)
+            phases = {phase: timer.summary() for phase, timer in self.phases.items()}
+            window_start, window_instances, window_bytes = self._window
+            if reset_window:
+                self._window = (now, counters["instances_stored"], counters["bytes_stored"])
+
+        uptime = max(now - self.started_at, 1e-9)
+        window = max(now - window_start, 1e-9)
+        return {
+            **counters,
+            "studies_in_progress": counters["studies_started"] - counters["studies_completed"] - counters["studies_failed"],
+            "uptime_seconds": round(uptime, 1),
+            "instances_per_second": round(counters["instances_stored"] / uptime, 3),
+            "bytes_per_second": round(counters["bytes_stored"] / uptime, 1),
+            "recent_instances_per_second": round((counters["instances_stored"] - window_instances) / window, 3),
+            "recent_bytes_per_second": round((counters["bytes_stored"] - window_bytes) / window, 1),
+            "phases": phases,
+            "peak_rss_bytes": peak_rss(),
+        }
+
+
+def start_summary_logger(collect, interval=METRICS_LOG_INTERVAL):
+    """
+    Log `collect(reset_window=True)` as a JSON line every `interval` seconds on a daemon thread.
+
+    Returns:
+        threading.Thread or None: The logging thread, or None if disabled
+    """
+    if interval <= 0:
+        return None
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                metrics_logger.info(json.dumps({"severity": "INFO", "message": "dicom metrics", **collect(reset_window=True)}))
+            except Exception as e:
+                metrics_logger.info(json.dumps({"severity": "WARNING", "message": f"Failed to collect metrics: {e}"}))
+
+    thread = threading.Thread(target=run, name="metrics-summary", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,96 @@
+import re
+from requests.structures import CaseInsensitiveDict
+
+BOUNDARY_PATTERN = re.compile(r'boundary=(?:"([^"]+)"|([^;,\s]+))', re.IGNORECASE)
+
+
+def get_boundary(content_type):
+    """Extract the multipart boundary from a Content-Type header value."""
+    match = BOUNDARY_PATTERN.search(content_type)
+    if not match:
+        raise ValueError(f"No boundary found in content type: {content_type}")
+    return (match.group(1) or match.group(2)).encode('utf-8')
+
+
+def parse_part_headers(raw_headers):
+    """Parse the header block of a single multipart part."""
+    headers = CaseInsensitiveDict()
+    for line in raw_headers.split(b'\r\n'):
+        if b':' in line:
+            name, value = line.split(b':', 1)
+            headers[name.strip().decode('utf-8')] = value.strip().decode('utf-8')
+    return headers
+
+
+def iter_multipart_parts(chunks, content_type):
+    """
+    Incrementally parse a multipart/related body.
+
+    Parts are yielded as soon as their closing boundary arrives, so only the
+    part currently being received is held in memory, never the whole study.
+
+    Args:
+        chunks: Iterable of bytes, e.g. response.iter_content(chunk_size)
+        content_type (str): Content-Type header of the response
+
+    Yields:
+        tuple: (headers, content) where headers is a CaseInsensitiveDict
+    """
+    boundary = get_boundary(content_type)
+    delimiter = b'\r\n--' + boundary
+
+    buffer = bytearray(b'\r\n')  # lets the first boundary match the same delimiter
+    search_from = 0
+    in_part = False
+    finished = False
+
+    for chunk in chunks:
+        if finished:
+            continue  # drain the epilogue
+        buffer += chunk
+
+        while True:
+            index = buffer.find(delimiter, search_from)
+            if index < 0:
+                # Nothing complete yet, only rescan the tail that could hold a split delimiter
+                search_from = max(0, len(buffer) - len(delimiter) + 1)
+                break
+
+            # Need the two bytes after the delimiter to tell '--' (end) from CRLF
+            after = index + len(delimiter)
+            if len(buffer) < after + 2:
+                search_from = index
+                break
+
+            if in_part:
+                raw_part = bytes(buffer[:index])
+                del buffer[:index]
+                index, after, in_part = 0, len(delimiter), False
+
+                if raw_part.startswith(b'\r\n'):
+                    headers, content = CaseInsensitiveDict(), raw_part[2:]
+                else:
+                    header_end = raw_part.find(b'\r\n\r\n')
+                    if header_end < 0:
+                        headers, content = CaseInsensitiveDict(), raw_part
+                    else:
+                        headers = parse_part_headers(raw_part[:header_end])
+                        content = raw_part[header_end + 4:]
+                yield headers, content
+
+            if buffer[after:after + 2] == b'--':
+                finished = True
+                buffer.clear()
+                break
+
+            # Skip the rest of the boundary line (transport padding + CRLF)
+            line_end = buffer.find(b'\r\n', after)
+            if line_end < 0:
+                search_from = index
+                break
+            del buffer[:line_end + 2]
+            search_from = 0
+            in_part = True
+
+    if not finished:
+        raise ValueError("Multipart response ended before the closing boundary")
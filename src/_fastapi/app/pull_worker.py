@@ -0,0 +1,175 @@
+"""
+Streaming-pull worker for the DICOM downloader.
+
+An alternative to the push endpoint in app.main: the worker pulls study URLs
+from a Pub/Sub subscription with explicit flow control, and only acks a
+message once its study has been stored.
+
+    python -m app.pull_worker --subscription projects/<project>/subscriptions/<name>
+
+Set PUBSUB_EMULATOR_HOST to run against the Pub/Sub emulator, or use
+--urls-file to feed the same handler from an in-memory queue.
+"""
+import os
+import queue
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app.retrieval import retrieve_and_store_dicom, record_study_failure, logger, MAX_STUDY_ATTEMPTS
+
+# Studies handled at once, and the upper bound on message bytes held by the client
+MAX_OUTSTANDING_MESSAGES = int(os.environ.get("MAX_OUTSTANDING_MESSAGES", os.environ.get("MAX_CONCURRENT_STUDIES", "8")))
+MAX_OUTSTANDING_BYTES = int(os.environ.get("MAX_OUTSTANDING_BYTES", str(10 * 1024 * 1024)))
+# The client keeps extending a message's ack deadline for up to this many seconds
+MAX_LEASE_DURATION = int(os.environ.get("MAX_LEASE_DURATION", "7200"))
+# Delivery attempts per message in the in-memory queue
+MAX_ATTEMPTS = int(os.environ.get("MAX_ATTEMPTS", "5"))
+
+
+def handle_message(message, bucket_name, bucket_path):
+    """
+    Store the study named by a message, then ack it; nack on failure so it is redelivered.
+
+    A study that has failed MAX_STUDY_ATTEMPTS times is acked without being
+    stored, so the ack alone does not say whether the study succeeded.
+
+    Returns:
+        bool: True if the study is stored
+    """
+    dicom_url = message.data.decode("utf-8")
+
+    if not dicom_url:
+        logger.error("No DICOM URL found in payload")
+        message.ack()  # redelivering an empty message can't help
+        return False
+
+    try:
+        success = retrieve_and_store_dicom(dicom_url, bucket_name, bucket_path)
+    except Exception as e:
+        logger.exception(f"Error processing DICOM from {dicom_url}: {e}")
+        success = False
+
+    if success:
+        message.ack()
+        return True
+
+    attempts = record_study_failure(bucket_name, bucket_path, dicom_url)
+    if attempts >= MAX_STUDY_ATTEMPTS:
+        logger.error(f"Giving up on {dicom_url} after {attempts} failed attempts")
+        message.ack()
+    else:
+        logger.warning(f"Failed to process DICOM from {dicom_url} (attempt {attempts}), nacking for redelivery")
+        message.nack()
+    return False
+
+
+def run_subscriber(subscription, bucket_name, bucket_path):
+    """Pull from a Pub/Sub subscription until interrupted."""
+    from google.cloud import pubsub_v1
+    from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
+
+    subscriber = pubsub_v1.SubscriberClient()
+    if "/" not in subscription:
+        subscription = subscriber.subscription_path(os.environ["PROJECT_ID"], subscription)
+
+    flow_control = pubsub_v1.types.FlowControl(
+        max_messages=MAX_OUTSTANDING_MESSAGES,
+        max_bytes=MAX_OUTSTANDING_BYTES,
+        max_lease_duration=MAX_LEASE_DURATION,
+    )
+    # One callback thread per outstanding message, since each callback blocks for a whole study
+    scheduler = ThreadScheduler(
+        executor=ThreadPoolExecutor(max_workers=MAX_OUTSTANDING_MESSAGES, thread_name_prefix="pull")
+    )
+
+    future = subscriber.subscribe(
+        subscription,
+        callback=lambda message: handle_message(message, bucket_name, bucket_path),
+        flow_control=flow_control,
+        scheduler=scheduler,
+    )
+    logger.info(f"Pulling from {subscription} with up to {MAX_OUTSTANDING_MESSAGES} studies in flight")
+
+    with subscriber:
+        try:
+            future.result()
+        except KeyboardInterrupt:
+            future.cancel()
+            future.result()
+
+
+class InMemoryMessage:
+    """Minimal stand-in for a Pub/Sub message, backed by a local queue."""
+
+    def __init__(self, work_queue, data, attempt=1):
+        self.work_queue = work_queue
+        self.data = data
+        self.attempt = attempt
+        # Set once the message will not be delivered again
+        self.settled = False
+
+    def ack(self):
+        self.settled = True
+
+    def nack(self):
+        if self.attempt < MAX_ATTEMPTS:
+            self.work_queue.put(InMemoryMessage(self.work_queue, self.data, self.attempt + 1))
+        else:
+            self.settled = True
+
+
+def run_in_memory(urls, bucket_name, bucket_path, workers=MAX_OUTSTANDING_MESSAGES):
+    """
+    Process study URLs from an in-memory queue with the same handler as the subscriber.
+
+    Returns:
+        list: (url, success) for every URL, after retries; success comes from
+        the handler, not the ack, since studies that are given up on are acked too
+    """
+    work_queue = queue.Queue()
+    results = []
+    for url in urls:
+        work_queue.put(InMemoryMessage(work_queue, url.encode("utf-8")))
+
+    def worker():
+        while True:
+            try:
+                message = work_queue.get(timeout=1)
+            except queue.Empty:
+                if len(results) >= len(urls):
+                    return
+                continue
+            success = handle_message(message, bucket_name, bucket_path)
+            if message.settled:
+                results.append((message.data.decode("utf-8"), success))
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Streaming-pull DICOM download worker')
+    parser.add_argument('--subscription', type=str, default=os.environ.get("SUBSCRIPTION", ""),
+                        help='Subscription name or full path')
+    parser.add_argument('--urls-file', type=str, help='Process URLs from this file (one per line) instead of Pub/Sub')
+    args = parser.parse_args()
+
+    bucket_name = os.environ.get("BUCKET_NAME", "")
+    bucket_path = os.environ.get("BUCKET_PATH", "Downloads")
+
+    if args.urls_file:
+        with open(args.urls_file) as f:
+            urls = [line.strip() for line in f if line.strip()]
+        results = run_in_memory(urls, bucket_name, bucket_path)
+        failed = [url for url, success in results if not success]
+        logger.info(f"Processed {len(results)} studies, {len(failed)} failed")
+    elif args.subscription:
+        run_subscriber(args.subscription, bucket_name, bucket_path)
+    else:
+        parser.error("--subscription or --urls-file is required")
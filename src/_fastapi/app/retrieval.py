@@ -0,0 +1,530 @@
+"""
+Study retrieval for the DICOM downloader.
+
+Fetches a study from DICOMweb and stores its instances, with the completion
+and failure markers, admission accounting and metrics shared by every entry
+point: the push endpoint in app.main, the pull worker, and the local
+`main.py --download-local` mode. Nothing here depends on FastAPI.
+"""
+import logging
+import os
+import base64
+import json
+import threading
+import time
+import random
+import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from google.api_core.exceptions import PreconditionFailed
+
+from app.multipart_stream import iter_multipart_parts
+from app.dicom_header import read_instance_uids
+from app.admission import AdmissionController, container_memory_limit
+from app.gcp_clients import get_storage_client, get_http_session, get_oauth2_token
+from app.dicomweb import DicomWebClient, dicomweb_rate_limiter
+from app.local_storage import LocalBucket, LOCAL_BUCKET_PREFIX
+from app.metrics import ServiceMetrics
+
+# Configure standard Python logging (Cloud Run captures stdout/stderr automatically)
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler()]
+)
+logger = logging.getLogger("dicom-processor")
+
+# Size of the reads from the DICOMweb response stream
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Studies processed at once by this worker process
+MAX_CONCURRENT_STUDIES = int(os.environ.get("MAX_CONCURRENT_STUDIES", "8"))
+
+# Part uploads are shared across all studies in this process, and each study
+# may only have a few parts queued so memory stays bounded.
+MAX_CONCURRENT_UPLOADS = int(os.environ.get("MAX_CONCURRENT_UPLOADS", "32"))
+MAX_UPLOADS_PER_STUDY = int(os.environ.get("MAX_UPLOADS_PER_STUDY", "8"))
+UPLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_UPLOADS, thread_name_prefix="upload")
+
+# Admission control: beyond these budgets new studies get a retryable 429 so
+# Pub/Sub backs off and redelivers instead of the container running out of memory
+MAX_INFLIGHT_BYTES = int(os.environ.get("MAX_INFLIGHT_MB", "1024")) * 1024 * 1024
+MEMORY_LIMIT = int(os.environ["MEMORY_LIMIT_MB"]) * 1024 * 1024 if "MEMORY_LIMIT_MB" in os.environ else container_memory_limit()
+MEMORY_HIGH_WATERMARK = float(os.environ.get("MEMORY_HIGH_WATERMARK", "0.8"))
+ADMISSION = AdmissionController(MAX_CONCURRENT_STUDIES, MAX_INFLIGHT_BYTES, MEMORY_LIMIT, MEMORY_HIGH_WATERMARK)
+
+# Optionally list a study's instances and fetch them one by one in parallel,
+# instead of streaming the whole study as a single multipart response
+RETRIEVE_BY_INSTANCE = os.environ.get("RETRIEVE_BY_INSTANCE", "false").lower() in ("1", "true", "yes")
+MAX_CONCURRENT_FETCHES = int(os.environ.get("MAX_CONCURRENT_FETCHES", "32"))
+MAX_FETCHES_PER_STUDY = int(os.environ.get("MAX_FETCHES_PER_STUDY", "4"))
+FETCH_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_FETCHES, thread_name_prefix="fetch")
+# Instances requested per QIDO query when listing a study
+QIDO_PAGE_SIZE = int(os.environ.get("QIDO_PAGE_SIZE", "1000"))
+
+# Studies with a completion marker are skipped, so redeliveries and reruns only cost the missing work
+COMPLETION_MARKER = "_COMPLETE.json"
+# Failed attempts are counted in a failure marker; after MAX_STUDY_ATTEMPTS the
+# message is acked so a study that can never succeed stops being redelivered
+FAILURE_MARKER = "_FAILED.json"
+MAX_STUDY_ATTEMPTS = int(os.environ.get("MAX_STUDY_ATTEMPTS", "5"))
+# Conditional writes of the failure marker tried before giving up on counting an attempt
+FAILURE_MARKER_RETRIES = 5
+SKIP_COMPLETED_STUDIES = os.environ.get("SKIP_COMPLETED_STUDIES", "true").lower() in ("1", "true", "yes")
+_completed_studies = set()
+_completed_lock = threading.Lock()
+
+# Optionally de-identify each part at ingest and write it under ANON_BUCKET_PATH,
+# with the same layout as `main.py --anon`. The de-identification modules are
+# copied into app/deid by build_and_push_image, and the key comes from Secret Manager.
+# Run from the repository (--download-local), they are imported from src first, since
+# app/deid may be half-written by an image build running at the same time.
+INLINE_DEID = os.environ.get("INLINE_DEID", "false").lower() in ("1", "true", "yes")
+STORE_RAW = os.environ.get("STORE_RAW", "true").lower() in ("1", "true", "yes") or not INLINE_DEID
+ANON_BUCKET_PATH = os.environ.get("ANON_BUCKET_PATH", "")
+if INLINE_DEID:
+    try:
+        from src.deid_core import deidentify_bytes
+        from src.id_crypto import get_id_cache_stats
+    except ImportError:
+        from app.deid.deid_core import deidentify_bytes
+        from app.deid.id_crypto import get_id_cache_stats
+    DEID_KEY = base64.b64decode(os.environ["DICOM_ENCRYPTION_KEY"])
+
+# Study counts, throughput and per-phase latency, served on /metrics and logged periodically
+METRICS = ServiceMetrics()
+
+
+def timed_oauth2_token():
+    with METRICS.timed("auth"):
+        return get_oauth2_token()
+
+# One DICOMweb client per process, throttled to this process's share of the API quota
+DICOMWEB = DicomWebClient(get_http_session, timed_oauth2_token, dicomweb_rate_limiter())
+STUDY_ACCEPT = 'multipart/related; type="application/dicom"; transfer-syntax=*'
+INSTANCE_ACCEPT = 'application/dicom; transfer-syntax=*'
+QIDO_ACCEPT = 'application/dicom+json'
+
+# DICOM JSON attribute tags
+SERIES_UID_TAG = '0020000E'
+INSTANCE_UID_TAG = '00080018'
+
+
+def open_bucket(bucket_name):
+    """
+    Open the storage backend studies are written to.
+    
+    A name starting with file:// is a local directory with the same object
+    layout as the bucket; anything else is a GCS bucket.
+    """
+    if bucket_name.startswith(LOCAL_BUCKET_PREFIX):
+        return LocalBucket(bucket_name[len(LOCAL_BUCKET_PREFIX):])
+    return get_storage_client().bucket(bucket_name)
+
+
+def retrieve_and_store_dicom(url, bucket_name, bucket_path):
+    """Retrieves and stores all DICOM instances from a DICOMweb study.
+    
+    Blocking; the service runs it on its study executor from async code.
+    """
+    METRICS.count("studies_started")
+    success = False
+    try:
+        success = retrieve_study(url, bucket_name, bucket_path)
+        return success
+    finally:
+        METRICS.count("studies_completed" if success else "studies_failed")
+
+
+def retrieve_study(url, bucket_name, bucket_path):
+    """Retrieve and store one study, returning True if any instance was stored."""
+    # Extract study ID from the URL
+    study_id_from_url = url.split('/')[-1]
+    
+    bucket = open_bucket(bucket_name)
+    
+    try:
+        if SKIP_COMPLETED_STUDIES and study_is_complete(bucket, bucket_path, study_id_from_url):
+            logger.info(f"Skipping study {study_id_from_url}, already complete")
+            METRICS.count("studies_skipped")
+            return True
+        
+        start_time = time.monotonic()
+        if RETRIEVE_BY_INSTANCE:
+            success_count, instance_count, failures, stored_bytes = retrieve_study_by_instance(url, bucket, bucket_path, study_id_from_url)
+            METRICS.record_stored(success_count, stored_bytes)
+            mark_study_complete(bucket, bucket_path, study_id_from_url, success_count, instance_count, failures, stored_bytes, start_time)
+            return success_count > 0
+        
+        # Stream the response so only the parts being uploaded are held in memory
+        with METRICS.timed("fetch"):
+            response = DICOMWEB.get(url, STUDY_ACCEPT, stream=True)
+        
+        if response.status_code != 200:
+            logger.error(f"Failed to retrieve DICOM: Status {response.status_code}")
+            response.close()
+            return False
+            
+        content_type = response.headers.get('Content-Type', '')
+        if 'multipart/related' not in content_type:
+            logger.error(f"Unsupported content type: {content_type}")
+            response.close()
+            return False
+        
+        # Process each part (each part is a separate DICOM instance) as it arrives
+        with response:
+            parts = iter_timed_parts(response, content_type)
+            success_count, instance_count, failures, stored_bytes = store_dicom_parts(parts, bucket, bucket_path, study_id_from_url)
+        
+        METRICS.record_stored(success_count, stored_bytes)
+        mark_study_complete(bucket, bucket_path, study_id_from_url, success_count, instance_count, failures, stored_bytes, start_time)
+        return success_count > 0
+        
+    except Exception as e:
+        logger.exception(f"Error retrieving or processing DICOM study: {e}")
+        return False
+
+
+def iter_timed_parts(response, content_type):
+    """
+    Yield the parts of a streamed multipart response, timing each one.
+    
+    Time spent waiting on the response body is recorded as "transfer" and
+    the rest of the time splitting out a part as "split".
+    """
+    chunks = response.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+    transfer_seconds = 0.0
+    
+    def timed_chunks():
+        nonlocal transfer_seconds
+        while True:
+            start = time.perf_counter()
+            chunk = next(chunks, None)
+            transfer_seconds += time.perf_counter() - start
+            if chunk is None:
+                return
+            yield chunk
+    
+    parts = iter_multipart_parts(timed_chunks(), content_type)
+    while True:
+        transfer_seconds = 0.0
+        start = time.perf_counter()
+        part = next(parts, None)
+        elapsed = time.perf_counter() - start
+        if part is None:
+            return
+        METRICS.record_phase("transfer", transfer_seconds)
+        METRICS.record_phase("split", elapsed - transfer_seconds)
+        yield part
+
+
+def study_is_complete(bucket, bucket_path, study_id):
+    """Check for the study's completion marker, remembering studies already seen complete."""
+    marker_path = f"{bucket_path}/{study_id}/{COMPLETION_MARKER}"
+    with _completed_lock:
+        if marker_path in _completed_studies:
+            return True
+    
+    if not bucket.blob(marker_path).exists():
+        return False
+    
+    with _completed_lock:
+        _completed_studies.add(marker_path)
+    return True
+
+
+def mark_study_complete(bucket, bucket_path, study_id, success_count, instance_count, failures, stored_bytes, start_time):
+    """
+    Write the study's completion marker if every instance was stored.
+    
+    Partially stored studies get no marker, so a redelivery or rerun fetches them again.
+    """
+    if failures or instance_count == 0 or success_count < instance_count:
+        return
+    
+    marker = {
+        "study_id": study_id,
+        "instance_count": instance_count,
+        "bytes": stored_bytes,
+        "duration_seconds": round(time.monotonic() - start_time, 3),
+        "completed_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+    marker_path = f"{bucket_path}/{study_id}/{COMPLETION_MARKER}"
+    try:
+        bucket.blob(marker_path).upload_from_string(json.dumps(marker), content_type='application/json')
+    except Exception as e:
+        # The study itself is stored; without a marker it is just fetched again next time
+        logger.warning(f"Failed to write completion marker {marker_path}: {e}")
+        return
+    with _completed_lock:
+        _completed_studies.add(marker_path)
+
+
+def record_study_failure(bucket_name, bucket_path, url):
+    """
+    Count a failed attempt at a study in its failure marker.
+    
+    The marker is rewritten only if it is still at the generation that was
+    read, so concurrent redeliveries of the same study can't lose an attempt.
+    On a conflict the count is read again and the write retried.
+    
+    Returns:
+        int: Failed attempts so far, including this one
+    """
+    study_id = url.split('/')[-1]
+    bucket = open_bucket(bucket_name)
+    marker_path = f"{bucket_path}/{study_id}/{FAILURE_MARKER}"
+    
+    attempts = 1
+    for retry in range(FAILURE_MARKER_RETRIES):
+        try:
+            existing = bucket.get_blob(marker_path)
+            generation = existing.generation if existing is not None else 0  # 0: must not exist yet
+            attempts = json.loads(existing.download_as_bytes()).get("attempts", 0) + 1 if existing is not None else 1
+        except Exception as e:
+            logger.warning(f"Failed to read failure marker for study {study_id}: {e}")
+            return attempts
+        
+        marker = {
+            "study_id": study_id,
+            "url": url,
+            "attempts": attempts,
+            "last_failure_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        }
+        try:
+            bucket.blob(marker_path).upload_from_string(json.dumps(marker), content_type='application/json',
+                                                        if_generation_match=generation)
+            return attempts
+        except PreconditionFailed:
+            # Another delivery updated the marker since it was read
+            time.sleep(random.uniform(0, 0.1 * 2 ** retry))
+        except Exception as e:
+            logger.warning(f"Failed to write failure marker for study {study_id}: {e}")
+            return attempts
+    
+    logger.warning(f"Failure marker for study {study_id} kept changing, attempt {attempts} may not be counted")
+    return attempts
+
+
+def list_study_instances(url):
+    """
+    List the series and instance UIDs of a study with QIDO-RS queries.
+    
+    Servers cap the results of one query, and a truncated listing would get
+    the study marked complete without its missing instances. Results are
+    paged with limit and offset until a page comes back short without the
+    Warning a server adds when it truncates results (PS3.18).
+    
+    Returns:
+        list: (series_uid, instance_uid) for every instance in the study
+    """
+    records = []
+    while True:
+        response = DICOMWEB.get(f"{url}/instances?limit={QIDO_PAGE_SIZE}&offset={len(records)}", QIDO_ACCEPT, stream=False)
+        with response:
+            if response.status_code == 204:
+                break
+            response.raise_for_status()
+            page = response.json()
+            truncated = "additional results" in response.headers.get("Warning", "")
+        records.extend(page)
+        if not page or (len(page) < QIDO_PAGE_SIZE and not truncated):
+            break
+    
+    instances = []
+    for record in records:
+        try:
+            series_uid = record[SERIES_UID_TAG]['Value'][0]
+            instance_uid = record[INSTANCE_UID_TAG]['Value'][0]
+        except (KeyError, IndexError):
+            logger.warning(f"Skipping QIDO record without series/instance UID in {url}")
+            continue
+        instances.append((series_uid, instance_uid))
+    return instances
+
+
+def fetch_and_upload_instance(url, bucket, file_path):
+    """Retrieve a single DICOM instance and upload it to the bucket, returning its size in bytes."""
+    with METRICS.timed("fetch"):
+        response = DICOMWEB.get(url, INSTANCE_ACCEPT, stream=False)
+        with response:
+            if response.status_code != 200:
+                raise RuntimeError(f"Status {response.status_code} retrieving {url}")
+            part_content = response.content
+    
+    ADMISSION.add_bytes(len(part_content))
+    try:
+        store_part(bucket, file_path, part_content)
+    finally:
+        ADMISSION.remove_bytes(len(part_content))
+    return len(part_content)
+
+
+def retrieve_study_by_instance(url, bucket, bucket_path, study_id):
+    """
+    Retrieve a study instance by instance, with several fetches in flight.
+    
+    The study is listed first, then each instance is fetched and uploaded on
+    the shared FETCH_EXECUTOR, with at most MAX_FETCHES_PER_STUDY of this
+    study's instances in flight. Objects land under the same paths as the
+    multipart retrieval.
+    
+    Returns:
+        tuple: (success_count, instance_count, failures, stored_bytes), as for store_dicom_parts
+    """
+    instances = list_study_instances(url)
+    if not instances:
+        logger.warning(f"No instances found in DICOM study {url}")
+    
+    success_count = 0
+    stored_bytes = 0
+    failures = []
+    fetches = {}
+    in_flight = threading.BoundedSemaphore(MAX_FETCHES_PER_STUDY)
+    
+    try:
+        for series_uid, instance_uid in instances:
+            instance_url = f"{url}/series/{series_uid}/instances/{instance_uid}"
+            file_path = f"{bucket_path}/{study_id}/{series_uid}/{instance_uid}.dcm"
+            
+            in_flight.acquire()
+            future = FETCH_EXECUTOR.submit(fetch_and_upload_instance, instance_url, bucket, file_path)
+            future.add_done_callback(lambda _: in_flight.release())
+            fetches[future] = file_path
+    finally:
+        for future in as_completed(fetches):
+            try:
+                stored_bytes += future.result()
+                success_count += 1
+            except Exception as e:
+                logger.error(f"Failed to store {fetches[future]}: {e}")
+                failures.append((fetches[future], str(e)))
+    
+    if failures:
+        logger.warning(f"{len(failures)} of {len(instances)} DICOM instances failed for study {study_id}")
+    
+    return success_count, len(instances), failures, stored_bytes
+
+
+def dicom_object_path(part_content, bucket_path, study_id):
+    """Build the bucket path of a DICOM part from its series and instance UIDs."""
+    # Only the header is parsed, the pixel data is never decoded or copied
+    series_uid, instance_uid = read_instance_uids(part_content)
+    
+    # Extract metadata for logging (not using study_uid for path anymore)
+    series_uid = str(series_uid) if series_uid is not None else 'unknown_series'
+    
+    # Get instance UID
+    if instance_uid is not None:
+        instance_uid = str(instance_uid)
+    else:
+        # Generate a fallback UID
+        import hashlib
+        instance_hash = hashlib.md5(part_content[:4096]).hexdigest()
+        instance_uid = f"unknown_uid_{instance_hash}"
+        logger.warning(f"No SOPInstanceUID found in DICOM, using generated ID: {instance_uid}")
+    
+    # Use study ID from URL instead of study_uid from DICOM
+    return f"{bucket_path}/{study_id}/{series_uid}/{instance_uid}.dcm"
+
+
+def store_part(bucket, file_path, part_content):
+    """Store one DICOM part raw, de-identified, or both, depending on the ingest mode."""
+    if STORE_RAW:
+        upload_part(bucket, file_path, part_content)
+    if INLINE_DEID:
+        deidentify_and_upload(bucket, part_content)
+
+
+def deidentify_and_upload(bucket, part_content):
+    """
+    De-identify a part and upload it under ANON_BUCKET_PATH.
+    
+    Raises if the part can't be de-identified and no raw copy is kept, so the
+    part counts as failed and the study is not marked complete.
+    """
+    try:
+        with METRICS.timed("deid"):
+            relative_path, anon_content = deidentify_bytes(part_content, DEID_KEY)
+    except Exception as e:
+        METRICS.count("deid_failures")
+        if not STORE_RAW:
+            logger.error(f"Could not de-identify DICOM part and STORE_RAW is off: {e}")
+            raise
+        # The raw copy is kept; these files fail the batch step too, so retrying would not help
+        logger.warning(f"Could not de-identify DICOM part, keeping only the raw copy: {e}")
+        return
+    
+    upload_part(bucket, f"{ANON_BUCKET_PATH}/{relative_path}", anon_content)
+    METRICS.count("instances_deidentified")
+
+
+def upload_part(bucket, file_path, part_content):
+    """Upload a single DICOM part to the bucket."""
+    with METRICS.timed("upload"):
+        blob = bucket.blob(file_path)
+        blob.upload_from_string(part_content, content_type='application/dicom')
+
+
+def store_dicom_parts(parts, bucket, bucket_path, study_id):
+    """
+    Upload each DICOM part of a study as it is parsed.
+    
+    Uploads run concurrently on the shared UPLOAD_EXECUTOR, with at most
+    MAX_UPLOADS_PER_STUDY parts of this study waiting or uploading at once.
+    A failed part is recorded and does not stop the rest of the study.
+    
+    Returns:
+        tuple: (success_count, instance_count, failures, stored_bytes) where
+        failures is a list of (file_path, error) for parts that could not be stored
+    """
+    instance_count = 0
+    success_count = 0
+    stored_bytes = 0
+    failures = []
+    uploads = {}
+    upload_sizes = {}
+    in_flight = threading.BoundedSemaphore(MAX_UPLOADS_PER_STUDY)
+    
+    try:
+        for part_headers, part_content in parts:
+            part_content_type = part_headers.get('Content-Type', '')
+            
+            if 'application/dicom' not in part_content_type:
+                logger.warning(f"Skipping non-DICOM part with content type: {part_content_type}")
+                continue
+            
+            instance_count += 1
+            
+            # Process this DICOM instance
+            try:
+                with METRICS.timed("header"):
+                    file_path = dicom_object_path(part_content, bucket_path, study_id)
+            except Exception as e:
+                logger.exception(f"Error processing DICOM instance: {e}")
+                failures.append((f"part {instance_count}", str(e)))
+                continue
+            
+            # Wait for a free upload slot so unsent parts can't pile up in memory
+            in_flight.acquire()
+            part_size = len(part_content)
+            ADMISSION.add_bytes(part_size)
+            future = UPLOAD_EXECUTOR.submit(store_part, bucket, file_path, part_content)
+            future.add_done_callback(lambda _, size=part_size: (ADMISSION.remove_bytes(size), in_flight.release()))
+            uploads[future] = file_path
+            upload_sizes[future] = part_size
+    finally:
+        # Always wait for started uploads, even if the stream broke mid-study
+        for future in as_completed(uploads):
+            try:
+                future.result()
+                success_count += 1
+                stored_bytes += upload_sizes[future]
+            except Exception as e:
+                logger.error(f"Failed to upload {uploads[future]}: {e}")
+                failures.append((uploads[future], str(e)))
+    
+    if failures:
+        logger.warning(f"{len(failures)} of {instance_count} DICOM instances failed for study {study_id}")
+    
+    return success_count, instance_count, failures, stored_bytes
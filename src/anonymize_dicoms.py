@@ -2,7 +2,6 @@ import pydicom
 import os
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
-import hashlib
 from src.encrypt_keys import *
 from google.cloud import storage
 from io import BytesIO
@@ -18,137 +17,15 @@ import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from config import CONFIG
 
-# Define sets at module level for better performance
-NAMES_TO_REMOVE = {
-    'SOP Instance UID', 'Study Time', 'Series Time', 'Content Time',
-    'Study Instance UID', 'Series Instance UID', 'Private Creator',
-    'Media Storage SOP Instance UID', 'Implementation Class UID',
-    "Patient's Name", "Referring Physician's Name", "Acquisition DateTime",
-    "Institution Name", "Station Name", "Physician(s) of Record",
-    "Referenced SOP Class UID", "Referenced SOP Instance UID",
-    "Device Serial Number", "Patient Comments", "Issuer of Patient ID",
-    "Study ID", "Study Comments", "Current Patient Location",
-    "Requested Procedure ID", "Performed Procedure Step ID",
-    "Other Patient IDs", "Operators' Name", "Institutional Department Name",
-    "Manufacturer", "Requesting Physician",
-}
-
-NAMES_TO_ANON_TIME = {
-    'Study Time', 'Series Time', 'Content Time',
-}
-
-def anon_callback(ds, element):
-    # Check if the element name is in the removal set
-    if element.name in NAMES_TO_REMOVE:
-        del ds[element.tag]
-        
-    # Handle date elements
-    if element.VR == "DA":
-        element.value = element.value[0:4] + "0101"  # set all dates to YYYY0101
-    # Handle time elements not in the exception list
-    elif element.VR == "TM" and element.name not in NAMES_TO_ANON_TIME:
-        element.value = "000000"  # set time to zeros
-
-def deidentify_dicom(ds):
-    ds.remove_private_tags()  # take out private tags added by notion or otherwise
-    
-    # Avoid separate walks by combining them
-    ds.walk(anon_callback)
-    # Only walk file_meta if it exists
-    if hasattr(ds, 'file_meta') and ds.file_meta is not None:
-        ds.file_meta.walk(anon_callback)
-
-    media_type = ds.file_meta[0x00020002]
-    is_video = 'Multi-frame' in str(media_type)
-    is_secondary = 'Secondary' in str(media_type)
-    
-    y0 = 101
-    
-    if not is_secondary and (0x0018, 0x6011) in ds:
-            y0 = ds['SequenceOfUltrasoundRegions'][0]['RegionLocationMinY0'].value
-
-    if 'OriginalAttributesSequence' in ds:
-        del ds.OriginalAttributesSequence
-        
-    # Check if Pixel Data is compressed
-    if ds.file_meta.TransferSyntaxUID.is_compressed:
-        # Attempt to decompress the Pixel Data
-        try:
-            ds.decompress()
-        except NotImplementedError as e:
-            print(f"Decompression not implemented for this transfer syntax: {e}")
-            return None  # or handle this appropriately for your use case
-        except Exception as e:
-            print(f"An error occurred during decompression: {e}")
-            return None  # or handle this appropriately for your use case
-
-    # crop patient info above US region 
-    arr = ds.pixel_array
-    
-    if is_video:
-        arr[:,:y0] = 0
-    else:
-        arr[:y0] = 0
-    
-    # Update the Pixel Data
-    ds.PixelData = arr.tobytes()
-    
-    # Important: Keep the original transfer syntax - DO NOT MODIFY THIS LINE
-    ds.file_meta.TransferSyntaxUID = ds.file_meta.TransferSyntaxUID
-
-    return ds
-
+# The de-identification itself lives in deid_core, shared with the download service
+from src import deid_core
+from src.deid_core import NAMES_TO_REMOVE, NAMES_TO_ANON_TIME, anon_callback, deidentify_dicom
 
 
 def create_dcm_filename(ds, key):
-        
-    # Extract the necessary identifiers
-    accession_number = ds.AccessionNumber
-    patient_id = ds.PatientID
-    
-    # Encrypt identifiers using the new method
-    anonymized_patient_id = encrypt_single_id(key, patient_id)
-    anonymized_accession_number = encrypt_single_id(key, accession_number)
-    
-    # Check the media type
-    media_type = ds.file_meta[0x00020002]
-    is_video = str(media_type).find('Multi-frame') > -1
-    is_secondary = str(media_type).find('Secondary') > -1
-
-    if is_video:
-        media = 'video'
-    elif is_secondary:
-        media = 'second'
-    else:
-        media = 'image'
-    
-    # Create a hash object
-    hash_obj = hashlib.sha256()
-    hash_obj.update(ds.pixel_array.tobytes())  # Convert pixel_array to bytes before hashing
-    
-    image_hash = hash_obj.hexdigest()
-    
-    # Try to convert encrypted IDs to integers and pad to 8 digits
-    try:
-        anon_patient_id_int = int(anonymized_patient_id)
-        formatted_patient_id = f"{anon_patient_id_int:08}"
-    except ValueError:
-        formatted_patient_id = anonymized_patient_id
-        
-    try:
-        anon_accession_number_int = int(anonymized_accession_number)
-        formatted_accession_number = f"{anon_accession_number_int:08}"
-    except ValueError:
-        formatted_accession_number = anonymized_accession_number
-    
-    # Construct the filename using the anonymized identifiers
-    filename = f'{media}_{formatted_patient_id}_{formatted_accession_number}_{image_hash}.dcm'
+    """Encrypt the IDs of a dataset through the shared ID cache and build its anonymized filename."""
+    return deid_core.create_dcm_filename(ds, key, encrypt_id_cached)
 
-    # Anonymize the DICOM data - set the new IDs
-    ds.PatientID = anonymized_patient_id
-    ds.AccessionNumber = anonymized_accession_number
-
-    return filename, ds  # return the modified DICOM dataset along with the filename
 
 def process_single_blob(blob, client, output_bucket_name, output_bucket_path, encryption_key, max_retries=3, error_counters=None):
     """Process a single DICOM blob from GCP bucket using RAM with download retry logic"""
@@ -341,11 +218,16 @@ def deidentify_bucket_dicoms(bucket_path, output_bucket_path, encryption_key, ba
     append_audit(os.path.join(env, "raw_data"), f"{error_counters['other_errors']} DICOMs Failed - Other errors")
     append_audit(os.path.join(env, "raw_data"), f"Remaining DICOMs: {successful}")
     
+    cache_stats = get_id_cache_stats()
+    append_audit(os.path.join(env, "raw_data"), f"ID cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['store_hits']} served from ID store")
+    flush_id_store()
+    
     print(f"Processing complete. Total: {total_processed}, Success: {successful}, Failed: {failed}")
     print(f"Error breakdown:")
     print(f"- Metadata errors: {error_counters['metadata_errors']}")
     print(f"- Pixel data errors: {error_counters['pixel_data_errors']}")
     print(f"- Decompression errors: {error_counters['decompression_errors']}")
     print(f"- Other errors: {error_counters['other_errors']}")
+    print(f"ID cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses ({cache_stats['hit_rate']:.1%} hit rate), {cache_stats['store_hits']} served from ID store")
     
     return successful, failed
\ No newline at end of file
@@ -0,0 +1,141 @@
+import math
+import statistics
+
+# Cloud Run memory sizes (MiB) and the CPUs each one needs
+MEMORY_TIERS = [(2048, 1), (4096, 1), (8192, 2), (16384, 4), (32768, 8)]
+# Resident memory of one service instance before any study is in flight
+BASE_MEMORY_MB = 400
+# Share of the memory limit admission control lets studies use (MEMORY_HIGH_WATERMARK)
+MEMORY_HIGH_WATERMARK = 0.8
+# Parts of one study held in memory at once (MAX_UPLOADS_PER_STUDY in the service)
+PARTS_IN_FLIGHT = 8
+# Studies per CPU; retrieval is I/O bound, but parsing and de-identification are not free
+STUDIES_PER_CPU = 8
+# Concurrency the service uses when nothing is known about the cohort
+DEFAULT_CONCURRENCY = 8
+# Assumed per-study time and size without history or calibration
+DEFAULT_STUDY_SECONDS = 60.0
+DEFAULT_STUDY_MB = 100.0
+DEFAULT_INSTANCES_PER_STUDY = 20
+
+
+def summarize_history(history):
+    """
+    Typical per-study duration, size and instance count from run history.
+
+    Args:
+        history (dict): {study_id: {'duration_seconds', 'bytes', 'instance_count'}} as
+            read by load_study_history
+
+    Returns:
+        dict or None: Medians over studies with a recorded duration, or None without any
+    """
+    entries = [entry for entry in history.values() if entry.get('duration_seconds')]
+    if not entries:
+        return None
+
+    def median(column, default):
+        values = [float(entry[column]) for entry in entries if entry.get(column)]
+        return statistics.median(values) if values else default
+
+    study_mb = median('bytes', DEFAULT_STUDY_MB * 1024 * 1024) / (1024 * 1024)
+    instances = median('instance_count', DEFAULT_INSTANCES_PER_STUDY)
+    return {
+        "studies": len(entries),
+        "study_seconds": median('duration_seconds', DEFAULT_STUDY_SECONDS),
+        "study_mb": study_mb,
+        "instances": instances,
+        # Only a few parts of a study are held at once, not the whole study
+        "study_memory_mb": min(study_mb, PARTS_IN_FLIGHT * study_mb / max(1.0, instances)),
+    }
+
+
+def plan_capacity(study_count, history=None, dicomweb_qps=None, retrieve_by_instance=False,
+                  max_instances_cap=100, target_hours=None, calibration=None):
+    """
+    Choose memory, per-instance concurrency and instance count for a pull.
+
+    Per-study time and memory come from a calibration run if given, else from
+    earlier runs' history, else from conservative defaults. Concurrency per
+    instance is what fits in memory under admission control and the CPU
+    budget; the instance count is the smallest that meets the target time,
+    limited by the DICOMweb quota and max_instances_cap.
+
+    Args:
+        study_count (int): Studies to publish
+        history (dict): Study history as read by load_study_history
+        dicomweb_qps (float): Healthcare API requests per second for the whole service
+        retrieve_by_instance (bool): Studies are fetched one instance per request
+        max_instances_cap (int): Upper bound on Cloud Run instances
+        target_hours (float): Desired duration; as fast as allowed if None
+        calibration (dict): Measured 'study_seconds' and optionally 'study_memory_mb', overriding history
+
+    Returns:
+        dict: memory_mb, cpu, concurrency, max_instances, expected_hours,
+        limiting_factor and the reasoning lines
+    """
+    reasons = []
+    profile = summarize_history(history or {})
+    if profile:
+        reasons.append(f"History of {profile['studies']} studies: median {profile['study_seconds']:.1f}s, "
+                       f"{profile['study_mb']:.0f} MB and {profile['instances']:.0f} instances per study")
+    else:
+        profile = {"study_seconds": DEFAULT_STUDY_SECONDS, "study_mb": DEFAULT_STUDY_MB,
+                   "instances": DEFAULT_INSTANCES_PER_STUDY,
+                   "study_memory_mb": PARTS_IN_FLIGHT * DEFAULT_STUDY_MB / DEFAULT_INSTANCES_PER_STUDY}
+        if not calibration:
+            reasons.append(f"No history or calibration: assuming {DEFAULT_STUDY_SECONDS:.0f}s and "
+                           f"{DEFAULT_STUDY_MB:.0f} MB per study")
+    if calibration:
+        # A calibration without a usable memory measurement only overrides the time
+        profile = {**profile, **calibration}
+        measured = (f"{profile['study_memory_mb']:.0f} MB in flight" if "study_memory_mb" in calibration
+                    else f"no memory measurement, keeping {profile['study_memory_mb']:.0f} MB in flight")
+        reasons.append(f"Calibration: {profile['study_seconds']:.1f}s and {measured} per study")
+
+    study_seconds = profile["study_seconds"]
+    study_memory_mb = max(1.0, profile["study_memory_mb"])
+
+    # Per instance: the smallest memory size that fits the default concurrency, else the roomiest
+    options = []
+    for memory_mb, cpu in MEMORY_TIERS:
+        fits = int((memory_mb * MEMORY_HIGH_WATERMARK - BASE_MEMORY_MB) // study_memory_mb)
+        options.append((memory_mb, cpu, max(0, min(fits, cpu * STUDIES_PER_CPU))))
+    memory_mb, cpu, concurrency = next(
+        (option for option in options if option[2] >= DEFAULT_CONCURRENCY),
+        max(options, key=lambda option: option[2])
+    )
+    concurrency = max(1, concurrency)
+    reasons.append(f"{memory_mb} MiB / {cpu} CPU fits {concurrency} studies at {study_memory_mb:.0f} MB each "
+                   f"(base {BASE_MEMORY_MB} MB, {MEMORY_HIGH_WATERMARK:.0%} watermark, {STUDIES_PER_CPU} per CPU)")
+
+    # Studies in flight across the service, from each constraint
+    limits = {"cohort size": study_count, "instance cap": max_instances_cap * concurrency}
+    if target_hours:
+        limits["target time"] = math.ceil(study_count * study_seconds / (target_hours * 3600))
+    if dicomweb_qps:
+        requests_per_study = 1 + profile["instances"] if retrieve_by_instance else 1
+        limits["DICOMweb quota"] = max(1, int(dicomweb_qps * study_seconds / requests_per_study))
+        reasons.append(f"{dicomweb_qps:g} DICOMweb requests/s at {requests_per_study:.0f} per study "
+                       f"sustains {limits['DICOMweb quota']} studies in flight")
+    else:
+        reasons.append("No DICOMweb quota configured, not limiting on it")
+
+    limiting_factor = min(limits, key=limits.get)
+    slots = max(1, limits[limiting_factor])
+    concurrency = min(concurrency, slots)
+    max_instances = max(1, math.ceil(slots / concurrency))
+    expected_hours = math.ceil(study_count / (max_instances * concurrency)) * study_seconds / 3600
+    duration = f"{expected_hours:.1f} hours" if expected_hours >= 1 else f"{expected_hours * 60:.0f} minutes"
+    reasons.append(f"{slots} studies in flight, limited by {limiting_factor}: "
+                   f"{max_instances} instances x {concurrency} studies, about {duration}")
+
+    return {
+        "memory_mb": memory_mb,
+        "cpu": cpu,
+        "concurrency": concurrency,
+        "max_instances": max_instances,
+        "expected_hours": expected_hours,
+        "limiting_factor": limiting_factor,
+        "reasons": reasons,
+    }
@@ -0,0 +1,169 @@
+import hashlib
+from io import BytesIO
+import pydicom
+from .id_crypto import encrypt_id_cached
+
+# De-identification shared by the --anon batch step and the download service.
+# Only depends on pydicom and id_crypto so it can be copied into the Cloud Run image.
+
+# Define sets at module level for better performance
+NAMES_TO_REMOVE = {
+    'SOP Instance UID', 'Study Time', 'Series Time', 'Content Time',
+    'Study Instance UID', 'Series Instance UID', 'Private Creator',
+    'Media Storage SOP Instance UID', 'Implementation Class UID',
+    "Patient's Name", "Referring Physician's Name", "Acquisition DateTime",
+    "Institution Name", "Station Name", "Physician(s) of Record",
+    "Referenced SOP Class UID", "Referenced SOP Instance UID",
+    "Device Serial Number", "Patient Comments", "Issuer of Patient ID",
+    "Study ID", "Study Comments", "Current Patient Location",
+    "Requested Procedure ID", "Performed Procedure Step ID",
+    "Other Patient IDs", "Operators' Name", "Institutional Department Name",
+    "Manufacturer", "Requesting Physician",
+}
+
+NAMES_TO_ANON_TIME = {
+    'Study Time', 'Series Time', 'Content Time',
+}
+
+def anon_callback(ds, element):
+    # Check if the element name is in the removal set
+    if element.name in NAMES_TO_REMOVE:
+        del ds[element.tag]
+        
+    # Handle date elements
+    if element.VR == "DA":
+        element.value = element.value[0:4] + "0101"  # set all dates to YYYY0101
+    # Handle time elements not in the exception list
+    elif element.VR == "TM" and element.name not in NAMES_TO_ANON_TIME:
+        element.value = "000000"  # set time to zeros
+
+def deidentify_dicom(ds):
+    ds.remove_private_tags()  # take out private tags added by notion or otherwise
+    
+    # Avoid separate walks by combining them
+    ds.walk(anon_callback)
+    # Only walk file_meta if it exists
+    if hasattr(ds, 'file_meta') and ds.file_meta is not None:
+        ds.file_meta.walk(anon_callback)
+
+    media_type = ds.file_meta[0x00020002]
+    is_video = 'Multi-frame' in str(media_type)
+    is_secondary = 'Secondary' in str(media_type)
+    
+    y0 = 101
+    
+    if not is_secondary and (0x0018, 0x6011) in ds:
+            y0 = ds['SequenceOfUltrasoundRegions'][0]['RegionLocationMinY0'].value
+
+    if 'OriginalAttributesSequence' in ds:
+        del ds.OriginalAttributesSequence
+        
+    # Check if Pixel Data is compressed
+    if ds.file_meta.TransferSyntaxUID.is_compressed:
+        # Attempt to decompress the Pixel Data
+        try:
+            ds.decompress()
+        except NotImplementedError as e:
+            print(f"Decompression not implemented for this transfer syntax: {e}")
+            return None  # or handle this appropriately for your use case
+        except Exception as e:
+            print(f"An error occurred during decompression: {e}")
+            return None  # or handle this appropriately for your use case
+
+    # crop patient info above US region 
+    arr = ds.pixel_array
+    
+    if is_video:
+        arr[:,:y0] = 0
+    else:
+        arr[:y0] = 0
+    
+    # Update the Pixel Data
+    ds.PixelData = arr.tobytes()
+    
+    # Important: Keep the original transfer syntax - DO NOT MODIFY THIS LINE
+    ds.file_meta.TransferSyntaxUID = ds.file_meta.TransferSyntaxUID
+
+    return ds
+
+
+def create_dcm_filename(ds, key, encrypt_id=encrypt_id_cached):
+        
+    # Extract the necessary identifiers
+    accession_number = ds.AccessionNumber
+    patient_id = ds.PatientID
+    
+    # Encrypt identifiers using the new method
+    anonymized_patient_id = encrypt_id(key, patient_id)
+    anonymized_accession_number = encrypt_id(key, accession_number)
+    
+    # Check the media type
+    media_type = ds.file_meta[0x00020002]
+    is_video = str(media_type).find('Multi-frame') > -1
+    is_secondary = str(media_type).find('Secondary') > -1
+
+    if is_video:
+        media = 'video'
+    elif is_secondary:
+        media = 'second'
+    else:
+        media = 'image'
+    
+    # Create a hash object
+    hash_obj = hashlib.sha256()
+    hash_obj.update(ds.pixel_array.tobytes())  # Convert pixel_array to bytes before hashing
+    
+    image_hash = hash_obj.hexdigest()
+    
+    # Try to convert encrypted IDs to integers and pad to 8 digits
+    try:
+        anon_patient_id_int = int(anonymized_patient_id)
+        formatted_patient_id = f"{anon_patient_id_int:08}"
+    except ValueError:
+        formatted_patient_id = anonymized_patient_id
+        
+    try:
+        anon_accession_number_int = int(anonymized_accession_number)
+        formatted_accession_number = f"{anon_accession_number_int:08}"
+    except ValueError:
+        formatted_accession_number = anonymized_accession_number
+    
+    # Construct the filename using the anonymized identifiers
+    filename = f'{media}_{formatted_patient_id}_{formatted_accession_number}_{image_hash}.dcm'
+
+    # Anonymize the DICOM data - set the new IDs
+    ds.PatientID = anonymized_patient_id
+    ds.AccessionNumber = anonymized_accession_number
+
+    return filename, ds  # return the modified DICOM dataset along with the filename
+
+
+def deidentify_bytes(data, key, encrypt_id=encrypt_id_cached):
+    """
+    De-identify one DICOM file held in memory, as the --anon batch step does.
+    
+    Args:
+        data (bytes): Raw DICOM file
+        key (bytes): ID encryption key
+        encrypt_id: Function (key, id_value) -> encrypted ID, e.g. a cached one
+        
+    Returns:
+        tuple: (relative_path, deidentified_bytes) where relative_path is
+        "{PatientID}_{AccessionNumber}/{filename}" with the encrypted IDs
+        
+    Raises:
+        ValueError: If the file has no pixel data or could not be de-identified
+    """
+    dataset = pydicom.dcmread(BytesIO(data), force=True)
+    new_filename, dataset = create_dcm_filename(dataset, key, encrypt_id)
+    
+    if not hasattr(dataset, 'pixel_array'):
+        raise ValueError("No pixel data found")
+    
+    dataset = deidentify_dicom(dataset)
+    if dataset is None:
+        raise ValueError("Deidentification failed")
+    
+    output_buffer = BytesIO()
+    dataset.save_as(output_buffer)
+    return f"{dataset.PatientID}_{dataset.AccessionNumber}/{new_filename}", output_buffer.getvalue()
@@ -2,53 +2,81 @@
 import datetime
 import csv
 import os
+import shutil
+import base64
 import subprocess
 import tqdm
 import time
+import json
+import heapq
+import statistics
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import pubsub_v1
+from google.cloud import storage
 
 # Add parent directory to path
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from config import CONFIG
+from src.capacity_plan import plan_capacity
 
 # Cloud Build configuration
 CONTENT_DIR = os.path.dirname(os.path.abspath(__file__))  # Directory of this script
 FASTAPI_DIR = os.path.join(CONTENT_DIR, "_fastapi")  # Assuming _fastapi directory exists
 TARGET_TAG = f"us-central1-docker.pkg.dev/{CONFIG['env']['project_id']}/{CONFIG['cloud_run']['ar']}/{CONFIG['cloud_run']['ar_name']}:{CONFIG['cloud_run']['version']}"
 
+# Modules copied into the image for de-identification at ingest
+SHARED_MODULES = ["id_crypto.py", "deid_core.py"]
+DEID_STAGE_DIR = os.path.join(FASTAPI_DIR, "app", "deid")
+
+# Markers written by the download service under {bucket_path}/{study_id}/
+COMPLETION_MARKER = "_COMPLETE.json"
+FAILURE_MARKER = "_FAILED.json"
+
+# Per-study durations from earlier runs, used to publish the longest studies first
+STUDY_HISTORY_COLUMNS = ['STUDY_ID', 'duration_seconds', 'bytes', 'instance_count']
+# Completion percentages reported for the planned and actual curves
+CURVE_POINTS = (10, 25, 50, 75, 90, 100)
+
 # The URL will be obtained after deployment
 CLOUD_RUN_URL = None
 
-def wake_up_service():
-    """Send a request to wake up the Cloud Run service before sending messages"""
-    import requests
-    
+# Memory, concurrency and instance count chosen for this deployment by plan_deployment
+CAPACITY_PLAN = None
+
+# Wall time of each control-plane phase in this run, in seconds
+PHASE_TIMES = {}
+
+
+@contextmanager
+def timed_phase(name):
+    """Record the wall time of the enclosed block in PHASE_TIMES."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        PHASE_TIMES[name] = PHASE_TIMES.get(name, 0.0) + time.time() - start
+
+
+def report_phase_times():
+    """Print how long each control-plane phase took."""
+    if PHASE_TIMES:
+        print("Phase times: " + ", ".join(f"{name} {seconds:.1f}s" for name, seconds in PHASE_TIMES.items()))
+
+
+def wake_up_service(timeout=300):
+    """Poll the service's health endpoint until it answers, so the first messages hit a warm instance."""
     global CLOUD_RUN_URL
     if not CLOUD_RUN_URL:
         return False
     
     print(f"Warming up Cloud Run service at {CLOUD_RUN_URL}...")
-    try:
-        # Get a token for authentication
-        token_cmd = ["gcloud", "auth", "print-identity-token", 
-                     f"--audiences={CLOUD_RUN_URL}"]
-        token_result = subprocess.run(token_cmd, check=True, capture_output=True, text=True)
-        token = token_result.stdout.strip()
-        
-        # Send a GET request to wake up the service
-        headers = {"Authorization": f"Bearer {token}"}
-        response = requests.get(f"{CLOUD_RUN_URL}", headers=headers, timeout=30)
-        print(f"Warm-up request status: {response.status_code}")
-        
-        # Give the service time to fully initialize
-        print("Waiting 10 seconds for service to be fully ready...")
-        time.sleep(10)
-        return True
-    except Exception as e:
-        print(f"Warning: Failed to warm up service: {e}")
-        return False
-    
+    with timed_phase("warm up"):
+        return wait_for_service_healthy(CLOUD_RUN_URL, timeout=timeout)
+
+
 def build_and_push_image():
     """Builds and pushes the Docker image using Cloud Build."""
     print("Building and pushing Docker image...")
@@ -57,6 +85,12 @@ def build_and_push_image():
         print(f"ERROR: FastAPI directory not found: {FASTAPI_DIR}")
         raise FileNotFoundError(f"Directory not found: {FASTAPI_DIR}")
     
+    # Copy the shared de-identification code into the build context
+    os.makedirs(DEID_STAGE_DIR, exist_ok=True)
+    for module in SHARED_MODULES:
+        shutil.copy(os.path.join(CONTENT_DIR, module), DEID_STAGE_DIR)
+    open(os.path.join(DEID_STAGE_DIR, "__init__.py"), "w").close()
+    
     command = [
         "gcloud", "builds", "submit",
         "--gcs-source-staging-dir", CONFIG['storage']['gcs_stage'],
@@ -67,136 +101,271 @@ def build_and_push_image():
     
     try:
         print(f"Executing in directory: {FASTAPI_DIR}")
-        result = subprocess.run(command, cwd=FASTAPI_DIR, check=True, capture_output=True, text=True)
+        with timed_phase("build"):
+            result = subprocess.run(command, cwd=FASTAPI_DIR, check=True, capture_output=True, text=True)
         print(f"Build successful: {result.stdout}")
         return True
     except subprocess.CalledProcessError as e:
         print(f"Build failed: {e.stderr}")
         raise
+    finally:
+        shutil.rmtree(DEID_STAGE_DIR, ignore_errors=True)
+
+
+def store_encryption_key_secret(key):
+    """
+    Add the ID encryption key as a new version of the Secret Manager secret read by the service.
+    
+    The key is passed on stdin, so it never appears on a command line or in the deploy config.
+    """
+    secret_name = CONFIG['cloud_run'].get('deid_key_secret', 'dicom-encryption-key')
+    project = f"--project={CONFIG['env']['project_id']}"
+    
+    with timed_phase("secret"):
+        describe = subprocess.run(["gcloud", "secrets", "describe", secret_name, project], capture_output=True, text=True)
+        if describe.returncode != 0:
+            subprocess.run(["gcloud", "secrets", "create", secret_name, "--replication-policy=automatic", project],
+                           check=True, capture_output=True, text=True)
+            print(f"Created secret '{secret_name}'")
+        
+        subprocess.run(["gcloud", "secrets", "versions", "add", secret_name, "--data-file=-", project],
+                       input=base64.b64encode(key).decode(), check=True, capture_output=True, text=True)
+    print(f"Stored encryption key in secret '{secret_name}'")
+    return secret_name
+
+
+def get_identity_token(audience):
+    """
+    Get an ID token for calling the Cloud Run service.
+    
+    Service account credentials mint one directly; user credentials from
+    `gcloud auth login` cannot, so those fall back to the gcloud CLI once.
+    """
+    import google.auth.transport.requests
+    import google.oauth2.id_token
+    try:
+        return google.oauth2.id_token.fetch_id_token(google.auth.transport.requests.Request(), audience)
+    except Exception:
+        result = subprocess.run(["gcloud", "auth", "print-identity-token", f"--audiences={audience}"],
+                                check=True, capture_output=True, text=True)
+        return result.stdout.strip()
 
 
-def wait_for_cloud_run_ready(cr_name, max_retries=5, retry_interval=10):
+def wait_for_service_healthy(url, timeout=300, max_interval=5):
     """
-    Check if the Cloud Run service is available, with retries.
+    Poll the service's root endpoint until it answers 200.
+    
+    The interval starts short and backs off, so a ready service is detected
+    within a fraction of a second instead of after a fixed sleep.
     
     Args:
-        cr_name (str): Cloud Run service name
-        max_retries (int): Maximum number of retries
-        retry_interval (int): Seconds to wait between retries
+        url (str): Cloud Run service URL
+        timeout (int): Seconds to keep polling
+        max_interval (float): Longest wait between polls
     
     Returns:
-        bool: True if service is available, False otherwise
+        bool: True if the service answered before the timeout
     """
-    print(f"Waiting for Cloud Run service '{cr_name}' to be ready...")
+    import requests
     
-    for attempt in range(max_retries):
+    try:
+        headers = {"Authorization": f"Bearer {get_identity_token(url)}"}
+    except Exception as e:
+        print(f"Warning: Could not get an identity token for {url}: {e}")
+        return False
+    
+    deadline = time.time() + timeout
+    interval = 0.5
+    status = None
+    while time.time() < deadline:
         try:
-            check_command = [
-                "gcloud", "run", "services", "describe", cr_name,
-                f"--region={CONFIG['env']['region']}", f"--project={CONFIG['env']['project_id']}",
-                "--format=value(status.url)"
-            ]
-            check_result = subprocess.run(check_command, check=True, capture_output=True, text=True)
-            url = check_result.stdout.strip()
-            
-            if url:
-                print(f"Cloud Run service '{cr_name}' is ready at {url}")
-                return url
-        except subprocess.CalledProcessError as e:
-            print(f"Attempt {attempt+1}/{max_retries}: Service not ready yet: {e.stderr}")
-        
-        print(f"Waiting {retry_interval} seconds before retrying...")
-        time.sleep(retry_interval)
+            status = requests.get(url, headers=headers, timeout=30).status_code
+            if status == 200:
+                print(f"Service at {url} is healthy")
+                return True
+        except requests.RequestException as e:
+            status = str(e)
+        time.sleep(interval)
+        interval = min(max_interval, interval * 2)
+    
+    print(f"Service at {url} not healthy after {timeout} seconds (last status: {status})")
+    return False
+
+
+def cloud_run_service_path():
+    """Full resource name of the Cloud Run service."""
+    cr_name = CONFIG['cloud_run']['ar_name'].replace("_", "-")
+    return f"projects/{CONFIG['env']['project_id']}/locations/{CONFIG['env']['region']}/services/{cr_name}"
+
+
+def current_capacity():
+    """The capacity plan for this deployment, or the fixed defaults if none was made."""
+    if CAPACITY_PLAN:
+        return CAPACITY_PLAN
+    return {
+        "memory_mb": 4096,
+        "cpu": 1,
+        "concurrency": CONFIG['cloud_run'].get('max_concurrent_studies', 8),
+        "max_instances": CONFIG['cloud_run'].get('max_instances', 100),
+    }
+
+
+def plan_deployment(csv_file, history_file=None, calibration=None):
+    """
+    Size the deployment for the studies in csv_file and remember the plan in CAPACITY_PLAN.
+    
+    Args:
+        csv_file (str): CSV of studies that will be published
+        history_file (str): Study history CSV from earlier runs
+        calibration (dict): Measurements from calibrate_capacity, if a calibration run was made
+    
+    Returns:
+        dict: The plan from plan_capacity
+    """
+    global CAPACITY_PLAN
+    
+    study_count = len(set(iter_csv_urls(csv_file)))
+    CAPACITY_PLAN = plan_capacity(
+        study_count,
+        history=load_study_history(history_file),
+        dicomweb_qps=CONFIG['cloud_run'].get('dicomweb_qps'),
+        retrieve_by_instance=CONFIG['cloud_run'].get('retrieve_by_instance', False),
+        max_instances_cap=CONFIG['cloud_run'].get('max_instances', 100),
+        target_hours=CONFIG['cloud_run'].get('target_hours'),
+        calibration=calibration,
+    )
+    print(f"Capacity plan for {study_count} studies:")
+    for reason in CAPACITY_PLAN["reasons"]:
+        print(f"  {reason}")
+    return CAPACITY_PLAN
+
+
+def service_environment(bucket_name, bucket_path, key_secret=None):
+    """
+    Environment variables and secrets for the download service.
+    
+    Returns:
+        tuple: ({name: value}, {name: secret_name}) for plain and Secret Manager variables
+    """
+    capacity = current_capacity()
+    # MEMORY_LIMIT_MB matches the memory limit so admission control works without cgroup limits visible
+    env = {"BUCKET_NAME": bucket_name, "BUCKET_PATH": bucket_path, "MEMORY_LIMIT_MB": str(capacity["memory_mb"]),
+           "MAX_CONCURRENT_STUDIES": str(capacity["concurrency"])}
+    # The tracker reads the same limit to tell which studies the service gave up on
+    env["MAX_STUDY_ATTEMPTS"] = str(CONFIG['cloud_run'].get('max_study_attempts', 5))
+    
+    # Each service process gets its share of the Healthcare API request budget
+    # between the instances that may be running; dicomweb_adaptive lets it adapt to 429s from there
+    dicomweb_qps = CONFIG['cloud_run'].get('dicomweb_qps')
+    if dicomweb_qps:
+        env["DICOMWEB_QPS"] = str(dicomweb_qps)
+        env["DICOMWEB_INSTANCES"] = str(capacity["max_instances"])
+        if CONFIG['cloud_run'].get('dicomweb_adaptive'):
+            env["DICOMWEB_ADAPTIVE"] = "true"
+    
+    # Very large studies can be fetched instance by instance to stay within the request timeout
+    if CONFIG['cloud_run'].get('retrieve_by_instance'):
+        env["RETRIEVE_BY_INSTANCE"] = "true"
+    
+    secrets = {}
+    if key_secret:
+        env.update(inline_deid_environment(bucket_path))
+        secrets["DICOM_ENCRYPTION_KEY"] = key_secret
     
-    print(f"Cloud Run service '{cr_name}' not ready after {max_retries} attempts")
-    return None
+    return env, secrets
 
 
-def deploy_cloud_run(bucket_name=None, bucket_path=None):
-    """Deploy the FastAPI application to Cloud Run."""
+def inline_deid_environment(bucket_path):
+    """
+    Service variables for de-identifying at ingest, shared by Cloud Run and --download-local.
+    
+    De-identified DICOMs go to the anonymized prefix with the same run timestamp.
+    The key itself is passed separately, as a secret or from the local key file.
+    """
+    anon_bucket_path = f"{CONFIG['storage']['anonymized_path']}/{os.path.basename(bucket_path)}"
+    print(f"De-identified DICOMs will be written to {anon_bucket_path}")
+    return {
+        "INLINE_DEID": "true",
+        "ANON_BUCKET_PATH": anon_bucket_path,
+        "STORE_RAW": "true" if CONFIG['cloud_run'].get('store_raw', True) else "false",
+    }
+
+
+def deploy_cloud_run(bucket_name=None, bucket_path=None, key_secret=None):
+    """
+    Deploy the FastAPI application to Cloud Run with the Cloud Run Admin API.
+    
+    The service is created or updated in one call, and the call returns once
+    the new revision is serving.
+    """
+    from google.cloud import run_v2
+    from google.protobuf import duration_pb2
     global CLOUD_RUN_URL
     
     print("Deploying Cloud Run service...")
     
-    cr_name = CONFIG['cloud_run']['ar_name'].replace("_", "-")
     vpc_connector = f"projects/{CONFIG['cloud_run']['vpc_shared']}/locations/{CONFIG['env']['region']}/connectors/{CONFIG['cloud_run']['vpc_name']}"
+    capacity = current_capacity()
+    env, secrets = service_environment(bucket_name, bucket_path, key_secret)
+    env_vars = [run_v2.EnvVar(name=name, value=value) for name, value in env.items()]
+    env_vars += [
+        run_v2.EnvVar(name=name, value_source=run_v2.EnvVarSource(
+            secret_key_ref=run_v2.SecretKeySelector(secret=secret, version="latest")))
+        for name, secret in secrets.items()
+    ]
     
-    # Create environment variables string
-    env_vars = f"BUCKET_NAME={bucket_name},BUCKET_PATH={bucket_path}"
+    service = run_v2.Service(
+        name=cloud_run_service_path(),
+        ingress=run_v2.IngressTraffic.INGRESS_TRAFFIC_INTERNAL_LOAD_BALANCER,
+        binary_authorization=run_v2.BinaryAuthorization(use_default=True),
+        template=run_v2.RevisionTemplate(
+            service_account=CONFIG['env']['service_account_identity'],
+            timeout=duration_pb2.Duration(seconds=3000),
+            scaling=run_v2.RevisionScaling(min_instance_count=1, max_instance_count=capacity["max_instances"]),
+            # A little above the study limit so health and metrics requests still get through;
+            # Cloud Run sends further pushes to other instances instead of the service answering 429
+            max_instance_request_concurrency=capacity["concurrency"] + 2,
+            vpc_access=run_v2.VpcAccess(connector=vpc_connector, egress=run_v2.VpcAccess.VpcEgress.ALL_TRAFFIC),
+            containers=[run_v2.Container(
+                image=TARGET_TAG,
+                ports=[run_v2.ContainerPort(container_port=5000)],
+                resources=run_v2.ResourceRequirements(
+                    limits={"memory": f"{capacity['memory_mb']}Mi", "cpu": str(capacity["cpu"])}),
+                env=env_vars,
+            )],
+        ),
+    )
     
-    command = [
-        "gcloud", "run", "deploy", cr_name,
-        "--binary-authorization=default",
-        f"--image={TARGET_TAG}",
-        "--ingress=internal-and-cloud-load-balancing",
-        "--no-allow-unauthenticated",
-        "--port=5000",
-        f"--project={CONFIG['env']['project_id']}",
-        "--quiet",
-        f"--region={CONFIG['env']['region']}",
-        f"--service-account={CONFIG['env']['service_account_identity']}",
-        f"--vpc-connector={vpc_connector}",
-        "--vpc-egress=all-traffic",
-        "--timeout=3000",
-        "--memory=4096Mi",
-        "--min-instances=1",
-        f"--set-env-vars={env_vars}"
-    ]
+    with timed_phase("deploy"):
+        operation = run_v2.ServicesClient().update_service(
+            request=run_v2.UpdateServiceRequest(service=service, allow_missing=True)
+        )
+        deployed = operation.result()
     
-    try:
-        result = subprocess.run(command, check=True, capture_output=True, text=True)
-        print(f"Successfully deployed Cloud Run service: {cr_name}")
-        
-        # Wait for service to be fully available and get URL
-        url = wait_for_cloud_run_ready(cr_name)
-        if url:
-            CLOUD_RUN_URL = url
-            print(f"Cloud Run URL: {CLOUD_RUN_URL}")
-            return CLOUD_RUN_URL
-        else:
-            raise Exception(f"Failed to get URL for Cloud Run service: {cr_name}")
-    except subprocess.CalledProcessError as e:
-        print(f"Error deploying Cloud Run service: {e.stderr}")
-        raise
-    except Exception as e:
-        print(f"Error accessing Cloud Run service: {str(e)}")
-        raise
+    CLOUD_RUN_URL = deployed.uri
+    print(f"Successfully deployed Cloud Run service: {deployed.name}")
+    print(f"Cloud Run URL: {CLOUD_RUN_URL}")
+    return CLOUD_RUN_URL
 
 
-def check_pubsub_exists():
-    """Check if Pub/Sub topic and subscription already exist."""
-    topic_exists = False
-    subscription_exists = False
-    
-    # Check if topic exists
-    try:
-        check_topic_cmd = [
-            "gcloud", "pubsub", "topics", "describe", CONFIG['env']['topic_name'],
-            f"--project={CONFIG['env']['project_id']}", "--format=json"
-        ]
-        subprocess.run(check_topic_cmd, check=True, capture_output=True, text=True)
-        topic_exists = True
-        print(f"Topic '{CONFIG['env']['topic_name']}' already exists.")
-    except subprocess.CalledProcessError:
-        pass
-    
-    # Check if subscription exists
-    try:
-        check_sub_cmd = [
-            "gcloud", "pubsub", "subscriptions", "describe", CONFIG['env']['subscription_name'],
-            f"--project={CONFIG['env']['project_id']}", "--format=json"
-        ]
-        subprocess.run(check_sub_cmd, check=True, capture_output=True, text=True)
-        subscription_exists = True
-        print(f"Subscription '{CONFIG['env']['subscription_name']}' already exists.")
-    except subprocess.CalledProcessError:
-        pass
+def ensure_topic():
+    """Create the Pub/Sub topic if it does not exist yet."""
+    from google.api_core.exceptions import AlreadyExists
     
-    return topic_exists, subscription_exists
+    publisher = pubsub_v1.PublisherClient()
+    topic_path = publisher.topic_path(CONFIG['env']['project_id'], CONFIG['env']['topic_name'])
+    with timed_phase("topic"):
+        try:
+            publisher.create_topic(name=topic_path)
+            print(f"Topic '{CONFIG['env']['topic_name']}' created successfully.")
+        except AlreadyExists:
+            print(f"Topic '{CONFIG['env']['topic_name']}' already exists.")
+    return topic_path
 
 
 def setup_pubsub():
-    """Create Pub/Sub topic and subscription with push configuration."""
+    """Create the Pub/Sub topic and the push subscription to the deployed service."""
+    from google.api_core.exceptions import AlreadyExists
     global CLOUD_RUN_URL
     
     if CLOUD_RUN_URL is None:
@@ -207,45 +376,57 @@ def setup_pubsub():
     push_endpoint = f"{CLOUD_RUN_URL}/push_handlers/receive_messages"
     print(f"Push endpoint: {push_endpoint}")
     
-    # Check if resources already exist
-    topic_exists, subscription_exists = check_pubsub_exists()
-    
-    if not topic_exists:
-        print(f"Setting up Pub/Sub topic: {CONFIG['env']['topic_name']}")
-        try:
-            # Create topic
-            subprocess.run([
-                "gcloud", "pubsub", "topics", "create", CONFIG['env']['topic_name'],
-                f"--project={CONFIG['env']['project_id']}"
-            ], check=True)
-            print(f"Topic '{CONFIG['env']['topic_name']}' created successfully.")
-        except subprocess.CalledProcessError as e:
-            if "already exists" in str(e):
-                print(f"Topic '{CONFIG['env']['topic_name']}' already exists.")
-            else:
-                raise
+    topic_path = ensure_topic()
+    subscriber = pubsub_v1.SubscriberClient()
+    subscription_path = subscriber.subscription_path(CONFIG['env']['project_id'], CONFIG['env']['subscription_name'])
     
-    if not subscription_exists:
-        print(f"Setting up Pub/Sub subscription: {CONFIG['env']['subscription_name']}")
+    with timed_phase("subscription"), subscriber:
         try:
-            # Create subscription with push configuration
-            subprocess.run([
-                "gcloud", "pubsub", "subscriptions", "create", CONFIG['env']['subscription_name'],
-                f"--topic={CONFIG['env']['topic_name']}",
-                f"--push-endpoint={push_endpoint}",
-                f"--push-auth-service-account={CONFIG['env']['service_account_identity']}",
-                f"--project={CONFIG['env']['project_id']}"
-            ], check=True)
+            subscriber.create_subscription(request={
+                "name": subscription_path,
+                "topic": topic_path,
+                "push_config": {
+                    "push_endpoint": push_endpoint,
+                    "oidc_token": {"service_account_email": CONFIG['env']['service_account_identity']},
+                },
+                # Hold each push for up to 10 minutes, and back off when the service answers 429/503
+                "ack_deadline_seconds": 600,
+                "retry_policy": {"minimum_backoff": {"seconds": 10}, "maximum_backoff": {"seconds": 600}},
+            })
             print(f"Subscription '{CONFIG['env']['subscription_name']}' created successfully.")
-        except subprocess.CalledProcessError as e:
-            if "already exists" in str(e):
-                print(f"Subscription '{CONFIG['env']['subscription_name']}' already exists.")
-            else:
-                raise
+        except AlreadyExists:
+            print(f"Subscription '{CONFIG['env']['subscription_name']}' already exists.")
     
     return True
 
 
+# Publisher batching and flow control. Publishing blocks once this many
+# messages (or bytes) are outstanding, so memory stays flat on large cohorts.
+PUBLISH_BATCH_MAX_MESSAGES = 500
+PUBLISH_BATCH_MAX_BYTES = 1024 * 1024
+PUBLISH_BATCH_MAX_LATENCY = 0.05  # seconds
+PUBLISH_MAX_OUTSTANDING_MESSAGES = 10000
+PUBLISH_MAX_OUTSTANDING_BYTES = 10 * 1024 * 1024
+
+
+def create_publisher():
+    """Create a Pub/Sub publisher with explicit batch settings and publish flow control."""
+    batch_settings = pubsub_v1.types.BatchSettings(
+        max_messages=PUBLISH_BATCH_MAX_MESSAGES,
+        max_bytes=PUBLISH_BATCH_MAX_BYTES,
+        max_latency=PUBLISH_BATCH_MAX_LATENCY,
+    )
+    flow_control = pubsub_v1.types.PublishFlowControl(
+        message_limit=PUBLISH_MAX_OUTSTANDING_MESSAGES,
+        byte_limit=PUBLISH_MAX_OUTSTANDING_BYTES,
+        limit_exceeded_behavior=pubsub_v1.types.LimitExceededBehavior.BLOCK,
+    )
+    return pubsub_v1.PublisherClient(
+        batch_settings=batch_settings,
+        publisher_options=pubsub_v1.types.PublisherOptions(flow_control=flow_control),
+    )
+
+
 def publish_message(url):
     global PUBLISHER
     global TOPIC_PATH
@@ -254,119 +435,615 @@ def publish_message(url):
     return future
 
 
-def process_csv_file(csv_file):
+def iter_csv_urls(csv_file):
+    """Stream the ENDPOINT_ADDRESS values of a CSV file, skipping rows without one."""
+    with open(csv_file, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            url = row.get('ENDPOINT_ADDRESS')
+            if not url:
+                print(f"Warning: Missing URL in row: {row}")
+                continue
+            yield url
+
+
+def publish_urls(urls, total=None, failed_file=None):
+    """
+    Publish study URLs to Pub/Sub and wait for every publish to resolve.
+    
+    Each publish future is tracked through a callback, so the result of every
+    message is known without holding all futures in memory.
+    
+    Args:
+        urls: Iterable of study URLs
+        total (int): Number of URLs for the progress bar, if known
+        failed_file (str): Write URLs that failed to publish here, as a CSV
+            with ENDPOINT_ADDRESS and error columns that can be published again
+    
+    Returns:
+        tuple: (published_count, failed) where failed is a list of (url, error)
+    """
+    lock = threading.Lock()
+    all_done = threading.Condition(lock)
+    counts = {"submitted": 0, "resolved": 0, "published": 0}
+    failed = []
+    
+    pbar = tqdm.tqdm(total=total, desc="Publishing messages")
+    
+    def on_done(future, url):
+        error = future.exception()
+        with lock:
+            if error is None:
+                counts["published"] += 1
+            else:
+                failed.append((url, str(error)))
+            counts["resolved"] += 1
+            all_done.notify_all()
+        pbar.update(1)
+    
+    for url in urls:
+        try:
+            future = publish_message(url)
+        except Exception as e:
+            # Raised synchronously, e.g. a message over the size limit
+            with lock:
+                failed.append((url, str(e)))
+            pbar.update(1)
+            continue
+        with lock:
+            counts["submitted"] += 1
+        future.add_done_callback(lambda f, url=url: on_done(f, url))
+    
+    # Flush the last partial batch and wait for every outstanding publish
+    with lock:
+        all_done.wait_for(lambda: counts["resolved"] == counts["submitted"])
+    pbar.close()
+    
+    if failed:
+        for url, error in failed[:10]:
+            print(f"Failed to publish {url}: {error}")
+        if len(failed) > 10:
+            print(f"... and {len(failed) - 10} more")
+        if failed_file:
+            with open(failed_file, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['ENDPOINT_ADDRESS', 'error'])
+                writer.writerows(failed)
+            print(f"Wrote {len(failed)} failed URLs to {failed_file}, publish them again with --csv {failed_file}")
+    
+    return counts["published"], failed
+
+
+def select_missing_urls(urls, bucket_path):
+    """
+    Drop studies that already have a completion marker under bucket_path.
+    
+    The bucket is listed once, so the cost does not depend on how many
+    studies are already stored.
+    
+    Args:
+        urls: Iterable of study URLs
+        bucket_path (str): Prefix the download service writes to
+    
+    Returns:
+        list: URLs of studies that are missing or incomplete
+    """
+    completed, _ = list_study_markers(bucket_path)
+    urls = list(urls)
+    missing = [url for url in urls if study_id_from_url(url) not in completed]
+    
+    print(f"{len(urls) - len(missing)} of {len(urls)} studies already complete in "
+          f"gs://{CONFIG['storage']['bucket_name']}/{bucket_path}, {len(missing)} to publish")
+    return missing
+
+
+def process_csv_file(csv_file, failed_file=None, bucket_path=None, run_path=None):
     """
     Read the CSV file containing DICOM URLs and publish each URL to Pub/Sub.
     
+    The file is streamed once; publishing blocks under flow control instead of
+    buffering the whole cohort. With bucket_path set, studies that are already
+    complete there are left out. Unless the longest_first setting is off,
+    studies are published longest first, which needs the whole list in memory.
+    
     Args:
         csv_file (str): Path to the CSV file
+        failed_file (str): Where to write URLs that failed to publish
+        bucket_path (str): Only publish studies without a completion marker here
+        run_path (str): Prefix the service writes this run to, saved with the publish time
+            in output/publish_plan.json for the completion curve
+    
+    Returns:
+        tuple: (published_count, failed) as returned by publish_urls
     """
     print(f"Processing CSV file: {csv_file}")
     
-    # First count total rows for the progress bar
-    with open(csv_file, 'r') as f:
-        total_rows = sum(1 for _ in csv.DictReader(f))
+    output_dir = os.path.dirname(os.path.abspath(csv_file))
+    plan_file = os.path.join(output_dir, "publish_plan.json")
+    longest_first = CONFIG['cloud_run'].get('longest_first', True)
     
-    num_processed = 0
-    with open(csv_file, 'r') as f:
-        reader = csv.DictReader(f)
-        # Create progress bar
-        pbar = tqdm.tqdm(total=total_rows, desc="Publishing messages")
-        for row in reader:
-            url = row.get('ENDPOINT_ADDRESS')
-            if not url:
-                print(f"Warning: Missing URL in row: {row}")
-                pbar.update(1)
-                continue
-                
-            publish_message(url)
-            num_processed += 1
-            pbar.update(1)
-            
-        pbar.close()
+    if bucket_path or longest_first:
+        urls = select_missing_urls(iter_csv_urls(csv_file), bucket_path) if bucket_path else list(iter_csv_urls(csv_file))
+        if not urls:
+            print("Nothing to publish")
+            return 0, []
+        if longest_first:
+            urls = order_longest_first(urls, os.path.join(output_dir, "study_history.csv"), plan_file, run_path)
+        else:
+            save_publish_plan(plan_file, run_path)
+        published, failed = publish_urls(urls, total=len(urls), failed_file=failed_file)
+    else:
+        save_publish_plan(plan_file, run_path)
+        published, failed = publish_urls(iter_csv_urls(csv_file), failed_file=failed_file)
     
-    print(f"Processed {num_processed} URLs from {csv_file}")
+    print(f"Published {published} URLs from {csv_file}, {len(failed)} failed")
+    return published, failed
 
 
 def cleanup_resources(delete_cloud_run=False):
     """
     Delete created resources.
     
+    The subscription, topic and service are independent, so they are deleted
+    at the same time.
+    
     Args:
         delete_cloud_run (bool): Whether to delete the Cloud Run service
     """
+    from google.api_core.exceptions import NotFound
     print("Cleaning up resources...")
     
-    # Delete subscription
-    try:
-        subprocess.run([
-            "gcloud", "pubsub", "subscriptions", "delete", CONFIG['env']['subscription_name'],
-            f"--project={CONFIG['env']['project_id']}", "--quiet"
-        ], check=True)
-        print(f"Subscription '{CONFIG['env']['subscription_name']}' deleted.")
-    except subprocess.CalledProcessError as e:
-        print(f"Failed to delete subscription '{CONFIG['env']['subscription_name']}': {e}")
+    def delete_subscription():
+        with pubsub_v1.SubscriberClient() as subscriber:
+            subscriber.delete_subscription(subscription=subscriber.subscription_path(
+                CONFIG['env']['project_id'], CONFIG['env']['subscription_name']))
+        return f"Subscription '{CONFIG['env']['subscription_name']}'"
     
-    # Delete topic
-    try:
-        subprocess.run([
-            "gcloud", "pubsub", "topics", "delete", CONFIG['env']['topic_name'],
-            f"--project={CONFIG['env']['project_id']}", "--quiet"
-        ], check=True)
-        print(f"Topic '{CONFIG['env']['topic_name']}' deleted.")
-    except subprocess.CalledProcessError as e:
-        print(f"Failed to delete topic '{CONFIG['env']['topic_name']}': {e}")
+    def delete_topic():
+        publisher = pubsub_v1.PublisherClient()
+        publisher.delete_topic(topic=publisher.topic_path(CONFIG['env']['project_id'], CONFIG['env']['topic_name']))
+        return f"Topic '{CONFIG['env']['topic_name']}'"
     
-    # Delete Cloud Run service if requested
-    if delete_cloud_run:
-        try:
-            cr_name = CONFIG['cloud_run']['ar_name'].replace("_", "-")
-            subprocess.run([
-                "gcloud", "run", "services", "delete", cr_name,
-                f"--region={CONFIG['env']['region']}", f"--project={CONFIG['env']['project_id']}", "--quiet"
-            ], check=True)
-            print(f"Cloud Run service '{cr_name}' deleted.")
-        except subprocess.CalledProcessError as e:
-            print(f"Failed to delete Cloud Run service: {e}")
+    def delete_service():
+        from google.cloud import run_v2
+        run_v2.ServicesClient().delete_service(name=cloud_run_service_path()).result()
         
-        # Also delete the container image
+        # Also delete the container image, once nothing is serving it
+        registry = f"us-central1-docker.pkg.dev/{CONFIG['env']['project_id']}/{CONFIG['cloud_run']['ar']}/{CONFIG['cloud_run']['ar_name']}"
         try:
-            registry = f"us-central1-docker.pkg.dev/{CONFIG['env']['project_id']}/{CONFIG['cloud_run']['ar']}/{CONFIG['cloud_run']['ar_name']}"
             subprocess.run([
-                "gcloud", "artifacts", "docker", "images", "delete", 
+                "gcloud", "artifacts", "docker", "images", "delete",
                 registry, "--quiet", "--delete-tags"
             ], check=True)
             print(f"Container image '{registry}' deleted.")
         except subprocess.CalledProcessError as e:
             print(f"Failed to delete container image: {e}")
+        return "Cloud Run service"
+    
+    tasks = [delete_subscription, delete_topic] + ([delete_service] if delete_cloud_run else [])
+    with timed_phase("cleanup"), ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+        futures = {executor.submit(task): task.__name__ for task in tasks}
+        for future, name in futures.items():
+            try:
+                print(f"{future.result()} deleted.")
+            except NotFound:
+                print(f"{name}: already gone.")
+            except Exception as e:
+                print(f"{name} failed: {e}")
+
+
+def get_deployed_service():
+    """Return the deployed Cloud Run service, or None if it does not exist or cannot be read."""
+    from google.cloud import run_v2
+    try:
+        return run_v2.ServicesClient().get_service(name=cloud_run_service_path())
+    except Exception:
+        return None
 
 
 def get_existing_cloud_run_url():
     """Get the URL of an existing Cloud Run service."""
-    cr_name = CONFIG['cloud_run']['ar_name'].replace("_", "-")
+    service = get_deployed_service()
+    return service.uri if service and service.uri else None
+
+
+def get_deployed_env():
+    """Return the environment variables of the deployed Cloud Run service, or {} if unavailable."""
+    service = get_deployed_service()
+    if not service or not service.template.containers:
+        return {}
+    return {var.name: var.value for var in service.template.containers[0].env}
+
+
+def study_id_from_url(url):
+    """The study ID the download service stores a study under (last URL segment)."""
+    return url.rstrip('/').split('/')[-1]
+
+
+def list_study_markers(bucket_path, max_attempts=None):
+    """
+    Read the completion and failure markers under bucket_path with one listing.
+    
+    Args:
+        bucket_path (str): Prefix the download service writes to
+        max_attempts (int): Only read failure markers to find studies that
+            reached this many attempts; None skips reading them
+    
+    Returns:
+        tuple: (completed, gave_up) sets of study IDs
+    """
+    client = storage.Client()
+    bucket = client.bucket(CONFIG['storage']['bucket_name'])
+    
+    completed = set()
+    failure_blobs = []
+    for blob in client.list_blobs(bucket, prefix=f"{bucket_path}/", match_glob="**/_*.json"):
+        study_id = blob.name.split('/')[-2]
+        if blob.name.endswith(COMPLETION_MARKER):
+            completed.add(study_id)
+        elif blob.name.endswith(FAILURE_MARKER):
+            failure_blobs.append((study_id, blob))
+    
+    gave_up = set()
+    if max_attempts:
+        for study_id, blob in failure_blobs:
+            if study_id in completed:
+                continue
+            try:
+                if json.loads(blob.download_as_bytes()).get("attempts", 0) >= max_attempts:
+                    gave_up.add(study_id)
+            except Exception as e:
+                print(f"Warning: Could not read {blob.name}: {e}")
+    
+    return completed, gave_up
+
+
+def track_completion(urls, bucket_path, poll_interval=60, max_attempts=5, stall_timeout=3600, incomplete_file=None):
+    """
+    Wait until every published study is complete or has given up, showing progress and ETA.
+    
+    A study is done when the service has written its completion marker, and
+    has given up when its failure marker reaches max_attempts (the service's
+    MAX_STUDY_ATTEMPTS). Tracking stops early if nothing changes for
+    stall_timeout seconds.
+    
+    Args:
+        urls: Study URLs that were published
+        bucket_path (str): Prefix the download service writes to
+        poll_interval (int): Seconds between bucket listings
+        max_attempts (int): Attempts after which the service gives up on a study
+        stall_timeout (int): Seconds without progress before giving up on tracking
+        incomplete_file (str): Write unfinished study URLs here as an ENDPOINT_ADDRESS CSV
+    
+    Returns:
+        tuple: (completed, gave_up, remaining) sets of study IDs
+    """
+    url_by_study = {study_id_from_url(url): url for url in urls}
+    pending = set(url_by_study)
+    print(f"Tracking {len(pending)} studies under gs://{CONFIG['storage']['bucket_name']}/{bucket_path}")
+    
+    pbar = tqdm.tqdm(total=len(pending), desc="Studies finished")
+    last_progress = time.time()
+    while True:
+        completed, gave_up = list_study_markers(bucket_path, max_attempts)
+        completed &= set(url_by_study)
+        gave_up = (gave_up & set(url_by_study)) - completed
+        remaining = pending - completed - gave_up
+        
+        finished = len(url_by_study) - len(remaining)
+        if finished > pbar.n:
+            pbar.update(finished - pbar.n)
+            last_progress = time.time()
+        pbar.set_postfix(complete=len(completed), gave_up=len(gave_up), remaining=len(remaining))
+        
+        if not remaining:
+            break
+        if time.time() - last_progress > stall_timeout:
+            print(f"\nNo progress for {stall_timeout} seconds, stopping tracking")
+            break
+        time.sleep(poll_interval)
+    pbar.close()
+    
+    print(f"Complete: {len(completed)}, gave up after {max_attempts} attempts: {len(gave_up)}, still pending: {len(remaining)}")
+    unfinished = gave_up | remaining
+    if unfinished and incomplete_file:
+        with open(incomplete_file, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['ENDPOINT_ADDRESS', 'status'])
+            for study_id in sorted(unfinished):
+                writer.writerow([url_by_study[study_id], 'gave_up' if study_id in gave_up else 'pending'])
+        print(f"Wrote {len(unfinished)} unfinished studies to {incomplete_file}")
+    
+    return completed, gave_up, remaining
+
+
+def read_completion_markers(bucket_path):
+    """
+    Read every completion marker under bucket_path.
+    
+    Returns:
+        dict: {study_id: marker} with the duration, size and completed_at the service recorded
+    """
+    client = storage.Client()
+    bucket = client.bucket(CONFIG['storage']['bucket_name'])
+    blobs = list(client.list_blobs(bucket, prefix=f"{bucket_path}/", match_glob=f"**/{COMPLETION_MARKER}"))
+    
+    def read_marker(blob):
+        try:
+            return json.loads(blob.download_as_bytes())
+        except Exception as e:
+            print(f"Warning: Could not read {blob.name}: {e}")
+            return None
+    
+    markers = {}
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        for marker in executor.map(read_marker, blobs):
+            if marker and marker.get('study_id'):
+                markers[marker['study_id']] = marker
+    return markers
+
+
+def record_study_history(markers, history_file):
+    """
+    Add the per-study duration and size from this run's completion markers to the history file.
+    
+    Args:
+        markers (dict): {study_id: marker} as read by read_completion_markers
+        history_file (str): CSV with STUDY_HISTORY_COLUMNS, created if missing
+    
+    Returns:
+        int: Number of studies added or updated
+    """
+    if not markers:
+        return 0
+    
+    history = load_study_history(history_file)
+    for study_id, marker in markers.items():
+        history[study_id] = {column: marker.get(column) for column in STUDY_HISTORY_COLUMNS[1:]}
+    
+    with open(history_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(STUDY_HISTORY_COLUMNS)
+        for study_id, entry in history.items():
+            writer.writerow([study_id] + [entry.get(column) for column in STUDY_HISTORY_COLUMNS[1:]])
+    
+    print(f"Recorded {len(markers)} study durations in {history_file}")
+    return len(markers)
+
+
+def load_study_history(history_file):
+    """Read the study history file into {study_id: {column: value}}, or {} if it does not exist."""
+    history = {}
+    if not history_file or not os.path.exists(history_file):
+        return history
+    with open(history_file, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            history[row['STUDY_ID']] = {column: row.get(column) for column in STUDY_HISTORY_COLUMNS[1:]}
+    return history
+
+
+def estimate_study_costs(urls, history_file=None):
+    """
+    Estimate the relative download time of each study.
+    
+    Studies downloaded before use their recorded duration. The rest use the
+    median recorded duration, scaled by how many rows (accessions) in the
+    cohort point at the same study, since multi-accession studies hold more
+    images. Without any history the costs are in units of one accession.
+    
+    Args:
+        urls (list): Study URLs, possibly repeated once per accession
+        history_file (str): Study history CSV from earlier runs
+    
+    Returns:
+        tuple: ({url: cost}, bool) where the flag tells whether costs are in seconds
+    """
+    history = load_study_history(history_file)
+    accessions = {}
+    for url in urls:
+        accessions[url] = accessions.get(url, 0) + 1
+    
+    durations = {}
+    for url in accessions:
+        entry = history.get(study_id_from_url(url))
+        if entry and entry.get('duration_seconds'):
+            durations[url] = float(entry['duration_seconds'])
+    
+    in_seconds = bool(durations)
+    default = statistics.median(durations.values()) if durations else 1.0
+    costs = {url: durations.get(url, default * count) for url, count in accessions.items()}
+    return costs, in_seconds
+
+
+def planned_curve(costs, slots):
+    """
+    Simulate publishing in the given order onto `slots` parallel workers.
+    
+    Args:
+        costs (list): Study costs in publish order
+        slots (int): Studies processed at once across every instance
+    
+    Returns:
+        dict: {percent: time by which that share of studies is done}
+    """
+    free_at = [0.0] * max(1, slots)
+    finish_times = []
+    for cost in costs:
+        start = heapq.heappop(free_at)
+        finish_times.append(start + cost)
+        heapq.heappush(free_at, start + cost)
+    finish_times.sort()
+    if not finish_times:
+        return {}
+    return {point: finish_times[max(0, -(-point * len(finish_times) // 100) - 1)] for point in CURVE_POINTS}
+
+
+def study_slots():
+    """Studies the deployed service can work on at once."""
+    capacity = current_capacity()
+    return capacity["max_instances"] * capacity["concurrency"]
+
+
+def order_longest_first(urls, history_file=None, plan_file=None, run_path=None):
+    """
+    Order studies longest first so the biggest ones do not start last and stretch the tail.
+    
+    The planned completion curve for both orders is printed and, with
+    plan_file, saved so tracking can compare it to the actual curve. The
+    plan assumes every slot of the fully scaled service is busy from publish.
+    
+    Args:
+        urls (list): Study URLs in CSV order
+        history_file (str): Study history CSV from earlier runs
+        plan_file (str): Where to save the planned curve as JSON
+        run_path (str): Prefix the service writes this run to
+    
+    Returns:
+        list: Unique study URLs, longest first
+    """
+    costs, in_seconds = estimate_study_costs(urls, history_file)
+    csv_order = list(costs)
+    ordered = sorted(csv_order, key=costs.get, reverse=True)
+    
+    slots = study_slots()
+    plan = planned_curve([costs[url] for url in ordered], slots)
+    baseline = planned_curve([costs[url] for url in csv_order], slots)
+    unit = "s" if in_seconds else " units"
+    print(f"Publishing {len(ordered)} studies longest first, planned with all {slots} slots busy "
+          f"({'from run history' if in_seconds else 'no run history, estimating from accessions per study'})")
+    for point in CURVE_POINTS:
+        print(f"  {point:3d}% planned: {plan[point]:.0f}{unit} (CSV order: {baseline[point]:.0f}{unit})")
+    
+    if plan_file:
+        save_publish_plan(plan_file, run_path, plan, in_seconds)
+    return ordered
+
+
+def save_publish_plan(plan_file, run_path, plan=None, in_seconds=False):
+    """
+    Save when and where studies are being published, with the planned curve if there is one.
+    
+    Args:
+        plan_file (str): JSON file to write
+        run_path (str): Prefix the service writes this run to
+        plan (dict): {percent: planned time} from planned_curve
+        in_seconds (bool): The planned times are in seconds rather than relative units
+    """
+    with open(plan_file, 'w') as f:
+        json.dump({
+            "bucket_path": run_path,
+            "published_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "in_seconds": in_seconds,
+            "planned": plan or {},
+        }, f)
+
+
+def report_completion_curve(markers, total, plan_file=None, bucket_path=None):
+    """
+    Print the actual completion curve next to the planned one.
+    
+    Times are measured from when the run was published, using the
+    completed_at time in each study's completion marker. Without a saved
+    publish time for this bucket path, they are measured from when the first
+    study started instead, and no plan is shown.
+    
+    Args:
+        markers (dict): {study_id: marker} of the tracked studies that completed
+        total (int): Number of tracked studies
+        plan_file (str): Publish plan saved by save_publish_plan
+        bucket_path (str): Prefix the tracked run was written to
+    """
+    saved = {}
+    if plan_file and os.path.exists(plan_file):
+        with open(plan_file) as f:
+            saved = json.load(f)
+        if saved.get("bucket_path") != bucket_path or not saved.get("published_at"):
+            saved = {}
+    
+    completion_times = []
+    start_times = []
+    for marker in markers.values():
+        try:
+            completed_at = datetime.datetime.fromisoformat(marker["completed_at"]).timestamp()
+        except (KeyError, TypeError, ValueError):
+            continue
+        completion_times.append(completed_at)
+        start_times.append(completed_at - float(marker.get("duration_seconds") or 0))
+    if not completion_times:
+        print("Completion curve: no completed studies")
+        return
+    completion_times.sort()
+    
+    if saved:
+        start = datetime.datetime.fromisoformat(saved["published_at"]).timestamp()
+        origin = "publish"
+    else:
+        start = min(start_times)
+        origin = "first study start"
+    plan = {}
+    if saved.get("in_seconds"):
+        plan = {int(point): seconds for point, seconds in saved["planned"].items()}
+    
+    print(f"Completion curve (from {origin}):")
+    for point in CURVE_POINTS:
+        needed = -(-point * total // 100)
+        actual = completion_times[needed - 1] - start if needed <= len(completion_times) else None
+        actual_text = f"{actual:.0f}s" if actual is not None else "not reached"
+        planned_text = f", planned {plan[point]:.0f}s" if point in plan else ""
+        print(f"  {point:3d}%: {actual_text}{planned_text}")
+
+
+def finish_tracking(csv_file, bucket_path, auto_cleanup=False, exclude=()):
+    """
+    Track the studies in csv_file to completion and optionally tear down the pipeline.
+    
+    Resources are only cleaned up when every study finished (complete or given
+    up), so a stalled run can still be resumed.
+    
+    Returns:
+        int: 0 if nothing is left pending, 1 otherwise
+    """
+    urls = list(dict.fromkeys(url for url in iter_csv_urls(csv_file) if url not in exclude))
+    output_dir = os.path.dirname(os.path.abspath(csv_file))
+    _, _, remaining = track_completion(
+        urls, bucket_path,
+        poll_interval=CONFIG['cloud_run'].get('track_poll_interval', 60),
+        max_attempts=CONFIG['cloud_run'].get('max_study_attempts', 5),
+        stall_timeout=CONFIG['cloud_run'].get('track_stall_timeout', 3600),
+        incomplete_file=os.path.join(output_dir, "incomplete_studies.csv")
+    )
+    
+    # The completion markers give the actual curve, and their durations order the next run
     try:
-        command = [
-            "gcloud", "run", "services", "describe", cr_name,
-            f"--region={CONFIG['env']['region']}", f"--project={CONFIG['env']['project_id']}",
-            "--format=value(status.url)"
-        ]
-        result = subprocess.run(command, check=True, capture_output=True, text=True)
-        url = result.stdout.strip()
-        if url:
-            return url
-        return None
-    except subprocess.CalledProcessError:
-        return None
+        markers = read_completion_markers(bucket_path)
+        tracked = {study_id_from_url(url) for url in urls}
+        report_completion_curve({study_id: marker for study_id, marker in markers.items() if study_id in tracked},
+                                len(urls), os.path.join(output_dir, "publish_plan.json"), bucket_path)
+        record_study_history(markers, os.path.join(output_dir, "study_history.csv"))
+    except Exception as e:
+        print(f"Warning: Could not read completion markers: {e}")
+    
+    if remaining:
+        return 1
+    if auto_cleanup:
+        cleanup_resources(delete_cloud_run=True)
+    return 0
 
 
-def dicom_download_remote_start(csv_file=None, deploy=False, cleanup=False, bucket_path=None):
+def dicom_download_remote_start(csv_file=None, deploy=False, cleanup=False, bucket_path=None, key_file=None,
+                                publish=True, track=False, auto_cleanup=False, republish_all=False, calibrate=0):
     global CLOUD_RUN_URL
     global PUBLISHER
     global TOPIC_PATH
     
-    PUBLISHER = pubsub_v1.PublisherClient()
+    PUBLISHER = create_publisher()
     TOPIC_PATH = PUBLISHER.topic_path(CONFIG['env']['project_id'], CONFIG['env']['topic_name'])
     
+    # A running service keeps writing to the path it was deployed with
+    if bucket_path is None and not deploy and not cleanup:
+        bucket_path = get_deployed_env().get("BUCKET_PATH")
+        if bucket_path:
+            print(f"Using deployed bucket path: {bucket_path}")
+    
     # Generate a timestamp-based path if not provided
     if bucket_path is None:
         current_time = datetime.datetime.now()
@@ -377,6 +1054,7 @@ def dicom_download_remote_start(csv_file=None, deploy=False, cleanup=False, buck
     # Handle cleanup first - this can be run without other flags
     if cleanup:
         cleanup_resources(delete_cloud_run=True)
+        report_phase_times()
         return 0
     
     # For other operations, we need a CSV file
@@ -385,9 +1063,35 @@ def dicom_download_remote_start(csv_file=None, deploy=False, cleanup=False, buck
         return 1
     
     if deploy:
-        # Build and push the image first, then deploy to Cloud Run
-        build_and_push_image()
-        deploy_cloud_run(bucket_name=CONFIG['storage']['bucket_name'], bucket_path=bucket_path)
+        # The image build, key secret and topic don't depend on each other, so they run together.
+        # The service needs the image and secret, and the push subscription needs the service URL.
+        # A calibration download of a few studies overlaps with the build as well.
+        # The key is loaded once up front: on a first deploy the secret and the calibration would
+        # otherwise each create a different key, and the service and --anon would disagree.
+        key = None
+        if CONFIG['cloud_run'].get('inline_deid') and key_file:
+            from src.encrypt_keys import load_or_create_key
+            key = load_or_create_key(key_file)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            build = executor.submit(build_and_push_image)
+            topic = executor.submit(ensure_topic)
+            secret = None
+            if key:
+                secret = executor.submit(store_encryption_key_secret, key)
+            calibration = None
+            if calibrate:
+                from src.dicom_download_local import calibrate_capacity
+                calibration = executor.submit(calibrate_capacity, csv_file, calibrate, key=key)
+            build.result()
+            topic.result()
+            key_secret = secret.result() if secret else None
+            calibration = calibration.result() if calibration else None
+        
+        if CONFIG['cloud_run'].get('plan_capacity', True):
+            history_file = os.path.join(os.path.dirname(os.path.abspath(csv_file)), "study_history.csv")
+            plan_deployment(csv_file, history_file, calibration)
+        deploy_cloud_run(bucket_name=CONFIG['storage']['bucket_name'], bucket_path=bucket_path, key_secret=key_secret)
+        setup_pubsub()
     elif CLOUD_RUN_URL is None:
         # Try to get the URL of an existing deployment first
         existing_url = get_existing_cloud_run_url()
@@ -399,10 +1103,12 @@ def dicom_download_remote_start(csv_file=None, deploy=False, cleanup=False, buck
             CLOUD_RUN_URL = f"https://{CONFIG['cloud_run']['service']}-243026470979.{CONFIG['env']['region']}.run.app"
             print(f"Using fallback Cloud Run URL: {CLOUD_RUN_URL}")
     
-    if deploy:
-        # Add a brief pause before setting up PubSub to ensure Cloud Run is ready
-        time.sleep(5)
-        setup_pubsub()
+    # Track an earlier run without publishing again
+    if not deploy and not publish:
+        if not track or not csv_file or not os.path.exists(csv_file):
+            print("Error: --track needs the CSV of published studies")
+            return 1
+        return finish_tracking(csv_file, bucket_path, auto_cleanup)
     
     # Wake up the service before processing messages
     if csv_file and os.path.exists(csv_file):
@@ -410,11 +1116,18 @@ def dicom_download_remote_start(csv_file=None, deploy=False, cleanup=False, buck
         wake_up_service()
         
         # Now process the CSV file
-        process_csv_file(csv_file)
+        failed_file = os.path.join(os.path.dirname(os.path.abspath(csv_file)), "failed_publish.csv")
+        # A fresh deployment writes to a new path, so only reruns can skip stored studies
+        delta_path = None if deploy or republish_all else bucket_path
+        with timed_phase("publish"):
+            published, failed = process_csv_file(csv_file, failed_file=failed_file, bucket_path=delta_path,
+                                                 run_path=bucket_path)
+        report_phase_times()
         
-        # Wait a bit to allow processing to complete
-        print("Waiting 20 seconds for message processing to complete...")
-        time.sleep(20)
+        if track:
+            failed_urls = {url for url, _ in failed}
+            return finish_tracking(csv_file, bucket_path, auto_cleanup, exclude=failed_urls)
+        print(f"Published {published} studies. Progress can be followed with --track")
     elif csv_file:
         print(f"Error: CSV file not found: {csv_file}")
         return 1
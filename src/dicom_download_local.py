@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+import base64
+import datetime
+import csv
+import glob
+import json
+import os
+import statistics
+import tempfile
+import sys
+import time
+import threading
+import tqdm
+
+# Add parent directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import CONFIG
+from src.dicom_download import FASTAPI_DIR, COMPLETION_MARKER, iter_csv_urls, inline_deid_environment
+
+
+# Seconds between memory samples during calibration
+RSS_SAMPLE_INTERVAL = 0.1
+# Less growth than this per study is measurement noise, not a usable estimate
+MIN_CALIBRATED_STUDY_MB = 5
+
+
+def current_rss_mb():
+    """Current resident set size of this process in MB, or None where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def configure_local_service(workers, qps, bucket_path, key=None):
+    """
+    Set the download service's settings for this process and import its retrieval code.
+
+    The service reads its settings from the environment when its modules are
+    imported, so this has to run before anything imports them. With
+    cloud_run.inline_deid set, studies are de-identified at ingest exactly as
+    on Cloud Run, with the given key.
+
+    Args:
+        workers (int): Studies downloaded at once
+        qps (float): DICOMweb requests per second, 0 for no limit
+        bucket_path (str): Prefix studies are written under
+        key (bytes): ID encryption key, required with cloud_run.inline_deid
+
+    Returns:
+        module: app.pull_worker, ready to run
+    """
+    if 'app.retrieval' in sys.modules:
+        print("Warning: Download service already imported, --workers and --qps may not apply")
+
+    os.environ["MAX_CONCURRENT_STUDIES"] = str(workers)
+    os.environ["DICOMWEB_QPS"] = str(qps)
+    os.environ["DICOMWEB_INSTANCES"] = "1"
+    os.environ["MAX_STUDY_ATTEMPTS"] = str(CONFIG['cloud_run'].get('max_study_attempts', 5))
+    os.environ["METRICS_LOG_INTERVAL"] = "0"
+    if CONFIG['cloud_run'].get('retrieve_by_instance'):
+        os.environ["RETRIEVE_BY_INSTANCE"] = "true"
+
+    if CONFIG['cloud_run'].get('inline_deid'):
+        if not key:
+            raise ValueError("cloud_run.inline_deid is set, but no encryption key was given")
+        os.environ.update(inline_deid_environment(bucket_path))
+        os.environ["DICOM_ENCRYPTION_KEY"] = base64.b64encode(key).decode()
+
+    if FASTAPI_DIR not in sys.path:
+        sys.path.insert(0, FASTAPI_DIR)
+    import app.pull_worker as pull_worker
+    return pull_worker
+
+
+def dicom_download_local_start(csv_file, destination=None, workers=8, qps=0, bucket_path=None, key_file=None):
+    """
+    Download the studies in csv_file from this machine, without Cloud Run or Pub/Sub.
+
+    Studies are fed through an in-memory queue to a local worker pool that
+    runs the same retrieval code as the Cloud Run service, so objects,
+    completion markers and failure handling are identical.
+
+    Args:
+        csv_file (str): CSV with an ENDPOINT_ADDRESS column
+        destination (str): Local directory to write to; the configured bucket if None
+        workers (int): Studies downloaded at once
+        qps (float): DICOMweb requests per second, 0 for no limit
+        bucket_path (str): Prefix to write under; timestamped if None
+        key_file (str): Pickled ID encryption key, used with cloud_run.inline_deid
+
+    Returns:
+        int: 0 if every study was stored, 1 otherwise
+    """
+    if not csv_file or not os.path.exists(csv_file):
+        print(f"Error: CSV file not found: {csv_file}")
+        return 1
+
+    if bucket_path is None:
+        timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S")
+        bucket_path = f"{CONFIG['storage']['download_path']}/{timestamp}"
+
+    key = None
+    if CONFIG['cloud_run'].get('inline_deid') and key_file:
+        from src.encrypt_keys import load_or_create_key
+        key = load_or_create_key(key_file)
+    pull_worker = configure_local_service(workers, qps, bucket_path, key)
+    from app.local_storage import LOCAL_BUCKET_PREFIX
+    from app.retrieval import METRICS, DICOMWEB
+
+    if destination:
+        bucket_name = LOCAL_BUCKET_PREFIX + os.path.abspath(destination)
+    else:
+        bucket_name = CONFIG['storage']['bucket_name']
+
+    urls = list(dict.fromkeys(iter_csv_urls(csv_file)))
+    print(f"Downloading {len(urls)} studies locally to {bucket_name}/{bucket_path} "
+          f"with {workers} workers{f', {qps:g} DICOMweb requests/s' if qps else ''}")
+
+    start_time = time.time()
+    results = []
+    runner = threading.Thread(
+        target=lambda: results.extend(pull_worker.run_in_memory(urls, bucket_name, bucket_path, workers=workers)),
+        daemon=True
+    )
+    runner.start()
+
+    with tqdm.tqdm(total=len(urls), desc="Studies downloaded") as pbar:
+        while runner.is_alive():
+            runner.join(timeout=1)
+            snapshot = METRICS.snapshot()
+            pbar.n = min(len(urls), snapshot["studies_completed"])
+            pbar.set_postfix(failed_attempts=snapshot["studies_failed"], instances=snapshot["instances_stored"])
+            pbar.refresh()
+
+    elapsed = time.time() - start_time
+    snapshot = METRICS.snapshot()
+    failed = [url for url, success in results if not success]
+    print(f"Stored {len(urls) - len(failed)} of {len(urls)} studies in {elapsed:.1f} seconds "
+          f"({snapshot['studies_skipped']} already complete), {snapshot['instances_stored']} instances, "
+          f"{snapshot['bytes_stored'] / 1e9:.2f} GB")
+    print(f"DICOMweb: {DICOMWEB.stats()}")
+
+    if failed:
+        failed_file = os.path.join(os.path.dirname(os.path.abspath(csv_file)), "failed_local.csv")
+        with open(failed_file, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['ENDPOINT_ADDRESS'])
+            for url in failed:
+                writer.writerow([url])
+        print(f"Wrote {len(failed)} failed studies to {failed_file}")
+        return 1
+    return 0
+
+
+def calibrate_capacity(csv_file, sample_size=10, workers=4, key=None):
+    """
+    Download a few studies locally to measure per-study time and memory for the capacity planner.
+
+    The sample is written to a temporary directory and discarded. Times are
+    measured from this machine, so they approximate Cloud Run rather than
+    match it.
+
+    Args:
+        csv_file (str): CSV with an ENDPOINT_ADDRESS column
+        sample_size (int): Studies to download
+        workers (int): Studies downloaded at once
+        key (bytes): ID encryption key, used with cloud_run.inline_deid
+
+    Returns:
+        dict or None: 'study_seconds', and 'study_memory_mb' if memory growth could be
+        measured, or None if nothing was stored
+    """
+    pull_worker = configure_local_service(workers, 0, "calibration", key)
+    from app.local_storage import LOCAL_BUCKET_PREFIX
+
+    urls = list(dict.fromkeys(iter_csv_urls(csv_file)))[:sample_size]
+    print(f"Calibrating on {len(urls)} studies with {workers} workers...")
+
+    # ru_maxrss is a peak over the whole process, so sample the current RSS while the sample runs
+    rss_before = current_rss_mb()
+    rss_peak = [rss_before or 0.0]
+    done = threading.Event()
+
+    def sample_rss():
+        while not done.wait(RSS_SAMPLE_INTERVAL):
+            rss_peak[0] = max(rss_peak[0], current_rss_mb() or 0.0)
+
+    sampler = threading.Thread(target=sample_rss, daemon=True)
+    sampler.start()
+    try:
+        with tempfile.TemporaryDirectory(prefix="calibration-") as root:
+            pull_worker.run_in_memory(urls, LOCAL_BUCKET_PREFIX + root, "calibration", workers=workers)
+            durations = []
+            for marker_path in glob.glob(os.path.join(root, "calibration", "*", COMPLETION_MARKER)):
+                with open(marker_path) as f:
+                    durations.append(json.load(f)["duration_seconds"])
+    finally:
+        done.set()
+        sampler.join()
+
+    if not durations:
+        print("Calibration stored no studies, planning from history instead")
+        return None
+
+    calibration = {"study_seconds": statistics.median(durations)}
+    if rss_before is not None:
+        study_memory_mb = (rss_peak[0] - rss_before) / min(workers, len(urls))
+        if study_memory_mb >= MIN_CALIBRATED_STUDY_MB:
+            calibration["study_memory_mb"] = study_memory_mb
+    if "study_memory_mb" in calibration:
+        memory = f"about {calibration['study_memory_mb']:.0f} MB per study in flight"
+    else:
+        memory = "memory use too small to measure, planning memory from history instead"
+    print(f"Calibration: {len(durations)} studies, median {calibration['study_seconds']:.1f}s, {memory}")
+    return calibration
@@ -1,15 +1,21 @@
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.backends import default_backend
 import os
-import csv
+import re
 import pickle
-import struct
+import pandas as pd
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 
 # Add parent directory to path
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from config import CONFIG
+from src.id_crypto import ff1_encrypt, encrypt_single_id, key_fingerprint, KeyedIdEncryptor, get_id_encryptor
+# The ID cache lives in id_crypto so the download service shares it
+from src.id_crypto import (
+    encrypt_id_cached, encrypt_id_batch_cached, get_id_cache_stats, clear_id_cache,
+    attach_id_store, flush_id_store, ID_CACHE_MAX_SIZE,
+)
 
 
 def generate_key():
@@ -65,83 +71,6 @@ def get_encryption_key():
     return key
 
 
-def ff1_encrypt(key, number, domain_size):
-    """
-    Format-preserving encryption using a simplified FF1-based approach.
-    This guarantees a permutation (no collisions) for the given domain size.
-    """
-    # Convert number to bytes for encryption
-    number_bytes = str(number).encode()
-    
-    # Create a deterministic IV based on domain size
-    iv = struct.pack('<Q', domain_size) + struct.pack('<Q', 0)
-    
-    # Create and use cipher in ECB mode for simplicity
-    cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
-    encryptor = cipher.encryptor()
-    
-    # Pad the number bytes to ensure it's a multiple of 16
-    padded = number_bytes + b'\0' * (16 - len(number_bytes) % 16)
-    
-    # Encrypt the padded bytes
-    encrypted_bytes = encryptor.update(padded) + encryptor.finalize()
-    
-    # Convert to an integer and take modulo to ensure it's within domain
-    encrypted_int = int.from_bytes(encrypted_bytes, byteorder='big')
-    
-    # Ensure the result is within the domain size, maintaining format
-    domain_max = 10 ** len(str(number)) - 1
-    result = (encrypted_int % domain_max) + 1  # Ensure non-zero
-    
-    # Handle leading zeros by padding with zeros
-    return str(result).zfill(len(str(number)))
-
-def encrypt_single_id(key, id_value):
-    """Encrypt a single ID value using the provided key.
-    
-    Args:
-        key: The encryption key
-        id_value: The ID to encrypt (string or integer)
-        
-    Returns:
-        Encrypted ID value as a string
-    """
-    # Handle hyphenated values
-    if '-' in str(id_value):
-        parts = str(id_value).split('-')
-        encrypted_parts = []
-        
-        for part in parts:
-            if part.strip().isdigit():
-                num = int(part.strip())
-                part_length = len(str(num))
-                
-                # Get domain size based on input length
-                domain_size = 10 ** part_length
-                
-                encrypted_part = ff1_encrypt(key, num, domain_size)
-                encrypted_parts.append(encrypted_part)
-            else:
-                encrypted_parts.append(part)
-                
-        return '-'.join(encrypted_parts)
-    else:
-        # Handle numeric IDs
-        try:
-            num = int(str(id_value).strip())
-            num_length = len(str(num))
-            
-            # Get domain size based on input length
-            domain_size = 10 ** num_length
-            
-            encrypted_value = ff1_encrypt(key, num, domain_size)
-            return encrypted_value
-        except ValueError:
-            # Return original for non-numeric values
-            return str(id_value)
-
-
-
 def anonymize_date(date_str):
     """
     Anonymize a date by removing the day information, keeping only year and month.
@@ -171,126 +100,163 @@ def anonymize_date(date_str):
         print(f"Warning: Couldn't anonymize date '{date_str}' - unexpected format")
         return date_str
 
-def encrypt_ids(input_file=None, output_file_gcp=None, output_file_local=None, key_output=None):
+# Columns dropped from the anonymized CSV
+ANON_COLUMNS_TO_REMOVE = ["ENDPOINT_ADDRESS", "path_interpretation", "Pathology_Laterality", "final_diag", "STUDY_ID"]
+ANON_DATE_COLUMNS = ["BIRTH_DATE", "DEATH_DATE"]
+FINAL_INTERP_PATTERN = re.compile(r'([A-Z]+)\d+')
+# Mirrors anonymize_date: the text before the first space must split into exactly 3 parts on '-'
+DATE_PATTERN = re.compile(r'\A([^ \-]*)-([^ \-]*)-[^ \-]*(?: [\s\S]*)?\Z')
+
+
+def anonymize_date_column(values):
+    """
+    Vectorized anonymize_date for a column of date strings.
     
-    # Ensure output folder exists for local file
-    if output_file_local:
-        output_dir = os.path.dirname(output_file_local)
-        os.makedirs(output_dir, exist_ok=True)
+    Args:
+        values (pandas.Series): Date strings
+        
+    Returns:
+        pandas.Series: Dates in 'YYYY-MM-01' format, unexpected values unchanged
+    """
+    matched = values.str.match(DATE_PATTERN)
+    unexpected = values[~matched & (values != '') & (values.str.lower() != 'none')]
+    for value in unexpected:
+        print(f"Warning: Couldn't anonymize date '{value}' - unexpected format")
     
+    return values.str.replace(DATE_PATTERN, r'\1-\2-01', regex=True)
+
+
+def encrypt_id_column(key, values):
+    """
+    Encrypt a column of IDs through the batched ID cache.
+    
+    Args:
+        key: The encryption key
+        values (pandas.Series): Raw IDs
+        
+    Returns:
+        pandas.Series: Encrypted IDs
+    """
+    try:
+        encrypted = encrypt_id_batch_cached(key, values.to_numpy())
+    except ValueError:
+        # Fall back to one ID at a time, keeping IDs that cannot be encrypted
+        encrypted = []
+        for value in values:
+            try:
+                encrypted.append(encrypt_id_cached(key, value))
+            except ValueError:
+                encrypted.append(value)
+    return pd.Series(encrypted, index=values.index)
+
+
+def load_or_create_key(key_output):
+    """Load the pickled encryption key from key_output, generating and saving one if needed."""
     # Check if the key file already exists and load it
     if os.path.exists(key_output):
         try:
             with open(key_output, 'rb') as key_file:
                 key = pickle.load(key_file)
             print(f"Using existing encryption key from {key_output}")
+            return key
         except Exception as e:
             print(f"Error loading existing key: {e}")
-            key = generate_key()
-            # Save the new key
-            with open(key_output, 'wb') as key_file:
-                pickle.dump(key, key_file)
-            print(f"Generated new encryption key and saved to {key_output}")
-    else:
-        # Generate a single key for all columns
-        key = generate_key()
-        # Save the key to a separate file
-        with open(key_output, 'wb') as key_file:
-            pickle.dump(key, key_file)
-        print(f"Generated new encryption key and saved to {key_output}")
+    
+    # Generate a single key for all columns and save it to a separate file
+    key = generate_key()
+    with open(key_output, 'wb') as key_file:
+        pickle.dump(key, key_file)
+    print(f"Generated new encryption key and saved to {key_output}")
+    return key
 
-    with open(input_file, 'r') as infile, open(output_file_local, 'w', newline='') as outfile:
-        reader = csv.reader(infile)
-        writer = csv.writer(outfile)
-        
-        # Read header
-        header = next(reader)
-        
-        # Columns to remove
-        columns_to_remove = ["ENDPOINT_ADDRESS", "path_interpretation", "Pathology_Laterality", "final_diag", "STUDY_ID"]
-        
-        # Find indices of columns to remove
-        columns_to_remove_indices = []
-        for col in columns_to_remove:
-            try:
-                columns_to_remove_indices.append(header.index(col))
-            except ValueError:
-                pass
-        
-        # Find index of final_interpretation column
-        final_interp_index = -1
-        try:
-            final_interp_index = header.index("final_interpretation")
-        except ValueError:
-            pass
-        
-        # Create new header by excluding columns to remove
-        new_header = [col for i, col in enumerate(header) if i not in columns_to_remove_indices]
-        writer.writerow(new_header)
-        
-        # Find indices of date columns to be anonymized
-        birth_date_index = -1
-        death_date_index = -1
-        
-        try:
-            birth_date_index = header.index("BIRTH_DATE")
-        except ValueError:
-            pass
-            
-        try:
-            death_date_index = header.index("DEATH_DATE")
-        except ValueError:
-            pass
-            
-        for row in reader:
-            encrypted_row = []
-            
-            for i, value in enumerate(row):
-                # Skip the columns to remove
-                if i in columns_to_remove_indices:
-                    continue
-                    
-                if i <= 1:  # Process the first two columns (IDs)
-                    try:
-                        encrypted_value = encrypt_single_id(key, value)
-                        encrypted_row.append(encrypted_value)
-                    except ValueError:
-                        # Handle non-integer values
-                        encrypted_row.append(value)
-                elif i == birth_date_index or i == death_date_index:
-                    # Anonymize date columns
-                    anonymized_date = anonymize_date(value)
-                    encrypted_row.append(anonymized_date)
-                elif i == final_interp_index:
-                    # Simplify final_interpretation by removing the number at the end
-                    # Matches patterns like "BENIGN2", "MALIGNANT3" etc.
-                    import re
-                    simplified_value = re.sub(r'([A-Z]+)\d+', r'\1', value)
-                    encrypted_row.append(simplified_value)
-                else:
-                    # Keep any other columns unchanged
-                    encrypted_row.append(value)
-            
-            writer.writerow(encrypted_row)
 
-    print(f"Encryption and date anonymization complete. Output saved locally to {output_file_local}")
+def encrypt_ids(input_file=None, output_file_gcp=None, output_file_local=None, key_output=None, id_store_path=None, chunk_size=50000, max_workers=None):
     
+    # Ensure output folder exists for local file
+    if output_file_local:
+        output_dir = os.path.dirname(output_file_local)
+        os.makedirs(output_dir, exist_ok=True)
+    
+    key = load_or_create_key(key_output)
+    
+    # Reuse IDs encrypted by earlier runs with the same key
+    if id_store_path:
+        from src.id_store import IdMappingStore
+        attach_id_store(IdMappingStore(id_store_path, key))
 
-    # Upload to GCS if output_file_gcp is specified
+    header = list(pd.read_csv(input_file, nrows=0, dtype=str).columns)
+    new_header = [col for col in header if col not in ANON_COLUMNS_TO_REMOVE]
+    
+    # The first two columns hold the patient and accession IDs
+    id_columns = [col for col in header[:2] if col in new_header]
+    date_columns = [col for col in ANON_DATE_COLUMNS if col in new_header and col not in id_columns]
+    interp_column = "final_interpretation" if "final_interpretation" in new_header and "final_interpretation" not in id_columns else None
+    
+    def anonymize_chunk(chunk):
+        chunk = chunk[new_header].copy()
+        for col in id_columns:
+            chunk[col] = encrypt_id_column(key, chunk[col])
+        for col in date_columns:
+            chunk[col] = anonymize_date_column(chunk[col])
+        if interp_column:
+            # Simplify final_interpretation by removing the number at the end
+            # Matches patterns like "BENIGN2", "MALIGNANT3" etc.
+            chunk[interp_column] = chunk[interp_column].str.replace(FINAL_INTERP_PATTERN, r'\1', regex=True)
+        return chunk.to_csv(index=False, header=False, lineterminator='\r\n')
+    
+    # Stream the output straight to the bucket while the local copy is written
+    upload_stream = None
     if output_file_gcp:
         from google.cloud import storage
         
-        # Get the bucket using the CONFIG variable
         client = storage.Client()
         bucket = client.bucket(CONFIG["storage"]["bucket_name"])
-        
-        # Determine the blob name - this is the path within the bucket
-        blob_name = f"{output_file_gcp}"
-        
-        # Upload the file to GCS
-        blob_name = os.path.normpath(blob_name)
+        blob_name = os.path.normpath(f"{output_file_gcp}")
         blob = bucket.blob(blob_name)
-        blob.upload_from_filename(output_file_local)
+        upload_stream = blob.open('wb', content_type='text/csv', ignore_flush=True)
+    
+    def write_text(outfile, text):
+        outfile.write(text)
+        if upload_stream:
+            upload_stream.write(text.encode('utf-8'))
+    
+    max_workers = max_workers or os.cpu_count()
+    total_rows = 0
+    
+    try:
+        with open(output_file_local, 'w', newline='') as outfile:
+            write_text(outfile, pd.DataFrame(columns=new_header).to_csv(index=False, lineterminator='\r\n'))
+            
+            reader = pd.read_csv(input_file, dtype=str, keep_default_na=False, chunksize=chunk_size)
+            
+            # Anonymize chunks in parallel, writing them out in input order
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                pending = deque()
+                for chunk in reader:
+                    total_rows += len(chunk)
+                    pending.append(executor.submit(anonymize_chunk, chunk))
+                    if len(pending) >= max_workers * 2:
+                        write_text(outfile, pending.popleft().result())
+                while pending:
+                    write_text(outfile, pending.popleft().result())
+    except BaseException:
+        # Closing the writer would finalize a partial object, so its upload session is
+        # cancelled instead, and the half-written local file is removed
+        if upload_stream:
+            upload_stream.terminate()
+        if os.path.exists(output_file_local):
+            os.remove(output_file_local)
+        raise
+
+    print(f"Encryption and date anonymization complete for {total_rows} rows. Output saved locally to {output_file_local}")
+    
+    cache_stats = get_id_cache_stats()
+    print(f"ID cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses ({cache_stats['hit_rate']:.1%} hit rate), {cache_stats['store_hits']} served from ID store")
+    flush_id_store()
+
+    # Finalize the upload only once every chunk has been written
+    if upload_stream:
+        upload_stream.close()
         print(f"File uploaded to gs://{CONFIG['storage']['bucket_name']}/{blob_name}")
     
     return key
\ No newline at end of file
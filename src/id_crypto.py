@@ -0,0 +1,377 @@
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.backends import default_backend
+import struct
+import hashlib
+import threading
+import functools
+from collections import OrderedDict
+import numpy as np
+
+
+def ff1_encrypt(key, number, domain_size):
+    """
+    Format-preserving encryption using a simplified FF1-based approach.
+    This guarantees a permutation (no collisions) for the given domain size.
+    """
+    # Convert number to bytes for encryption
+    number_bytes = str(number).encode()
+    
+    # Create a deterministic IV based on domain size
+    iv = struct.pack('<Q', domain_size) + struct.pack('<Q', 0)
+    
+    # Create and use cipher in ECB mode for simplicity
+    cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
+    encryptor = cipher.encryptor()
+    
+    # Pad the number bytes to ensure it's a multiple of 16
+    padded = number_bytes + b'\0' * (16 - len(number_bytes) % 16)
+    
+    # Encrypt the padded bytes
+    encrypted_bytes = encryptor.update(padded) + encryptor.finalize()
+    
+    # Convert to an integer and take modulo to ensure it's within domain
+    encrypted_int = int.from_bytes(encrypted_bytes, byteorder='big')
+    
+    # Ensure the result is within the domain size, maintaining format
+    domain_max = 10 ** len(str(number)) - 1
+    result = (encrypted_int % domain_max) + 1  # Ensure non-zero
+    
+    # Handle leading zeros by padding with zeros
+    return str(result).zfill(len(str(number)))
+
+def encrypt_single_id(key, id_value):
+    """Encrypt a single ID value using the provided key.
+    
+    Args:
+        key: The encryption key
+        id_value: The ID to encrypt (string or integer)
+        
+    Returns:
+        Encrypted ID value as a string
+    """
+    # Handle hyphenated values
+    if '-' in str(id_value):
+        parts = str(id_value).split('-')
+        encrypted_parts = []
+        
+        for part in parts:
+            if part.strip().isdigit():
+                num = int(part.strip())
+                part_length = len(str(num))
+                
+                # Get domain size based on input length
+                domain_size = 10 ** part_length
+                
+                encrypted_part = ff1_encrypt(key, num, domain_size)
+                encrypted_parts.append(encrypted_part)
+            else:
+                encrypted_parts.append(part)
+                
+        return '-'.join(encrypted_parts)
+    else:
+        # Handle numeric IDs
+        try:
+            num = int(str(id_value).strip())
+            num_length = len(str(num))
+            
+            # Get domain size based on input length
+            domain_size = 10 ** num_length
+            
+            encrypted_value = ff1_encrypt(key, num, domain_size)
+            return encrypted_value
+        except ValueError:
+            # Return original for non-numeric values
+            return str(id_value)
+
+
+@functools.lru_cache(maxsize=16)
+def key_fingerprint(key):
+    """Return a short, non-reversible fingerprint identifying an encryption key."""
+    return hashlib.sha256(key).hexdigest()[:16]
+
+
+class KeyedIdEncryptor:
+    """Encrypts IDs under a single key, reusing the AES context between calls.
+    
+    Output is identical to encrypt_single_id. ff1_encrypt pads numbers of up to
+    15 digits to one block, and single-block AES-CBC is AES-ECB applied to
+    (block XOR IV). Since the IV only depends on the digit count, every number
+    of the same length can be encrypted with one ECB call. Longer numbers fall
+    back to ff1_encrypt.
+    """
+    
+    def __init__(self, key):
+        self.key = key
+        self.fingerprint = key_fingerprint(key)
+        self._cipher = Cipher(algorithms.AES(key), modes.ECB(), backend=default_backend())
+        self._local = threading.local()  # cipher contexts are not thread-safe
+    
+    def _encryptor(self):
+        encryptor = getattr(self._local, 'encryptor', None)
+        if encryptor is None:
+            encryptor = self._cipher.encryptor()
+            self._local.encryptor = encryptor
+        return encryptor
+    
+    def encrypt_numbers(self, numbers):
+        """Encrypt non-negative integers, grouped by digit length.
+        
+        Args:
+            numbers: Sequence of non-negative integers
+            
+        Returns:
+            list: Encrypted values as zero-padded strings, in input order
+        """
+        results = [None] * len(numbers)
+        
+        groups = {}
+        for i, num in enumerate(numbers):
+            digits = str(num)
+            groups.setdefault(len(digits), []).append((i, digits))
+        
+        for length, items in groups.items():
+            if length > 15:
+                # Multi-block CBC chains blocks, use the reference implementation
+                for i, digits in items:
+                    results[i] = ff1_encrypt(self.key, int(digits), 10 ** length)
+                continue
+            
+            iv = np.frombuffer(struct.pack('<Q', 10 ** length) + struct.pack('<Q', 0), dtype=np.uint8)
+            padded = b''.join(digits.encode().ljust(16, b'\0') for _, digits in items)
+            blocks = np.frombuffer(padded, dtype=np.uint8).reshape(-1, 16) ^ iv
+            
+            encrypted = self._encryptor().update(blocks.tobytes())
+            
+            domain_max = 10 ** length - 1
+            for j, (i, _) in enumerate(items):
+                encrypted_int = int.from_bytes(encrypted[j * 16:(j + 1) * 16], byteorder='big')
+                results[i] = str((encrypted_int % domain_max) + 1).zfill(length)
+        
+        return results
+    
+    def encrypt_many(self, id_values):
+        """Encrypt a batch of IDs, matching encrypt_single_id for each one.
+        
+        Args:
+            id_values: Sequence or NumPy array of IDs (strings or integers)
+            
+        Returns:
+            list: Encrypted ID values as strings, in input order
+        """
+        numbers = []
+        plans = []
+        
+        # Split every ID into literal segments and numbers to encrypt
+        for id_value in id_values:
+            text = str(id_value)
+            if '-' in text:
+                plan = []
+                for part in text.split('-'):
+                    if part.strip().isdigit():
+                        plan.append(len(numbers))
+                        numbers.append(int(part.strip()))
+                    else:
+                        plan.append(part)
+                plans.append(plan)
+            else:
+                try:
+                    num = int(text.strip())
+                except ValueError:
+                    # Non-numeric values are returned unchanged
+                    plans.append(text)
+                    continue
+                plans.append([len(numbers)])
+                numbers.append(num)
+        
+        encrypted = self.encrypt_numbers(numbers)
+        
+        results = []
+        for plan in plans:
+            if isinstance(plan, str):
+                results.append(plan)
+            else:
+                results.append('-'.join(encrypted[p] if isinstance(p, int) else p for p in plan))
+        return results
+    
+    def encrypt(self, id_value):
+        """Encrypt a single ID, equivalent to encrypt_single_id(key, id_value)."""
+        return self.encrypt_many([id_value])[0]
+
+
+@functools.lru_cache(maxsize=16)
+def get_id_encryptor(key):
+    """Return the shared KeyedIdEncryptor for a key."""
+    return KeyedIdEncryptor(key)
+
+
+# Bounded LRU cache of encrypted IDs, shared by every thread in the process.
+# Every instance in a study carries the same PatientID and AccessionNumber,
+# so most lookups during deidentification are hits.
+ID_CACHE_MAX_SIZE = 100000
+_ID_CACHE = OrderedDict()
+_ID_CACHE_LOCK = threading.Lock()
+_ID_CACHE_STATS = {"hits": 0, "misses": 0, "store_hits": 0}
+
+# Optional persistent mapping store (see src/id_store.py). Cache misses are
+# served from its read-only snapshot, and newly encrypted IDs are queued until
+# flush_id_store writes them back from the main thread.
+_ID_STORE = None
+_ID_STORE_SNAPSHOT = {}
+_ID_STORE_PENDING = {}
+
+
+def encrypt_id_cached(key, id_value):
+    """Memoized version of encrypt_single_id.
+    
+    Results are cached on (key fingerprint, raw ID) so the same ID is only
+    encrypted once per run, no matter how many DICOMs or CSV rows carry it.
+    
+    Args:
+        key: The encryption key
+        id_value: The ID to encrypt (string or integer)
+        
+    Returns:
+        Encrypted ID value as a string
+    """
+    fingerprint = key_fingerprint(key)
+    cache_key = (fingerprint, str(id_value))
+    use_store = _ID_STORE is not None and _ID_STORE.fingerprint == fingerprint
+    
+    with _ID_CACHE_LOCK:
+        if cache_key in _ID_CACHE:
+            _ID_CACHE.move_to_end(cache_key)
+            _ID_CACHE_STATS["hits"] += 1
+            return _ID_CACHE[cache_key]
+        _ID_CACHE_STATS["misses"] += 1
+    
+    encrypted_value = _ID_STORE_SNAPSHOT.get(str(id_value)) if use_store else None
+    
+    if encrypted_value is not None:
+        with _ID_CACHE_LOCK:
+            _ID_CACHE_STATS["store_hits"] += 1
+    else:
+        # Encrypt outside the lock so other threads are not blocked
+        encrypted_value = get_id_encryptor(key).encrypt(id_value)
+        if use_store:
+            with _ID_CACHE_LOCK:
+                _ID_STORE_PENDING[str(id_value)] = encrypted_value
+    
+    with _ID_CACHE_LOCK:
+        _ID_CACHE[cache_key] = encrypted_value
+        _ID_CACHE.move_to_end(cache_key)
+        while len(_ID_CACHE) > ID_CACHE_MAX_SIZE:
+            _ID_CACHE.popitem(last=False)
+    
+    return encrypted_value
+
+
+def encrypt_id_batch_cached(key, id_values):
+    """Batched version of encrypt_id_cached.
+    
+    Every distinct ID is looked up in the cache (and attached ID store) once,
+    and all misses are encrypted together with KeyedIdEncryptor.encrypt_many.
+    Hit and miss counts are per distinct ID.
+    
+    Args:
+        key: The encryption key
+        id_values: Sequence or NumPy array of IDs
+        
+    Returns:
+        list: Encrypted ID values as strings, in input order
+    """
+    fingerprint = key_fingerprint(key)
+    use_store = _ID_STORE is not None and _ID_STORE.fingerprint == fingerprint
+    texts = [str(id_value) for id_value in id_values]
+    
+    results = {}
+    misses = []
+    with _ID_CACHE_LOCK:
+        for text in dict.fromkeys(texts):
+            cache_key = (fingerprint, text)
+            if cache_key in _ID_CACHE:
+                _ID_CACHE.move_to_end(cache_key)
+                results[text] = _ID_CACHE[cache_key]
+            else:
+                misses.append(text)
+        _ID_CACHE_STATS["hits"] += len(results)
+        _ID_CACHE_STATS["misses"] += len(misses)
+    
+    to_encrypt = []
+    store_hits = 0
+    for text in misses:
+        stored = _ID_STORE_SNAPSHOT.get(text) if use_store else None
+        if stored is not None:
+            results[text] = stored
+            store_hits += 1
+        else:
+            to_encrypt.append(text)
+    
+    encrypted = get_id_encryptor(key).encrypt_many(to_encrypt)
+    
+    with _ID_CACHE_LOCK:
+        _ID_CACHE_STATS["store_hits"] += store_hits
+        for text, encrypted_value in zip(to_encrypt, encrypted):
+            results[text] = encrypted_value
+            if use_store:
+                _ID_STORE_PENDING[text] = encrypted_value
+        for text in misses:
+            _ID_CACHE[(fingerprint, text)] = results[text]
+        while len(_ID_CACHE) > ID_CACHE_MAX_SIZE:
+            _ID_CACHE.popitem(last=False)
+    
+    return [results[text] for text in texts]
+
+
+def get_id_cache_stats():
+    """Return a snapshot of the ID cache hit/miss counters and current size."""
+    with _ID_CACHE_LOCK:
+        stats = dict(_ID_CACHE_STATS)
+        stats["size"] = len(_ID_CACHE)
+    total = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / total if total else 0.0
+    return stats
+
+
+def clear_id_cache():
+    """Empty the ID cache and reset its counters."""
+    with _ID_CACHE_LOCK:
+        _ID_CACHE.clear()
+        for name in _ID_CACHE_STATS:
+            _ID_CACHE_STATS[name] = 0
+
+
+def attach_id_store(store):
+    """
+    Serve ID cache misses from a persistent IdMappingStore.
+    
+    The store's current contents are loaded once into a read-only snapshot
+    that all worker threads share.
+    """
+    global _ID_STORE, _ID_STORE_SNAPSHOT
+    with _ID_CACHE_LOCK:
+        _ID_STORE = store
+        _ID_STORE_SNAPSHOT = store.snapshot()
+        _ID_STORE_PENDING.clear()
+    print(f"Loaded {len(_ID_STORE_SNAPSHOT)} stored ID mappings from {store.db_path}")
+
+
+def flush_id_store():
+    """
+    Write IDs encrypted since the last flush to the attached store.
+    
+    Returns:
+        int: Number of new mappings written
+    """
+    if _ID_STORE is None:
+        return 0
+    
+    with _ID_CACHE_LOCK:
+        pending = dict(_ID_STORE_PENDING)
+        _ID_STORE_PENDING.clear()
+    
+    if not pending:
+        return 0
+    
+    inserted, collisions = _ID_STORE.add_many(pending)
+    print(f"Saved {inserted} new ID mappings to {_ID_STORE.db_path}")
+    return inserted
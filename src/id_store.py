@@ -0,0 +1,182 @@
+import os
+import sqlite3
+import datetime
+from types import MappingProxyType
+from src.encrypt_keys import key_fingerprint
+
+
+def id_domain(id_value):
+    """
+    Describe the digit-length domain of an ID, e.g. '8' or '4-7'.
+
+    Encrypted IDs can only collide with IDs from the same domain, since
+    encryption preserves the length of every numeric part.
+    """
+    return '-'.join(str(len(part)) if part.isdigit() else 'x' for part in str(id_value).split('-'))
+
+
+def canonical_id(id_value):
+    """
+    Normalize a raw ID the same way encrypt_single_id parses it.
+
+    Raw IDs such as '0123' and '123' encrypt to the same value by design,
+    so collisions are only reported between different canonical IDs.
+    """
+    text = str(id_value)
+    if '-' in text:
+        parts = []
+        for part in text.split('-'):
+            parts.append(str(int(part.strip())) if part.strip().isdigit() else part)
+        return '-'.join(parts)
+    try:
+        return str(int(text.strip()))
+    except ValueError:
+        return text
+
+
+class IdMappingStore:
+    """
+    On-disk raw ID -> encrypted ID mapping, stored in SQLite.
+
+    Rows are keyed by the encryption key fingerprint, so one database can hold
+    mappings for several keys without mixing them up. Lookups during a run are
+    served from an in-memory snapshot, and new mappings are added incrementally.
+    """
+
+    def __init__(self, db_path, key):
+        self.db_path = db_path
+        self.fingerprint = key_fingerprint(key)
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS id_map (
+                fingerprint TEXT NOT NULL,
+                raw_id TEXT NOT NULL,
+                canonical_id TEXT NOT NULL,
+                encrypted_id TEXT NOT NULL,
+                domain TEXT NOT NULL,
+                PRIMARY KEY (fingerprint, raw_id)
+            );
+            CREATE INDEX IF NOT EXISTS id_map_reverse
+                ON id_map (fingerprint, domain, encrypted_id);
+            CREATE TABLE IF NOT EXISTS collisions (
+                fingerprint TEXT NOT NULL,
+                domain TEXT NOT NULL,
+                encrypted_id TEXT NOT NULL,
+                raw_id TEXT NOT NULL,
+                existing_raw_id TEXT NOT NULL,
+                detected_at TEXT NOT NULL
+            );
+        """)
+        self.conn.commit()
+
+    def __len__(self):
+        row = self.conn.execute(
+            "SELECT COUNT(*) FROM id_map WHERE fingerprint = ?", (self.fingerprint,)
+        ).fetchone()
+        return row[0]
+
+    def snapshot(self):
+        """Return a read-only {raw ID: encrypted ID} mapping for this key."""
+        rows = self.conn.execute(
+            "SELECT raw_id, encrypted_id FROM id_map WHERE fingerprint = ?", (self.fingerprint,)
+        )
+        return MappingProxyType(dict(rows))
+
+    def lookup(self, raw_id):
+        """Return the encrypted ID for a raw ID, or None if it is not stored."""
+        row = self.conn.execute(
+            "SELECT encrypted_id FROM id_map WHERE fingerprint = ? AND raw_id = ?",
+            (self.fingerprint, str(raw_id))
+        ).fetchone()
+        return row[0] if row else None
+
+    def reverse_lookup(self, encrypted_id):
+        """Return every raw ID stored for an encrypted ID."""
+        rows = self.conn.execute(
+            "SELECT raw_id FROM id_map WHERE fingerprint = ? AND domain = ? AND encrypted_id = ?",
+            (self.fingerprint, id_domain(encrypted_id), str(encrypted_id))
+        )
+        return [row[0] for row in rows]
+
+    def add_many(self, mapping):
+        """
+        Insert new raw ID -> encrypted ID pairs, checking for collisions.
+
+        A collision is an encrypted ID already used by a different canonical
+        raw ID in the same digit-length domain. Collisions are recorded in the
+        collisions table and reported, but the mapping is still stored.
+
+        Args:
+            mapping (dict): Raw IDs to encrypted IDs
+
+        Returns:
+            tuple: (number of rows inserted, list of collision tuples)
+        """
+        detected_at = datetime.datetime.now().isoformat(timespec='seconds')
+        rows = []
+        for raw_id, encrypted_id in mapping.items():
+            raw_id = str(raw_id)
+            encrypted_id = str(encrypted_id)
+            rows.append((raw_id, canonical_id(raw_id), encrypted_id, id_domain(encrypted_id)))
+
+        with self.conn:
+            # Stage the batch in input order, keeping only raw IDs not stored yet
+            self.conn.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS id_batch (
+                    seq INTEGER PRIMARY KEY,
+                    raw_id TEXT NOT NULL UNIQUE,
+                    canonical_id TEXT NOT NULL,
+                    encrypted_id TEXT NOT NULL,
+                    domain TEXT NOT NULL
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS temp.id_batch_reverse ON id_batch (domain, encrypted_id)")
+            self.conn.execute("DELETE FROM id_batch")
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO id_batch (raw_id, canonical_id, encrypted_id, domain) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            self.conn.execute(
+                "DELETE FROM id_batch WHERE raw_id IN (SELECT raw_id FROM id_map WHERE fingerprint = ?)",
+                (self.fingerprint,)
+            )
+
+            # A new ID collides with a stored or earlier new ID of another canonical ID
+            collisions = self.conn.execute("""
+                SELECT b.domain, b.encrypted_id, b.raw_id, COALESCE(MIN(m.raw_id), MIN(e.raw_id))
+                FROM id_batch b
+                LEFT JOIN id_map m ON m.fingerprint = ? AND m.domain = b.domain
+                    AND m.encrypted_id = b.encrypted_id AND m.canonical_id != b.canonical_id
+                LEFT JOIN id_batch e ON e.seq < b.seq AND e.domain = b.domain
+                    AND e.encrypted_id = b.encrypted_id AND e.canonical_id != b.canonical_id
+                GROUP BY b.seq
+                HAVING COALESCE(MIN(m.raw_id), MIN(e.raw_id)) IS NOT NULL
+                ORDER BY b.seq
+            """, (self.fingerprint,)).fetchall()
+            self.conn.executemany(
+                "INSERT INTO collisions VALUES (?, ?, ?, ?, ?, ?)",
+                [(self.fingerprint, *collision, detected_at) for collision in collisions]
+            )
+
+            inserted = self.conn.execute(
+                "INSERT INTO id_map SELECT ?, raw_id, canonical_id, encrypted_id, domain FROM id_batch ORDER BY seq",
+                (self.fingerprint,)
+            ).rowcount
+            self.conn.execute("DELETE FROM id_batch")
+
+        if collisions:
+            print(f"WARNING: {len(collisions)} encrypted ID collisions detected, see the collisions table in {self.db_path}")
+
+        return inserted, collisions
+
+    def collision_count(self):
+        """Return the number of collisions recorded for this key."""
+        row = self.conn.execute(
+            "SELECT COUNT(*) FROM collisions WHERE fingerprint = ?", (self.fingerprint,)
+        ).fetchone()
+        return row[0]
+
+    def close(self):
+        self.conn.close()
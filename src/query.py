@@ -2,12 +2,22 @@ from google.cloud import bigquery
 import time
 import os
 import pandas as pd
-from tqdm import tqdm
+import uuid
+import datetime
 from tools.audit import append_audit
 # Get the current script directory and go back one directory
 env = os.path.dirname(os.path.abspath(__file__))
 env = os.path.dirname(env)  # Go back one directory
 
+# Add parent directory to path
+import sys
+sys.path.append(env)
+from config import CONFIG
+
+# BigQuery caps a request, query parameters included, at 10 MB. Cohorts above
+# this many patients are loaded into a table in the scratch dataset instead.
+MAX_PARAMETER_IDS = 100000
+
 
 BREAST_FILTER = """'IMG3425','IMG3426','IMG10897','IMG3571','IMG3557','IMG3558','IMG4636','IMG4637','IMG1100','IMG3506','IMG3545',
                   'IMG3508','IMG616','IMG3566','IMG1974','IMG3543','IMG3245','IMG3507','IMG3546','IMG3509','IMG1950','IMG3567',
@@ -117,90 +127,142 @@ def get_radiology_data(limit=None):
 
     return df
 
-def get_pathology_data(patient_ids, batch_size=1000):
+def get_pathology_data(patient_ids):
     """
-    Get pathology data for specific patient IDs, processing in batches
+    Get pathology data for specific patient IDs in a single query job
+    
+    The IDs are passed as an array query parameter and matched with UNNEST,
+    so the whole cohort is fetched by one job instead of one job per batch.
+    Cohorts larger than MAX_PARAMETER_IDS would push the request past
+    BigQuery's size limit, so they are loaded into a table in the
+    bigquery.scratch_dataset from the config and joined instead.
     
     Args:
         patient_ids (list): List of patient IDs to query
-        batch_size (int): Number of patients to process in each batch
     
     Returns:
         pandas.DataFrame: Query results as a dataframe
     """
     start_time = time.time()
+    if not patient_ids:
+        print("No patient IDs, skipping pathology query.")
+        return pd.DataFrame()
+    
+    scratch_dataset = CONFIG.get('bigquery', {}).get('scratch_dataset')
+    if len(patient_ids) > MAX_PARAMETER_IDS and not scratch_dataset:
+        raise ValueError(f"{len(patient_ids)} patient IDs are too many for one query parameter "
+                         f"(limit {MAX_PARAMETER_IDS}); set bigquery.scratch_dataset in the config "
+                         f"so they can be loaded into a table instead")
+    
     print("Initializing BigQuery client for pathology data...")
     client = bigquery.Client()
     
-    # Process in batches
-    all_results = []
-    total_patients = len(patient_ids)
-    total_batches = (total_patients + batch_size - 1) // batch_size
+    # Match the type of the clinic number column, as the inlined IDs used to
+    if all(str(id).isdigit() for id in patient_ids):
+        id_type, id_values = "INT64", [int(id) for id in patient_ids]
+    else:
+        id_type, id_values = "STRING", [str(id) for id in patient_ids]
     
-    # Create a tqdm progress bar
-    for i in tqdm(range(0, total_patients, batch_size), total=total_batches):
-        batch = patient_ids[i:i+batch_size]
-
-        # Format IDs appropriately
-        if batch and all(str(id).isdigit() for id in batch):
-            ids_str = ', '.join([str(id) for id in batch])
-        else:
-            ids_str = ', '.join([f"'{id}'" for id in batch])
-        
-        query = f"""
-        SELECT 
-          PAT_DIM_PATIENT.PATIENT_CLINIC_NUMBER AS PATIENT_ID,
-          PATH_FACT_PATHOLOGY.SPECIMEN_NOTE,
-          PATH_FACT_PATHOLOGY.SPECIMEN_UPDATE_DTM,
-          PATH_FACT_PATHOLOGY.SPECIMEN_RESULT_DTM,
-          PATH_FACT_PATHOLOGY.SPECIMEN_RECEIVED_DTM,
-          PATH_FACT_PATHOLOGY.SPECIMEN_SERVICE_DESCRIPTION,
-          PATH_FACT_PATHOLOGY.ENCOUNTER_ID,
-          DIAGCODE_DIM_DIAGNOSIS_CODE.DIAGNOSIS_NAME,
-          PATH_FACT_PATHOLOGY.PATHOLOGY_COUNT,
-          PATH_FACT_PATHOLOGY.SPECIMEN_COMMENT,
-          PATH_FACT_PATHOLOGY.SPECIMEN_ACCESSION_DTM,
-          PATH_FACT_PATHOLOGY.SPECIMEN_ACCESSION_NUMBER,
-          SPECDET.PART_DESCRIPTION,
-          SPECPARTYP.SPECIMEN_PART_TYPE_CODE,
-          SPECPARTYP.SPECIMEN_PART_TYPE_NAME
-        FROM `ml-mps-adl-intudp-phi-p-d5cb.phi_udpwh_etl_us_p.FACT_PATHOLOGY` PATH_FACT_PATHOLOGY
-        INNER JOIN
-          `ml-mps-adl-intudp-phi-p-d5cb.phi_udpwh_etl_us_p.DIM_PATIENT` PAT_DIM_PATIENT
-          ON (PATH_FACT_PATHOLOGY.PATIENT_DK = PAT_DIM_PATIENT.PATIENT_DK)
-        LEFT JOIN
-          `ml-mps-adl-intudp-phi-p-d5cb.phi_udpwh_etl_us_p.DIM_PATHOLOGY_DIAGNOSIS_CODE_BRIDGE` PATHDIAG
-          ON (PATH_FACT_PATHOLOGY.PATHOLOGY_FPK = PATHDIAG.PATHOLOGY_FPK)
-        LEFT JOIN
-          `ml-mps-adl-intudp-phi-p-d5cb.phi_udpwh_etl_us_p.DIM_DIAGNOSIS_CODE` DIAGCODE_DIM_DIAGNOSIS_CODE
-          ON (PATHDIAG.DIAGNOSIS_CODE_DK = DIAGCODE_DIM_DIAGNOSIS_CODE.DIAGNOSIS_CODE_DK)
-        LEFT JOIN
-          `ml-mps-adl-intudp-phi-p-d5cb.phi_udpwh_etl_us_p.FACT_PATHOLOGY_SPECIMEN_DETAIL` SPECDET
-          ON (PATH_FACT_PATHOLOGY.PATHOLOGY_FPK = SPECDET.PATHOLOGY_FPK)
-        LEFT JOIN
-          `ml-mps-adl-intudp-phi-p-d5cb.phi_udpwh_etl_us_p.DIM_SPECIMEN_PART_TYPE` SPECPARTYP
-          ON (SPECDET.SPECIMEN_PART_TYPE_DK = SPECPARTYP.SPECIMEN_PART_TYPE_DK)
-        WHERE PAT_DIM_PATIENT.PATIENT_CLINIC_NUMBER IN ({ids_str})
-        AND (
-          LOWER(SPECPARTYP.SPECIMEN_PART_TYPE_CODE) IN ('breast','breast1','breast2','breast3','breast4','breast5','breast6','breast7','breast8','breast9','breast10','breast11')
+    id_table = None
+    if len(patient_ids) > MAX_PARAMETER_IDS:
+        id_table = load_id_table(client, scratch_dataset, id_type, id_values)
+        patient_filter = f"IN (SELECT PATIENT_ID FROM `{id_table}`)"
+        job_config = bigquery.QueryJobConfig()
+    else:
+        patient_filter = "IN UNNEST(@patient_ids)"
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ArrayQueryParameter("patient_ids", id_type, id_values)]
         )
-        """
-        
-        batch_df = client.query(query).to_dataframe()
-        all_results.append(batch_df)
     
-    # Combine all batch results
-    if all_results:
-        df = pd.concat(all_results, ignore_index=True)
-    else:
-        df = pd.DataFrame()
+    query = f"""
+    SELECT 
+      PAT_DIM_PATIENT.PATIENT_CLINIC_NUMBER AS PATIENT_ID,
+      PATH_FACT_PATHOLOGY.SPECIMEN_NOTE,
+      PATH_FACT_PATHOLOGY.SPECIMEN_UPDATE_DTM,
+      PATH_FACT_PATHOLOGY.SPECIMEN_RESULT_DTM,
+      PATH_FACT_PATHOLOGY.SPECIMEN_RECEIVED_DTM,
+      PATH_FACT_PATHOLOGY.SPECIMEN_SERVICE_DESCRIPTION,
+      PATH_FACT_PATHOLOGY.ENCOUNTER_ID,
+      DIAGCODE_DIM_DIAGNOSIS_CODE.DIAGNOSIS_NAME,
+      PATH_FACT_PATHOLOGY.PATHOLOGY_COUNT,
+      PATH_FACT_PATHOLOGY.SPECIMEN_COMMENT,
+      PATH_FACT_PATHOLOGY.SPECIMEN_ACCESSION_DTM,
+      PATH_FACT_PATHOLOGY.SPECIMEN_ACCESSION_NUMBER,
+      SPECDET.PART_DESCRIPTION,
+      SPECPARTYP.SPECIMEN_PART_TYPE_CODE,
+      SPECPARTYP.SPECIMEN_PART_TYPE_NAME
+    FROM `ml-mps-adl-intudp-phi-p-d5cb.phi_udpwh_etl_us_p.FACT_PATHOLOGY` PATH_FACT_PATHOLOGY
+    INNER JOIN
+      `ml-mps-adl-intudp-phi-p-d5cb.phi_udpwh_etl_us_p.DIM_PATIENT` PAT_DIM_PATIENT
+      ON (PATH_FACT_PATHOLOGY.PATIENT_DK = PAT_DIM_PATIENT.PATIENT_DK)
+    LEFT JOIN
+      `ml-mps-adl-intudp-phi-p-d5cb.phi_udpwh_etl_us_p.DIM_PATHOLOGY_DIAGNOSIS_CODE_BRIDGE` PATHDIAG
+      ON (PATH_FACT_PATHOLOGY.PATHOLOGY_FPK = PATHDIAG.PATHOLOGY_FPK)
+    LEFT JOIN
+      `ml-mps-adl-intudp-phi-p-d5cb.phi_udpwh_etl_us_p.DIM_DIAGNOSIS_CODE` DIAGCODE_DIM_DIAGNOSIS_CODE
+      ON (PATHDIAG.DIAGNOSIS_CODE_DK = DIAGCODE_DIM_DIAGNOSIS_CODE.DIAGNOSIS_CODE_DK)
+    LEFT JOIN
+      `ml-mps-adl-intudp-phi-p-d5cb.phi_udpwh_etl_us_p.FACT_PATHOLOGY_SPECIMEN_DETAIL` SPECDET
+      ON (PATH_FACT_PATHOLOGY.PATHOLOGY_FPK = SPECDET.PATHOLOGY_FPK)
+    LEFT JOIN
+      `ml-mps-adl-intudp-phi-p-d5cb.phi_udpwh_etl_us_p.DIM_SPECIMEN_PART_TYPE` SPECPARTYP
+      ON (SPECDET.SPECIMEN_PART_TYPE_DK = SPECPARTYP.SPECIMEN_PART_TYPE_DK)
+    WHERE PAT_DIM_PATIENT.PATIENT_CLINIC_NUMBER {patient_filter}
+    AND (
+      LOWER(SPECPARTYP.SPECIMEN_PART_TYPE_CODE) IN ('breast','breast1','breast2','breast3','breast4','breast5','breast6','breast7','breast8','breast9','breast10','breast11')
+    )
+    """
+    
+    print(f"Executing pathology query for {len(patient_ids)} patients...")
+    try:
+        job = client.query(query, job_config=job_config)
+        df = job.to_dataframe()
+    finally:
+        if id_table:
+            client.delete_table(id_table, not_found_ok=True)
     
     total_duration = time.time() - start_time
-    print(f"Pathology query complete. Retrieved {len(df)} total rows in {total_duration:.2f} seconds.")
+    gb_processed = (job.total_bytes_processed or 0) / 1e9
+    jobs = "1 load job and 1 query job" if id_table else "1 job"
+    print(f"Pathology query complete. Retrieved {len(df)} total rows in {total_duration:.2f} seconds "
+          f"({jobs}, {gb_processed:.2f} GB processed).")
     
     return df
 
 
+def load_id_table(client, dataset, id_type, id_values):
+    """
+    Load patient IDs into a new table in dataset, created to expire after a day in case it is not deleted.
+    
+    Args:
+        client (bigquery.Client): BigQuery client
+        dataset (str): Dataset ID, optionally prefixed with the project
+        id_type (str): INT64 or STRING
+        id_values (list): Patient IDs
+    
+    Returns:
+        str: Full ID of the table
+    """
+    if '.' not in dataset:
+        dataset = f"{client.project}.{dataset}"
+    table_id = f"{dataset}.pathology_patient_ids_{uuid.uuid4().hex}"
+    
+    # The expiry is set when the table is created, so it never outlives a day even if the load fails
+    schema = [bigquery.SchemaField("PATIENT_ID", id_type)]
+    table = bigquery.Table(table_id, schema=schema)
+    table.expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=1)
+    client.create_table(table)
+    
+    print(f"Loading {len(id_values)} patient IDs into {table_id}...")
+    try:
+        job_config = bigquery.LoadJobConfig(schema=schema, write_disposition="WRITE_APPEND")
+        client.load_table_from_json([{"PATIENT_ID": value} for value in id_values], table_id, job_config=job_config).result()
+    except Exception:
+        client.delete_table(table_id, not_found_ok=True)
+        raise
+    return table_id
+
+
 def run_breast_imaging_query(limit=None):
     """
     Run queries with complete radiology and pathology data per patient
@@ -0,0 +1,49 @@
+import os
+import io
+import sys
+import time
+import argparse
+
+import pydicom
+
+# Make the Cloud Run service importable as `app`
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src", "_fastapi"))
+from app.dicom_header import read_instance_uids
+from load_test_download import make_dicom
+
+
+def read_uids_full(part_content):
+    """The previous approach: parse the whole part, pixel data included."""
+    dcm = pydicom.dcmread(io.BytesIO(part_content), force=True)
+    return dcm.get('SeriesInstanceUID'), dcm.get('SOPInstanceUID')
+
+
+def run_benchmark(sizes_mb, repeats=5):
+    print(f"Per-part CPU time (best of {repeats})")
+    for size_mb in sizes_mb:
+        part = make_dicom(int(size_mb * 1024 * 1024))
+
+        results = {}
+        for name, func in (("full dcmread", read_uids_full), ("header only", read_instance_uids)):
+            best = float('inf')
+            for _ in range(repeats):
+                start = time.process_time()
+                uids = func(part)
+                best = min(best, time.process_time() - start)
+            results[name] = (best, uids)
+
+        if results["full dcmread"][1] != results["header only"][1]:
+            raise AssertionError("Header-only reader returned different UIDs")
+
+        full_time = results["full dcmread"][0]
+        header_time = results["header only"][0]
+        print(f"- {size_mb:7.1f} MB part: full dcmread {full_time * 1000:9.2f} ms, "
+              f"header only {header_time * 1000:7.2f} ms ({full_time / max(header_time, 1e-9):.0f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark header-only UID extraction against a full dcmread')
+    parser.add_argument('--sizes', type=str, default="1,16,128", help='Comma separated part sizes in MB')
+    parser.add_argument('--repeats', type=int, default=5, help='Repetitions per size')
+    args = parser.parse_args()
+    run_benchmark([float(size) for size in args.sizes.split(",")], args.repeats)
@@ -0,0 +1,54 @@
+import os
+import time
+import random
+import argparse
+# Add parent directory to path
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.encrypt_keys import generate_key, encrypt_single_id, KeyedIdEncryptor
+
+
+def make_ids(count, seed=0):
+    """Generate a mix of patient-style and accession-style IDs."""
+    rng = random.Random(seed)
+    ids = []
+    for _ in range(count):
+        if rng.random() < 0.5:
+            ids.append(str(rng.randint(10**7, 10**8 - 1)))
+        else:
+            ids.append(f"{rng.randint(10**3, 10**4 - 1)}-{rng.randint(10**6, 10**7 - 1)}")
+    return ids
+
+
+def run_benchmark(count=100000, repeats=3):
+    key = generate_key()
+    ids = make_ids(count)
+    encryptor = KeyedIdEncryptor(key)
+
+    def best_of(func):
+        best = float('inf')
+        for _ in range(repeats):
+            start = time.perf_counter()
+            result = func()
+            best = min(best, time.perf_counter() - start)
+        return best, result
+
+    scalar_time, scalar_result = best_of(lambda: [encrypt_single_id(key, i) for i in ids])
+    keyed_time, keyed_result = best_of(lambda: [encryptor.encrypt(i) for i in ids])
+    batch_time, batch_result = best_of(lambda: encryptor.encrypt_many(ids))
+
+    if not (scalar_result == keyed_result == batch_result):
+        raise AssertionError("Batched encryption does not match encrypt_single_id")
+
+    print(f"Encrypted {count} IDs (best of {repeats})")
+    print(f"- {'encrypt_single_id':<32}{count / scalar_time:12,.0f} IDs/sec")
+    print(f"- {'KeyedIdEncryptor.encrypt':<32}{count / keyed_time:12,.0f} IDs/sec ({scalar_time / keyed_time:.1f}x)")
+    print(f"- {'KeyedIdEncryptor.encrypt_many':<32}{count / batch_time:12,.0f} IDs/sec ({scalar_time / batch_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark scalar vs batched ID encryption')
+    parser.add_argument('--count', type=int, default=100000, help='Number of IDs to encrypt')
+    parser.add_argument('--repeats', type=int, default=3, help='Repetitions per method')
+    args = parser.parse_args()
+    run_benchmark(args.count, args.repeats)
@@ -0,0 +1,471 @@
+import os
+import io
+import sys
+import math
+import time
+import json
+import datetime
+import base64
+import random
+import asyncio
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import httpx
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import generate_uid, ExplicitVRLittleEndian
+
+# Make the Cloud Run service importable as `app`
+FASTAPI_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src", "_fastapi")
+sys.path.insert(0, FASTAPI_DIR)
+
+BOUNDARY = "loadtest-boundary"
+# Redelivery of 429/503 responses, standing in for the subscription's retry policy
+REDELIVERY_ATTEMPTS = 100
+REDELIVERY_DELAY = 0.05
+FAKE_UID_ROOT = "1.2.826.0.1.3680043.10.1"
+
+
+def make_dicom(payload_size, series_uid=None, instance_uid=None):
+    """Build a minimal ultrasound DICOM instance with about `payload_size` bytes of pixel data.
+
+    Payloads over 1 MiB become multi-frame instances, like cine loops.
+    """
+    columns = min(max(1, payload_size), 1024)
+    rows = min(-(-max(1, payload_size) // columns), 1024)
+    frames = -(-max(1, payload_size) // (rows * columns))
+
+    file_meta = FileMetaDataset()
+    if frames > 1:
+        file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.3.1"  # Ultrasound Multi-frame Image Storage
+    else:
+        file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.6.1"  # Ultrasound Image Storage
+    file_meta.MediaStorageSOPInstanceUID = instance_uid or generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = file_meta
+    ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = generate_uid()
+    ds.SeriesInstanceUID = series_uid or generate_uid()
+    ds.PatientID = "12345678"
+    ds.AccessionNumber = "1234-5678901"
+    ds.Columns = columns
+    ds.Rows = rows
+    if frames > 1:
+        ds.NumberOfFrames = frames
+    ds.BitsAllocated = 8
+    ds.BitsStored = 8
+    ds.HighBit = 7
+    ds.SamplesPerPixel = 1
+    ds.PixelRepresentation = 0
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.PixelData = os.urandom(rows * columns * frames)
+
+    buffer = io.BytesIO()
+    try:
+        pydicom.dcmwrite(buffer, ds, enforce_file_format=True)
+    except TypeError:
+        # pydicom < 3.0
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        pydicom.dcmwrite(buffer, ds, write_like_original=False)
+    return buffer.getvalue()
+
+
+def parse_size(text):
+    """Parse a byte count such as 65536, 256k or 4m."""
+    text = text.strip().lower()
+    multiplier = {"k": 1024, "m": 1024 * 1024}.get(text[-1:], 1)
+    return int(float(text.rstrip("km")) * multiplier)
+
+
+def parse_range(text, parse=float):
+    """Parse "value" or "low-high" into a (low, high) tuple."""
+    low, _, high = text.partition("-")
+    return parse(low), parse(high or low)
+
+
+class StudyProfiles:
+    """
+    Deterministic per-study instance count, instance size and latency.
+
+    Counts and latencies are drawn uniformly from their ranges, sizes
+    log-uniformly, so a study mixes small images with the occasional large
+    cine loop. The same study index always gets the same profile, also on
+    reruns and redeliveries.
+    """
+
+    def __init__(self, instances=(10, 10), instance_size=(256 * 1024, 256 * 1024), latency=(0.05, 0.05), seed=0):
+        self.instances = instances
+        self.instance_size = instance_size
+        self.latency = latency
+        self.seed = seed
+
+    def rng(self, study, *extra):
+        return random.Random(":".join(str(part) for part in (self.seed, study) + extra))
+
+    def instance_count(self, study):
+        return self.rng(study, "count").randint(*self.instances)
+
+    def size(self, study, index):
+        low, high = self.instance_size
+        return int(math.exp(self.rng(study, "size", index).uniform(math.log(low), math.log(high))))
+
+    def delay(self, study):
+        return random.uniform(*self.latency)
+
+    def describe(self):
+        def span(values, fmt):
+            return fmt(values[0]) if values[0] == values[1] else f"{fmt(values[0])}-{fmt(values[1])}"
+        return (f"{span(self.instances, str)} instances x {span(self.instance_size, lambda v: f'{v / 1024:.0f} KiB')}, "
+                f"{span(self.latency, lambda v: f'{v * 1000:.0f}')} ms latency")
+
+
+class FakeDicomWebHandler(BaseHTTPRequestHandler):
+    """Serves every study as a multipart/related response of synthetic instances."""
+
+    protocol_version = "HTTP/1.1"
+    profiles = StudyProfiles()
+    quota_error_rate = 0.0
+    # Most QIDO results returned for one query, whatever limit is asked for
+    qido_max_results = 5000
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        path = url.path.rstrip("/").split("/")
+        study = path[path.index("studies") + 1]
+        time.sleep(self.profiles.delay(study))
+
+        # Simulate Healthcare API quota errors
+        if random.random() < self.quota_error_rate:
+            self.send_response(429)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        # QIDO listing and single-instance retrieval, for retrieval by instance
+        if path[-1] == "instances":
+            records = [
+                {"0020000E": {"vr": "UI", "Value": [f"{FAKE_UID_ROOT}.{study}.1"]},
+                 "00080018": {"vr": "UI", "Value": [f"{FAKE_UID_ROOT}.{study}.1.{index}"]}}
+                for index in range(self.profiles.instance_count(study))
+            ]
+            # Page like a real server, which also caps results per query and says so in a Warning
+            offset = int(query.get("offset", ["0"])[0])
+            limit = min(int(query.get("limit", [str(self.qido_max_results)])[0]), self.qido_max_results)
+            remaining = len(records) - offset - limit
+            headers = {"Warning": f"299 fake: There are {remaining} additional results that can be requested"} if remaining > 0 else {}
+            self.send_body("application/dicom+json", json.dumps(records[offset:offset + limit]).encode(), headers)
+            return
+        if len(path) >= 4 and path[-2] == "instances":
+            index = int(path[-1].rsplit(".", 1)[-1])
+            self.send_body("application/dicom", make_dicom(self.profiles.size(study, index), path[-3], path[-1]))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", f'multipart/related; type="application/dicom"; boundary={BOUNDARY}')
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        for index in range(self.profiles.instance_count(study)):
+            part = (
+                f"--{BOUNDARY}\r\nContent-Type: application/dicom\r\n\r\n".encode()
+                + make_dicom(self.profiles.size(study, index)) + b"\r\n"
+            )
+            self.write_chunk(part)
+        self.write_chunk(f"--{BOUNDARY}--\r\n".encode())
+        self.write_chunk(b"")
+
+    def send_body(self, content_type, body, headers=None):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        # Preconditions are not checked; the load test delivers each study to one handler at a time
+        if isinstance(data, str):
+            data = data.encode()
+        if self.bucket.root:
+            path = os.path.join(self.bucket.root, self.name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+        with self.bucket.lock:
+            self.bucket.objects[self.name] = len(data)
+
+    def download_as_bytes(self):
+        if not self.bucket.root:
+            raise FileNotFoundError(self.name)
+        with open(os.path.join(self.bucket.root, self.name), "rb") as f:
+            return f.read()
+
+    def exists(self):
+        with self.bucket.lock:
+            if self.name in self.bucket.objects:
+                return True
+        return bool(self.bucket.root) and os.path.exists(os.path.join(self.bucket.root, self.name))
+
+
+class FakeBucket:
+    """
+    Stand-in for a GCS bucket that records object sizes.
+
+    With a root directory objects are also written to disk, so uploads pay
+    real I/O and the output can be inspected after the run.
+    """
+
+    def __init__(self, root=None):
+        self.root = root
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name):
+        blob = FakeBlob(self, name)
+        blob.generation = 1
+        return blob if blob.exists() else None
+
+
+class FakeStorageClient:
+    bucket_instance = FakeBucket()
+
+    def bucket(self, name):
+        return self.bucket_instance
+
+
+def start_fake_dicomweb():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeDicomWebHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def fake_push_token(audience="http://service"):
+    """A JWT shaped like the OIDC token Pub/Sub attaches to push requests, with a random signature."""
+    now = int(time.time())
+    header = {"alg": "RS256", "kid": "loadtest", "typ": "JWT"}
+    claims = {
+        "aud": audience,
+        "azp": "loadtest",
+        "email": "pubsub-push@loadtest.iam.gserviceaccount.com",
+        "email_verified": True,
+        "exp": now + 3600,
+        "iat": now,
+        "iss": "https://accounts.google.com",
+        "sub": "loadtest",
+    }
+    return ".".join([b64url(json.dumps(header).encode()), b64url(json.dumps(claims).encode()), b64url(os.urandom(256))])
+
+
+def decode_fake_push_token(token):
+    """Stand-in for verify_jwt: checks the token's shape and expiry, not its signature."""
+    header, payload, signature = token.split(".")
+    claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+    if claims["exp"] < time.time():
+        raise ValueError("Token expired")
+    return claims
+
+
+def push_envelope(url, attempt=1):
+    """A Pub/Sub push request body for one study URL."""
+    return {
+        "message": {
+            "data": base64.b64encode(url.encode()).decode(),
+            "attributes": {"source": "loadtest"},
+            "messageId": str(time.time_ns()),
+            "publishTime": datetime.datetime.now(datetime.timezone.utc).isoformat().replace("+00:00", "Z"),
+        },
+        "subscription": "projects/loadtest/subscriptions/loadtest",
+        "deliveryAttempt": attempt,
+    }
+
+
+async def drive(service, base_url, studies, concurrency, rate=0.0):
+    """
+    Push `studies` study URLs to the service, redelivering retryable responses.
+
+    Args:
+        concurrency (int): Push requests in flight at most
+        rate (float): Studies per second to publish, 0 to push them all at once
+
+    Returns:
+        dict: elapsed seconds, failed and deferred counts, and per-study latencies
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=service.app)
+    deferred = 0
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://service", timeout=None) as client:
+        async def send(index):
+            nonlocal deferred
+            if rate > 0:
+                await asyncio.sleep(start + index / rate - time.perf_counter())
+            published = time.perf_counter()
+
+            # Redeliver on retryable statuses, like Pub/Sub does with its retry policy
+            for attempt in range(REDELIVERY_ATTEMPTS):
+                async with semaphore:
+                    response = await client.post(
+                        "/push_handlers/receive_messages",
+                        headers={"Authorization": f"Bearer {fake_push_token()}"},
+                        json=push_envelope(f"{base_url}/studies/{index}", attempt + 1),
+                    )
+                if response.status_code not in (429, 503):
+                    break
+                deferred += 1
+                await asyncio.sleep(REDELIVERY_DELAY * (attempt + 1))
+            return response.status_code, time.perf_counter() - published
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(send(i) for i in range(studies)))
+        elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for _, latency in results)
+    return {
+        "elapsed": elapsed,
+        "failed": sum(1 for status, _ in results if status >= 300),
+        "deferred": deferred,
+        "latencies": latencies,
+    }
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))] if sorted_values else 0.0
+
+
+def run_load_test(studies=40, concurrency=80, limits=(1, 8), profiles=None, rate=0.0, storage_dir=None,
+                  quota_error_rate=0.0, dicomweb_qps=0.0, by_instance=False, rerun=False, inline_deid=False):
+    FakeDicomWebHandler.profiles = profiles or StudyProfiles()
+    FakeDicomWebHandler.quota_error_rate = quota_error_rate
+
+    import app.main as service
+    import app.retrieval as retrieval
+    from app.admission import AdmissionController
+    from app.dicomweb import DicomWebClient, dicomweb_rate_limiter
+    from app.metrics import ServiceMetrics
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    # Swap external services for local stand-ins
+    retrieval.get_storage_client = FakeStorageClient
+    service.verify_jwt = decode_fake_push_token
+
+    retrieval.RETRIEVE_BY_INSTANCE = by_instance
+    if inline_deid:
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        from src.deid_core import deidentify_bytes
+        retrieval.INLINE_DEID = True
+        retrieval.deidentify_bytes = deidentify_bytes
+        retrieval.DEID_KEY = os.urandom(16)
+        retrieval.ANON_BUCKET_PATH = "Anonymized/loadtest"
+
+    server = start_fake_dicomweb()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    arrival = f"{rate:g} studies/s" if rate > 0 else "all at once"
+    print(f"{studies} studies of {FakeDicomWebHandler.profiles.describe()}, arriving {arrival}")
+    for limit in limits:
+        service.STUDY_EXECUTOR = ThreadPoolExecutor(max_workers=limit, thread_name_prefix="study")
+        # The push handler and the retrieval code must share the same instances
+        service.ADMISSION = retrieval.ADMISSION = AdmissionController(limit, retrieval.MAX_INFLIGHT_BYTES, retrieval.MEMORY_LIMIT)
+        service.DICOMWEB = retrieval.DICOMWEB = DicomWebClient(retrieval.get_http_session, lambda: "loadtest-token",
+                                                               dicomweb_rate_limiter(dicomweb_qps), backoff_base=0.05)
+        run_dir = os.path.join(storage_dir, f"limit_{limit}") if storage_dir else None
+        FakeStorageClient.bucket_instance = FakeBucket(run_dir)
+        retrieval._completed_studies.clear()
+        service.METRICS = retrieval.METRICS = ServiceMetrics()
+
+        result = asyncio.run(drive(service, base_url, studies, concurrency, rate))
+        objects = FakeStorageClient.bucket_instance.objects
+        stored = sum(1 for name in objects if name.endswith(".dcm") and not name.startswith("Anonymized/"))
+        anonymized = sum(1 for name in objects if name.startswith("Anonymized/"))
+        completed = sum(1 for name in objects if name.endswith(retrieval.COMPLETION_MARKER))
+        stored_bytes = sum(size for name, size in objects.items() if name.endswith(".dcm") and not name.startswith("Anonymized/"))
+        metrics = service.collect_metrics()
+
+        print(f"- MAX_CONCURRENT_STUDIES={limit:<3} {studies / result['elapsed'] * 60:8.1f} studies/min, "
+              f"study latency p50 {percentile(result['latencies'], 0.5):.2f}s p95 {percentile(result['latencies'], 0.95):.2f}s, "
+              f"peak RSS {metrics['peak_rss_bytes'] / 1e6:.0f} MB")
+        print(f"  {result['elapsed']:.1f}s, {stored} instances ({stored_bytes / 1e6:.0f} MB) stored, {completed} studies marked complete, "
+              f"{anonymized} de-identified, {result['failed']} failed, {result['deferred']} deferred")
+        dicomweb = service.DICOMWEB.stats()
+        print(f"  DICOMweb: {dicomweb['requests']} requests, statuses {dicomweb['status_counts']}, "
+              f"{dicomweb['retries']} retries, {dicomweb['throttle_wait_seconds']:.1f}s throttled")
+        phases = ", ".join(f"{phase} p95 {timer['p95_ms']:.0f} ms" for phase, timer in metrics['phases'].items() if timer['count'])
+        print(f"  Metrics: {metrics['instances_per_second']:.0f} instances/s, {metrics['bytes_per_second'] / 1e6:.1f} MB/s, {phases}")
+
+        if rerun:
+            # Push the same studies again, as a redelivery or `main.py --rerun` would
+            requests_before = service.DICOMWEB.stats()['requests']
+            result = asyncio.run(drive(service, base_url, studies, concurrency, rate))
+            print(f"  Rerun: {result['elapsed']:.1f}s, {service.DICOMWEB.stats()['requests'] - requests_before} DICOMweb requests, "
+                  f"{result['failed']} failed requests")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local load test for the DICOM download service')
+    parser.add_argument('--studies', type=int, default=40, help='Number of studies to push')
+    parser.add_argument('--concurrency', type=int, default=80, help='Push requests in flight (Cloud Run concurrency)')
+    parser.add_argument('--rate', type=float, default=0.0, help='Studies published per second (0 = all at once)')
+    parser.add_argument('--limits', type=str, default="1,8", help='Comma separated MAX_CONCURRENT_STUDIES values to compare')
+    parser.add_argument('--instances', type=str, default="10", help='Instances per study, e.g. 10 or 5-40')
+    parser.add_argument('--instance-size', type=str, default="256k", help='Pixel bytes per instance, e.g. 256k or 64k-8m')
+    parser.add_argument('--latency', type=str, default="0.05", help='DICOMweb response latency in seconds, e.g. 0.05 or 0.02-0.5')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the per-study profiles')
+    parser.add_argument('--storage-dir', type=str, help='Also write uploaded objects under this directory; completion markers left there by earlier runs are honoured')
+    parser.add_argument('--quota-error-rate', type=float, default=0.0, help='Fraction of DICOMweb requests answered with 429')
+    parser.add_argument('--by-instance', action='store_true', help='List studies and fetch instances in parallel')
+    parser.add_argument('--inline-deid', action='store_true', help='De-identify each part at ingest')
+    parser.add_argument('--rerun', action='store_true', help='Push every study a second time after the run')
+    parser.add_argument('--dicomweb-qps', type=float, default=0.0, help='DICOMweb requests per second allowed (0 = unlimited)')
+    args = parser.parse_args()
+
+    run_load_test(
+        studies=args.studies,
+        concurrency=args.concurrency,
+        limits=[int(limit) for limit in args.limits.split(",")],
+        profiles=StudyProfiles(
+            instances=parse_range(args.instances, int),
+            instance_size=parse_range(args.instance_size, parse_size),
+            latency=parse_range(args.latency, float),
+            seed=args.seed,
+        ),
+        rate=args.rate,
+        storage_dir=args.storage_dir,
+        quota_error_rate=args.quota_error_rate,
+        dicomweb_qps=args.dicomweb_qps,
+        by_instance=args.by_instance,
+        rerun=args.rerun,
+        inline_deid=args.inline_deid,
+    )